@@ -0,0 +1,422 @@
+import os, os.path, shutil
+import argparse
+import copy
+import gc
+import json
+import subprocess
+import tempfile
+import sys
+import time
+import tracemalloc
+from pgs_exports.PGSExport import PGSExport
+from pgs_exports.PGSBlobStore import PGSBlobStore
+from pgs_exports.PGSCatalogue import PGSCatalogue
+from pgs_exports.PGSExportGenerator import PGSExportGenerator
+from pgs_exports.PGSReleaseVerifier import PGSReleaseVerifier
+
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+input_data_dir = current_dir+'/tests/data'
+bench_dir = current_dir+'/tests/benchmark/'
+
+ancestry_categories = {
+    "MAE": "Multi-ancestry (including European)",
+    "MAO": "Multi-ancestry (excluding European)",
+    "AFR": "African",
+    "EAS": "East Asian",
+    "SAS": "South Asian",
+    "ASN": "Additional Asian Ancestries",
+    "EUR": "European",
+    "GME": "Greater Middle Eastern",
+    "AMR": "Hispanic or Latin American",
+    "OTH": "Additional Diverse Ancestries",
+    "NR": "Not Reported"
+}
+
+
+#==========================#
+#  Synthetic catalogue     #
+#==========================#
+
+def load_test_data():
+    ''' Load the test data (JSON files from "tests/data") '''
+    data = {}
+    for type in ['score', 'trait', 'publication', 'performance', 'cohort']:
+        with open(f'{input_data_dir}/{type}.json') as f:
+            data[type] = json.load(f)
+    return data
+
+
+def build_synthetic_data(scores_count, large_publication_scores=0, performances_per_score=2):
+    '''
+    Build a synthetic catalogue, using the test data as templates.
+    > Parameters:
+        - scores_count: number of Scores to generate
+        - large_publication_scores: number of these Scores evaluated by a single large publication ("PGP999999")
+        - performances_per_score: number of Performance Metrics generated for each Score
+    > Return type: dictionary (same structure as the REST API data)
+    '''
+    template = load_test_data()
+    score_tpl = template['score'][0]
+    perf_tpl = template['performance'][0]
+    pub_tpl = template['publication'][0]
+
+    large_pub = copy.deepcopy(pub_tpl)
+    large_pub['id'] = 'PGP999999'
+    large_pub['associated_pgs_ids'] = {'development': [], 'evaluation': []}
+
+    data = {
+        'score': [],
+        'performance': [],
+        'publication': [],
+        'trait': copy.deepcopy(template['trait']),
+        'cohort': copy.deepcopy(template['cohort'])
+    }
+    ppm_num = 0
+    pss_num = 0
+    for i in range(1, scores_count+1):
+        pgs_id = f'PGS{i:06d}'
+        pgp_id = f'PGP{i:06d}'
+
+        publication = copy.deepcopy(pub_tpl)
+        publication['id'] = pgp_id
+        publication['associated_pgs_ids'] = {'development': [pgs_id], 'evaluation': [pgs_id]}
+        data['publication'].append(publication)
+
+        score = copy.deepcopy(score_tpl)
+        score['id'] = pgs_id
+        score['publication'] = { k: v for k, v in publication.items() if k not in ('date_release', 'authors', 'associated_pgs_ids') }
+        data['score'].append(score)
+
+        is_large = i <= large_publication_scores
+        if is_large:
+            large_pub['associated_pgs_ids']['evaluation'].append(pgs_id)
+        for j in range(performances_per_score):
+            ppm_num += 1
+            pss_num += 1
+            perf = copy.deepcopy(perf_tpl)
+            perf['id'] = f'PPM{ppm_num:06d}'
+            perf['associated_pgs_id'] = pgs_id
+            perf['sampleset']['id'] = f'PSS{pss_num:06d}'
+            if is_large:
+                perf['publication'] = { k: v for k, v in large_pub.items() if k not in ('date_release', 'authors', 'associated_pgs_ids') }
+            else:
+                perf['publication'] = copy.deepcopy(score['publication'])
+            data['performance'].append(perf)
+
+    if large_publication_scores:
+        data['publication'].append(large_pub)
+    return data
+
+
+#==========================#
+#  Benchmarks              #
+#==========================#
+
+def benchmark_large_publication(scores_count, large_publication_scores, performances_per_score):
+    ''' Time the export of a large publication (evaluating a lot of Scores) '''
+    print(f'# Large publication: {large_publication_scores} evaluated scores, {performances_per_score} performances per score')
+    data = build_synthetic_data(scores_count, large_publication_scores, performances_per_score)
+    pgs_ids_list = [ x for x in data['publication'] if x['id'] == 'PGP999999' ][0]['associated_pgs_ids']['evaluation']
+
+    datadir = bench_dir+'PGP999999/'
+    os.makedirs(datadir, exist_ok=True)
+
+    pgs_export = PGSExport(datadir+'PGP999999_metadata.xlsx', data, ancestry_categories, True)
+    pgs_export.set_pgs_list(pgs_ids_list)
+
+    start = time.perf_counter()
+    perf_data = pgs_export.create_performance_metrics_spreadsheet()
+    duration = time.perf_counter() - start
+    perf_count = len(perf_data['PGS Performance Metric (PPM) ID'])
+    print(f'\t> Performance Metrics spreadsheet: {perf_count} rows in {duration:.2f}s')
+
+    start = time.perf_counter()
+    pgs_export.generate_sheets(datadir+'PGP999999')
+    pgs_export.save()
+    duration = time.perf_counter() - start
+    print(f'\t> Full publication export: {duration:.2f}s')
+
+
+def benchmark_export_scheduler(scores_count, large_publication_scores, performances_per_score, workers=2):
+    '''
+    Compare the time to run the PGS and large study exports on worker processes, in the order of the list
+    (large study last, as a naive parallel map) and largest first (cost estimated from the metadata)
+    '''
+    from pgs_exports.PGSExportScheduler import PGSExportScheduler
+    print(f'# Export scheduler: {scores_count} scores, 1 large publication evaluating {large_publication_scores} scores, {workers} workers')
+    data = build_synthetic_data(scores_count, large_publication_scores, performances_per_score)
+    catalogue = PGSCatalogue(data)
+    tasks = [ ('generate_study_metadata_export', x) for x in catalogue.get_score_ids() ] + [ ('generate_large_study_metadata_export', 'PGP999999') ]
+    get_tasks_costs = PGSExportScheduler.get_tasks_costs
+    try:
+        for label, costs_function in (('list order', lambda self, tasks, data_index: { x: 1 for x in tasks }), ('largest first', get_tasks_costs)):
+            export_dir = bench_dir+'scheduler/'
+            os.makedirs(export_dir, exist_ok=True)
+            PGSExportScheduler.get_tasks_costs = costs_function
+            exports_generator = PGSExportGenerator(export_dir, catalogue.data, export_dir+'pgs_scores_list.txt', catalogue.get_score_ids(), ['PGP999999'], '2020-12-15', ancestry_categories, 0, workers=workers, data_index=catalogue)
+            start = time.perf_counter()
+            exports_generator.run_export_tasks(tasks)
+            print(f'\t> {label}: {time.perf_counter() - start:.2f}s')
+            shutil.rmtree(export_dir)
+    finally:
+        PGSExportScheduler.get_tasks_costs = get_tasks_costs
+
+
+def benchmark_catalogue_memory(scores_count):
+    ''' Compare the memory used by the REST API dictionaries and by the compact catalogue model '''
+    print(f'# Catalogue memory: {scores_count} scores')
+    # JSON round trip, to get the same (unshared) objects as the REST API responses
+    json_data = json.dumps(build_synthetic_data(scores_count))
+
+    gc.collect()
+    tracemalloc.start()
+    data = json.loads(json_data)
+    data_size = tracemalloc.get_traced_memory()[0]
+    print(f'\t> REST API dictionaries: {data_size/1024**2:.1f} MB')
+
+    start = time.perf_counter()
+    catalogue = PGSCatalogue(data)
+    duration = time.perf_counter() - start
+    del data
+    gc.collect()
+    catalogue_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'\t> Compact catalogue: {catalogue_size/1024**2:.1f} MB (built in {duration:.2f}s) - {100*(1-catalogue_size/data_size):.0f}% reduction')
+
+
+def benchmark_csv_backends(scores_count):
+    ''' Compare the time to generate the per-score exports, with the CSV files written by Pandas or by the csv module '''
+    print(f'# Per-score exports: {scores_count} scores')
+    catalogue = PGSCatalogue(build_synthetic_data(scores_count))
+    score_ids_list = catalogue.get_score_ids()
+    for csv_backend in ('pandas', 'csv'):
+        export_dir = f'{bench_dir}scores_{csv_backend}/'
+        os.makedirs(export_dir, exist_ok=True)
+        exports_generator = PGSExportGenerator(export_dir,catalogue.data,export_dir+'pgs_scores_list.txt',score_ids_list,[],'2020-12-15',ancestry_categories,0,data_index=catalogue,csv_backends={'score': csv_backend})
+        start = time.perf_counter()
+        exports_generator.call_generate_studies_metadata_exports()
+        duration = time.perf_counter() - start
+        print(f'\t> CSV written with {csv_backend}: {duration:.2f}s ({1000*duration/scores_count:.1f}ms per score)')
+
+
+def benchmark_export_bundles(scores_count):
+    ''' Compare the time to generate the per-score exports, with the tar files built from the export directories or from in-memory bundles '''
+    print(f'# Per-score tar files: {scores_count} scores')
+    catalogue = PGSCatalogue(build_synthetic_data(scores_count))
+    score_ids_list = catalogue.get_score_ids()
+    for in_memory_bundle in (False, True):
+        export_dir = f'{bench_dir}scores_bundle_{in_memory_bundle}/'
+        os.makedirs(export_dir, exist_ok=True)
+        exports_generator = PGSExportGenerator(export_dir,catalogue.data,export_dir+'pgs_scores_list.txt',score_ids_list,[],'2020-12-15',ancestry_categories,0,data_index=catalogue)
+        exports_generator.in_memory_bundles = dict(exports_generator.in_memory_bundles, score=in_memory_bundle)
+        start = time.perf_counter()
+        exports_generator.call_generate_studies_metadata_exports()
+        duration = time.perf_counter() - start
+        label = 'in-memory bundles' if in_memory_bundle else 'export directories'
+        print(f'\t> Tar files built from the {label}: {duration:.2f}s ({1000*duration/scores_count:.1f}ms per score)')
+
+
+def benchmark_incremental_all_metadata(scores_count, released_scores):
+    ''' Compare the time of the all metadata export, fully rebuilt or patched from the tables of the previous release '''
+    print(f'# All metadata export: {scores_count} scores, {released_scores} released since the previous release')
+    data = build_synthetic_data(scores_count)
+    previous_catalogue = PGSCatalogue(data)
+    # The Scores released again have a new name
+    for score in data['score'][-released_scores:]:
+        score['name'] += ' (updated)'
+    catalogue = PGSCatalogue(data)
+    score_ids_list = catalogue.get_score_ids()
+    previous_tables_file = None
+    csv_files = {}
+    for label in ('previous release', 'full rebuild', 'incremental'):
+        export_dir = f'{bench_dir}all_metadata_{label.replace(" ", "_")}/'
+        os.makedirs(export_dir, exist_ok=True)
+        exports_catalogue = previous_catalogue if label == 'previous release' else catalogue
+        exports_generator = PGSExportGenerator(export_dir,exports_catalogue.data,export_dir+'pgs_scores_list.txt',score_ids_list,[],'2020-12-15',ancestry_categories,0,data_index=exports_catalogue,previous_tables_file=previous_tables_file if label == 'incremental' else None)
+        start = time.perf_counter()
+        exports_generator.call_generate_all_metadata_exports()
+        duration = time.perf_counter() - start
+        csv_files[label] = {}
+        for csv_file in sorted(x for x in os.listdir(export_dir+'all_metadata') if x.endswith('.csv')):
+            with open(export_dir+'all_metadata/'+csv_file) as f:
+                csv_files[label][csv_file] = f.read()
+        print(f'\t> {label}: {duration:.2f}s')
+        if label == 'previous release':
+            previous_tables_file = export_dir+PGSExportGenerator.all_metadata_tables_file
+    print(f'\t> Incremental files identical to the full rebuild: {csv_files["full rebuild"] == csv_files["incremental"]}')
+
+
+def benchmark_release_verifier(scores_count):
+    ''' Measure the throughput of the verification of the FTP structure (per-score exports), with one or several processes '''
+    print(f'# Verification of the FTP structure: {scores_count} per-score exports')
+    catalogue = PGSCatalogue(build_synthetic_data(scores_count))
+    score_ids_list = catalogue.get_score_ids()
+    export_dir = f'{bench_dir}scores_verified/'
+    os.makedirs(export_dir, exist_ok=True)
+    exports_generator = PGSExportGenerator(export_dir,catalogue.data,export_dir+'pgs_scores_list.txt',score_ids_list,[],'2020-12-15',ancestry_categories,0,data_index=catalogue)
+    exports_generator.call_generate_studies_metadata_exports()
+
+    # FTP structure of the Scores (files hardlinked from the exports)
+    ftp_dir = f'{bench_dir}ftp_verified/'
+    for pgs_id in score_ids_list:
+        ftp_meta_dir = f'{ftp_dir}scores/{pgs_id}/Metadata/'
+        os.makedirs(ftp_meta_dir, exist_ok=True)
+        for filename in os.listdir(f'{export_dir}{pgs_id}/Metadata/'):
+            os.link(f'{export_dir}{pgs_id}/Metadata/{filename}', ftp_meta_dir+filename)
+        os.link(f'{export_dir}{pgs_id}_metadata.tar.gz', f'{ftp_meta_dir}{pgs_id}_metadata.tar.gz')
+
+    for workers in sorted(set([1, os.cpu_count() or 1])):
+        verifier = PGSReleaseVerifier(ftp_dir, catalogue, workers)
+        verified = verifier.run()
+        files_count = verifier.stats['files']
+        print(f'\t> {workers} process(es): {files_count} files verified in {verifier.duration:.2f}s ({files_count/verifier.duration:.0f} files/s, ~{100000*verifier.duration/files_count:.0f}s for 100k files) - {len(verifier.errors)} error(s)')
+
+
+def benchmark_blob_store(scores_count):
+    ''' Measure the deduplication of the per-score CSV files by the blob store '''
+    print(f'# Blob store: {scores_count} per-score exports')
+    catalogue = PGSCatalogue(build_synthetic_data(scores_count))
+    score_ids_list = catalogue.get_score_ids()
+    export_dir = f'{bench_dir}scores_blobs/'
+    os.makedirs(export_dir, exist_ok=True)
+    blob_store = PGSBlobStore(export_dir+'.blobs')
+    exports_generator = PGSExportGenerator(export_dir,catalogue.data,export_dir+'pgs_scores_list.txt',score_ids_list,[],'2020-12-15',ancestry_categories,0,data_index=catalogue,blob_store=blob_store)
+    start = time.perf_counter()
+    exports_generator.call_generate_studies_metadata_exports()
+    duration = time.perf_counter() - start
+    print(f'\t> Exports generated in {duration:.2f}s ({1000*duration/scores_count:.1f}ms per score)')
+    blob_store.report()
+
+
+def benchmark_rest_fetch(scores_count, latency):
+    '''
+    Compare the time to fetch the metadata from a local stand-in of the REST API, with sequential and concurrent requests,
+    small and large pages, and a second fetch answered from the cache (conditional requests)
+    '''
+    from pgs_exports.PGSRestCache import PGSRestCache
+    from pgs_exports.PGSRestFetcher import PGSRestFetcher
+    from rest_stand_in import PGSRestStandIn
+    print(f'# REST fetch: {scores_count} scores, {1000*latency:.0f}ms latency per request')
+    stand_in = PGSRestStandIn(build_synthetic_data(scores_count), latency=latency).start()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        runs = [
+            (f'{concurrency} concurrent request(s), {page_size} results per page', concurrency, page_size, None)
+            for concurrency, page_size in ((1, PGSRestStandIn.default_page_size), (8, PGSRestStandIn.default_page_size), (8, PGSRestFetcher.max_page_size))
+        ]
+        runs += [ (f'8 concurrent requests, {label}', 8, PGSRestFetcher.max_page_size, cache_dir) for label in ('empty cache', 'cached responses') ]
+        for label, concurrency, page_size, cache in runs:
+            fetcher = PGSRestFetcher(stand_in.url, concurrency, cache=PGSRestCache(cache) if cache else None, page_size=page_size)
+            start = time.perf_counter()
+            fetcher.fetch_release_data()
+            duration = time.perf_counter() - start
+            print(f'\t> {label}: {fetcher.requests_count} requests ({fetcher.not_modified_count} not modified), {fetcher.received_bytes} bytes received (decoded) in {duration:.2f}s')
+    finally:
+        stand_in.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def benchmark_pipeline(scores_count, latency, error_rate):
+    '''
+    Time the steps of the release (main script), run end to end against a local stand-in of the REST API (synthetic catalogue,
+    with latency and errors) and a local FTP tree: a first release on an empty FTP, then a second release on the FTP of the first one,
+    then the same release with the streaming pipeline (the FTP structure is built while the entries are exported)
+    '''
+    import pgs_metadata_exports
+    from pgs_exports.PGSBuildFtp import PGSBuildFtp
+    from pgs_exports.PGSHashService import PGSHashService
+    from rest_stand_in import PGSRestStandIn
+    print(f'# Release pipeline: {scores_count} scores, {1000*latency:.0f}ms latency per request, {100*error_rate:.0f}% of errors')
+    pipeline_dir = bench_dir+'pipeline/'
+    release_dir = pipeline_dir+'release'
+    ftp_dir = pipeline_dir+'ftp/'
+    for dirpath in (release_dir, ftp_dir+'scores', ftp_dir+'metadata'):
+        os.makedirs(dirpath, exist_ok=True)
+
+    stand_in = PGSRestStandIn(build_synthetic_data(scores_count), latency=latency, error_rate=error_rate).start()
+    ftp_path = PGSBuildFtp.ftp_path
+    PGSBuildFtp.ftp_path = ftp_dir
+    argv = sys.argv
+    try:
+        releases = [
+            ('first release (empty FTP)', [ [x] for x in pgs_metadata_exports.commands ]),
+            ('second release (FTP of the first release)', [ [x] for x in pgs_metadata_exports.commands ]),
+            ('second release, streaming pipeline', [['release', '--stream_ftp']])
+        ]
+        for release, commands in releases:
+            durations = []
+            for command in commands:
+                sys.argv = ['pgs_metadata_exports.py', *command, '--url', stand_in.url, '--dir', release_dir, '--rest_rate_limit', '0', '--workers', '2', '--ftp_listing', pipeline_dir+'ftp_listing.tsv']
+                start = time.perf_counter()
+                pgs_metadata_exports.main()
+                durations.append((' '.join(command), time.perf_counter() - start))
+            print(f'\t> {release}: {sum([ x[1] for x in durations ]):.2f}s ('+' | '.join([ f'{x}: {d:.2f}s' for x, d in durations ])+')')
+            os.remove(pipeline_dir+'ftp_listing.tsv')
+            # The new FTP content becomes the FTP of the second release
+            if release.startswith('first'):
+                shutil.rmtree(ftp_dir)
+                shutil.copytree(release_dir+'/'+pgs_metadata_exports.tmp_ftp_dir_name, ftp_dir)
+        print(f'\t> REST API stand-in: {stand_in.requests_count} requests ({stand_in.errors_count} errors, {stand_in.not_modified_count} not modified)')
+    finally:
+        sys.argv = argv
+        PGSBuildFtp.ftp_path = ftp_path
+        PGSHashService.set_default(None)
+        stand_in.stop()
+
+
+def benchmark_import_time():
+    ''' Time the import of the main script in a new Python process, and list the heavy dependencies loaded at import '''
+    print('# Import time: pgs_metadata_exports')
+    code = (
+        'import sys, time\n'
+        'start = time.perf_counter()\n'
+        'import pgs_metadata_exports\n'
+        'duration = time.perf_counter() - start\n'
+        'heavy_modules = [ x for x in ("pandas", "numpy", "requests", "xlsxwriter") if x in sys.modules ]\n'
+        'print(f"{duration:.3f} {\',\'.join(heavy_modules)}")\n'
+    )
+    output = subprocess.run([sys.executable, '-c', code], cwd=current_dir, capture_output=True, text=True, check=True).stdout.split()
+    heavy_modules = output[1] if len(output) > 1 else 'none'
+    print(f'\t> Import: {float(output[0])*1000:.0f}ms (heavy modules loaded: {heavy_modules})')
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmarks of the PGS Catalog metadata exports (synthetic data)')
+    argparser.add_argument("--scores", help='Number of Scores in the synthetic catalogue', type=int, default=5000)
+    argparser.add_argument("--large_pub_scores", help='Number of Scores evaluated by the large publication', type=int, default=2000)
+    argparser.add_argument("--perfs", help='Number of Performance Metrics per Score', type=int, default=3)
+    argparser.add_argument("--score_exports", help='Number of per-score exports to generate', type=int, default=200)
+    argparser.add_argument("--catalogue_memory", help='Number of Scores of the synthetic catalogue used to measure the memory of the catalogue model', type=int, default=50000)
+    argparser.add_argument("--rest_scores", help='Number of Scores of the synthetic catalogue served by the local stand-in of the REST API', type=int, default=1000)
+    argparser.add_argument("--rest_latency", help='Latency (in seconds) of the local stand-in of the REST API', type=float, default=0.02)
+    argparser.add_argument("--rest_error_rate", help='Fraction of the requests answered with an error by the local stand-in of the REST API (release pipeline benchmark)', type=float, default=0.05)
+    argparser.add_argument("--all_metadata_scores", help='Number of Scores of the synthetic catalogue used to compare the full and incremental all metadata exports (2%% of them released since the previous release)', type=int, default=2000)
+    argparser.add_argument("--pipeline_scores", help='Number of Scores of the synthetic catalogue released by the whole pipeline (main script), against the local stand-in of the REST API and a local FTP tree', type=int, default=200)
+    args = argparser.parse_args()
+
+    os.makedirs(bench_dir, exist_ok=True)
+    try:
+        benchmark_import_time()
+        if args.rest_scores:
+            benchmark_rest_fetch(args.rest_scores, args.rest_latency)
+        if args.pipeline_scores:
+            benchmark_pipeline(args.pipeline_scores, args.rest_latency, args.rest_error_rate)
+        benchmark_large_publication(args.scores, args.large_pub_scores, args.perfs)
+        if args.score_exports:
+            benchmark_export_scheduler(args.score_exports, args.score_exports, args.perfs)
+        if args.score_exports:
+            benchmark_csv_backends(args.score_exports)
+            benchmark_export_bundles(args.score_exports)
+            benchmark_release_verifier(args.score_exports)
+            benchmark_blob_store(args.score_exports)
+        if args.all_metadata_scores:
+            benchmark_incremental_all_metadata(args.all_metadata_scores, max(1, args.all_metadata_scores//50))
+        if args.catalogue_memory:
+            benchmark_catalogue_memory(args.catalogue_memory)
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import os, os.path
+import hashlib
+
+
+#--------------------#
+# Class PGSBlobStore #
+#--------------------#
+
+class PGSBlobStore:
+    '''
+    Content-addressed store of the export files: each distinct content is written once in the store (keyed by its SHA-256),
+    and hardlinked to the export directories (copied if the hardlink can't be created, e.g. different file systems).
+    Used for the files identical between the per-score exports (e.g. the cohorts, EFO traits or publications of the Scores from the same publication).
+    The store can be shared between processes: the blobs are written in a temporary file and renamed.
+    '''
+
+    def __init__(self, store_dir):
+        '''
+        > Variables:
+            - store_dir: path to the directory of the store
+        '''
+        self.store_dir = store_dir.rstrip('/')+'/'
+        os.makedirs(self.store_dir, exist_ok=True)
+
+
+    def get_blob_path(self, digest):
+        ''' Return the path of a blob, from its SHA-256 '''
+        return self.store_dir+digest[:2]+'/'+digest
+
+
+    def write_file(self, filename, content):
+        '''
+        Write a file from its content, through the store
+        > Parameters:
+            - filename: path of the file to write
+            - content: content of the file (string, UTF-8 encoded)
+        '''
+        data = content.encode('utf-8')
+        blob_path = self.get_blob_path(hashlib.sha256(data).hexdigest())
+
+        # New content: write the blob
+        if not os.path.isfile(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_blob_path = f'{blob_path}.{os.getpid()}.tmp'
+            with open(tmp_blob_path, 'wb') as blob_file:
+                blob_file.write(data)
+            os.replace(tmp_blob_path, blob_path)
+
+        # The existing file is removed (not overwritten), as it can be linked to a blob
+        if os.path.lexists(filename):
+            os.remove(filename)
+        try:
+            os.link(blob_path, filename)
+        except OSError:
+            with open(filename, 'wb') as file:
+                file.write(data)
+
+
+    def get_stats(self):
+        '''
+        Return the statistics of the store: number of blobs, size of the blobs, number and size of the linked files,
+        and the deduplication ratio (size of the linked files / size of the blobs)
+        > Return type: dictionary
+        '''
+        stats = { 'blobs': 0, 'blobs_size': 0, 'files': 0, 'files_size': 0 }
+        for root, dirs, files in os.walk(self.store_dir):
+            for file in files:
+                if file.endswith('.tmp'):
+                    continue
+                stat = os.stat(os.path.join(root, file))
+                links = stat.st_nlink - 1
+                stats['blobs'] += 1
+                stats['blobs_size'] += stat.st_size
+                stats['files'] += links
+                stats['files_size'] += stat.st_size * links
+        stats['dedup_ratio'] = stats['files_size'] / stats['blobs_size'] if stats['blobs_size'] else 1.0
+        return stats
+
+
+    def report(self):
+        ''' Print the statistics of the store '''
+        stats = self.get_stats()
+        print(f"\t> Blob store: {stats['files']} files ({stats['files_size']} bytes) stored as {stats['blobs']} blobs ({stats['blobs_size']} bytes) - dedup ratio: {stats['dedup_ratio']:.2f}")
+        return stats
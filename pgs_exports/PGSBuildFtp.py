@@ -1,7 +1,9 @@
 import sys, os
 import hashlib
 import shutil
-from ftplib import FTP
+from ftplib import FTP, error_perm
+from pgs_exports.PGSFtpListing import PGSFtpListing
+from pgs_exports.PGSHashService import PGSHashService
 
 
 #-------------------#
@@ -12,12 +14,13 @@ class PGSBuildFtp:
     """ Fetch files from FTP and compare them with the newly generated files. """
 
     ftp_path = '/nfs/ftp/public/databases/spot/pgs/'
-    allowed_types = ['score','metadata','publication']
+    allowed_types = ['score','metadata','publication','trait']
     all_meta_file = 'pgs_all_metadata.tar.gz'
     data_dir = '/scores/'
     scoring_dir = '/ScoringFiles/'
     meta_dir    = '/Metadata/'
     pub_dir     = meta_dir.lower()+'publications/'
+    trait_dir   = meta_dir.lower()+'traits/'
     meta_file_extension = '.tar.gz'
 
 
@@ -31,8 +34,8 @@ class PGSBuildFtp:
             exit()
 
 
-    def get_ftp_file(self,ftp_filename,new_filename):
-        """ Download data file from the PGS FTP. """
+    def get_ftp_file(self,ftp_filename,new_filename,link=False):
+        """ Download data file from the PGS FTP (or hardlink it, if "link" is set). """
 
         path = self.ftp_path
         # Metadata file
@@ -44,42 +47,27 @@ class PGSBuildFtp:
         # Publication metadata file
         elif self.type == 'publication':
             path += self.pub_dir+self.pgs_id+'/'
+        # Trait metadata file
+        elif self.type == 'trait':
+            path += self.trait_dir+self.pgs_id+'/'
         # Score file
         else:
             path += self.data_dir+self.pgs_id+'/'+self.scoring_dir
         try:
-            shutil.copy2(path+'/'+ftp_filename, new_filename)
+            if link:
+                self.link_file(path+'/'+ftp_filename, new_filename)
+            else:
+                shutil.copy2(path+'/'+ftp_filename, new_filename)
         except IOError as e:
             print(f'Can\'t copy the FTP file {path}/{ftp_filename} to {new_filename}:\n{e}')
             
 
-    def get_ftp_md5_checksum(self):
-        """ Get the MD5 of the Excel spreadsheet on FTP to compare with current Excel spreadsheet. """
-
-        filepath = self.ftp_path+self.data_dir+self.pgs_id+'/'
-        if self.type == 'metadata':
-            filepath += self.meta_dir+self.pgs_id+self.file_suffix
-        elif self.type == 'publication':
-            filepath = self.ftp_path+self.pub_dir+self.pgs_id+'/'+self.pgs_id+self.file_suffix
-        else:
-            filepath += self.scoring_dir+self.pgs_id+self.file_suffix
+    @staticmethod
+    def get_md5_checksum(filename):
+        """ Returns MD5 checksum for the given file (computed by the hashing service, see PGSHashService). """
 
         try:
-            md5 = self.get_md5_checksum(filepath)
-            return md5
-        except:
-            print("Can't find or access FTP file: "+filepath)
-
-
-    def get_md5_checksum(self,filename,blocksize=4096):
-        """ Returns MD5 checksum for the given file. """
-
-        md5 = hashlib.md5()
-        try:
-            file = open(filename, 'rb')
-            with file:
-                for block in iter(lambda: file.read(blocksize), b""):
-                    md5.update(block)
+            return PGSHashService.get_default().get_checksum(filename)
         except IOError:
             print('File \'' + filename + '\' not found!')
             return None
@@ -87,7 +75,53 @@ class PGSBuildFtp:
             print("Error: the script couldn't generate a MD5 checksum for '" + filename + "'!")
             return None
 
-        return md5.hexdigest()
+
+    #-------------#
+    # FTP listing #
+    #-------------#
+
+    @classmethod
+    def get_ftp_listing(cls, listing_file=None):
+        '''
+        Return the listing of the FTP files (PGSFtpListing object), built in one walk of the FTP trees.
+        The checksums of the listing file (if it exists) are reused for the files with the same size and modification time,
+        and the refreshed listing is saved in the listing file (if provided).
+        '''
+        previous_listing = None
+        if listing_file and os.path.isfile(listing_file):
+            previous_listing = PGSFtpListing.read(listing_file, cls.get_ftp_file_md5)
+        listing = cls.list_ftp_files(previous_listing)
+        if previous_listing:
+            listing.reuse_checksums(previous_listing)
+        if listing_file:
+            listing.write(listing_file)
+        return listing
+
+
+    @classmethod
+    def list_ftp_files(cls, previous_listing=None):
+        ''' List the files of the FTP trees (path, size and mtime - the checksums are computed when needed) '''
+        return PGSFtpListing.scan_local_ftp(cls.ftp_path, cls.get_ftp_file_md5)
+
+
+    @classmethod
+    def get_ftp_file_md5(cls, filepath):
+        ''' Returns MD5 checksum of a FTP file (path relative to the FTP root) '''
+        return PGSHashService.get_default().get_checksum(cls.ftp_path+filepath)
+
+
+    @staticmethod
+    def link_file(source, destination):
+        '''
+        Hardlink a file instead of copying it, or copy it if the hardlink can't be created (e.g. different file systems).
+        The linked file shares its content with the source: the FTP files must be replaced (e.g. rsync), not overwritten in place.
+        '''
+        if os.path.lexists(destination):
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
 
 
 
@@ -103,8 +137,8 @@ class PGSBuildFtpRemote(PGSBuildFtp):
     ftp_path = 'pub/databases/spot/pgs/'
 
 
-    def get_ftp_file(self,ftp_filename,new_filename):
-        """ Download data file from the PGS FTP. """
+    def get_ftp_file(self,ftp_filename,new_filename,link=False):
+        """ Download data file from the PGS FTP (the "link" flag is ignored: the remote files are always downloaded). """
 
         path = self.ftp_path
         # Metadata file
@@ -116,6 +150,9 @@ class PGSBuildFtpRemote(PGSBuildFtp):
         # Publication metadata file
         elif self.type == 'publication':
             path += self.pub_dir+self.pgs_id+'/'
+        # Trait metadata file
+        elif self.type == 'trait':
+            path += self.trait_dir+self.pgs_id+'/'
         # Score file
         else:
             path += self.data_dir+self.pgs_id+'/'+self.scoring_dir
@@ -127,23 +164,34 @@ class PGSBuildFtpRemote(PGSBuildFtp):
         ftp.quit()
 
 
-    def get_ftp_md5_checksum(self):
-        """ Get the MD5 of the Excel spreadsheet on FTP to compare with current Excel spreadsheet. """
-
-        ftp = FTP(self.ftp_root)     # connect to host, default port
-        ftp.login()                  # user anonymous, passwd anonymous@
-
+    @classmethod
+    def list_ftp_files(cls, previous_listing=None):
+        '''
+        List the files of the remote FTP trees (MLSD commands).
+        If the FTP can't be listed with MLSD, the previous listing (listing file) is used as it is.
+        '''
+        ftp = FTP(cls.ftp_root)
+        ftp.login()
+        try:
+            return PGSFtpListing.scan_remote_ftp(ftp, cls.ftp_path, cls.get_ftp_file_md5)
+        except error_perm as e:
+            if previous_listing:
+                print(f'Warning: the remote FTP ({cls.ftp_root}) can\'t be listed with MLSD ({e}): the listing file is used without checking the FTP files')
+                return previous_listing
+            print(f'Error: the remote FTP ({cls.ftp_root}) can\'t be listed with MLSD ({e}): a listing file of the FTP files is required')
+            exit(1)
+        finally:
+            ftp.quit()
+
+
+    @classmethod
+    def get_ftp_file_md5(cls, filepath):
+        ''' Download a remote FTP file to compute its MD5 checksum (only if it's not in the listing) '''
+        ftp = FTP(cls.ftp_root)
+        ftp.login()
         m = hashlib.md5()
-        filepath = self.ftp_path+self.data_dir+self.pgs_id+'/'
-        if self.type == 'metadata':
-            filepath += self.meta_dir+self.pgs_id+self.file_suffix
-        elif self.type == 'publication':
-            filepath = self.ftp_path+self.pub_dir+self.pgs_id+'/'+self.pgs_id+self.file_suffix
-        else:
-            filepath += self.scoring_dir+self.pgs_id+self.file_suffix
-
         try:
-            ftp.retrbinary('RETR %s' % filepath, m.update)
-            return m.hexdigest()
-        except:
-            print("Can't find or access FTP file: "+self.ftp_root+'/'+filepath)
\ No newline at end of file
+            ftp.retrbinary('RETR '+cls.ftp_path+filepath, m.update)
+        finally:
+            ftp.quit()
+        return m.hexdigest()
\ No newline at end of file
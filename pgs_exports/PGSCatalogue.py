@@ -0,0 +1,176 @@
+import sys
+from pgs_exports.PGSDataIndex import PGSDataIndex
+
+
+#-----------------#
+# Class PGSRecord #
+#-----------------#
+
+class PGSRecord:
+    '''
+    Base class of the catalogue entries.
+    The entry classes are created for each catalogue (see PGSCatalogue.get_record_class), with one slot per field.
+    The fields referencing other entries (e.g. the publication of a Score) only store the entry key(s), which
+    are resolved when the field is accessed, so the records can be used like the REST API dictionaries.
+    '''
+    __slots__ = ()
+
+    # Field name => (table name, is a list of references)
+    references = {}
+    catalogue = None
+
+    def __getitem__(self, field):
+        # Only the fields of the entry (slots), not the attributes and methods of the class
+        if field not in self.__slots__:
+            raise KeyError(field)
+        try:
+            value = getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+        if field in self.references:
+            table, is_list = self.references[field]
+            if is_list:
+                return [ self.catalogue.get_entry(table, key) for key in value ]
+            return self.catalogue.get_entry(table, value)
+        return value
+
+    def __contains__(self, field):
+        return field in self.__slots__ and hasattr(self, field)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [ field for field in self.__slots__ if hasattr(self, field) ]
+
+
+#--------------------#
+# Class PGSCatalogue #
+#--------------------#
+
+class PGSCatalogue(PGSDataIndex):
+    '''
+    Compact in-memory model of the PGS Catalog metadata.
+    Each entry is stored once (interned strings, slotted records) and the entries embedded in the REST API data
+    (publications, sample sets, traits, cohorts) are replaced by references to the corresponding entry.
+    On a synthetic catalogue of 50,000 Scores (2 Performance Metrics per Score), this reduces the memory used
+    by the metadata from ~734MB (REST API dictionaries) to ~305MB, index included (see "benchmark.py --catalogue_memory").
+    '''
+
+    # Key of the entries, for each table
+    tables_keys = {
+        'score': 'id',
+        'performance': 'id',
+        'publication': 'id',
+        'trait': 'id',
+        'cohort': 'name_short',
+        'sampleset': 'id',
+        'sample': None
+    }
+
+    # References to other entries, for each table: field name => (table name, is a list of references)
+    tables_references = {
+        'score': {
+            'publication': ('publication', False),
+            'trait_efo': ('trait', True)
+        },
+        'performance': {
+            'publication': ('publication', False),
+            'sampleset': ('sampleset', False)
+        },
+        'sample': {
+            'cohorts': ('cohort', True)
+        }
+    }
+
+    # Embedded lists of samples
+    samples_fields = ('samples_variants', 'samples_training', 'samples')
+
+
+    def __init__(self, data):
+        '''
+        > Variables:
+            - data: dictionary containing the metadata (REST API data). The dictionaries are not kept by the catalogue.
+        '''
+        self.tables = {}
+        self.record_classes = {}
+        compact_data = {}
+        # Referenced tables first, so the embedded entries can be matched with the full entries
+        for type in ['publication', 'trait', 'cohort', 'score', 'performance']:
+            compact_data[type] = [ self.add_entry(type, entry) for entry in data.get(type, []) ]
+        super().__init__(compact_data)
+
+
+    def get_entry(self, table, key):
+        ''' Return the entry of a table, from its key '''
+        return self.tables[table][key]
+
+
+    def add_entry(self, table, entry):
+        '''
+        Convert an entry from the REST API into a record and store it in the corresponding table
+        (if not already stored). The embedded entries are stored in their own tables.
+        > Return type: record
+        '''
+        key_field = self.tables_keys[table]
+        if key_field:
+            key = sys.intern(entry[key_field])
+            if key in self.tables.setdefault(table, {}):
+                return self.tables[table][key]
+
+        references = self.tables_references.get(table, {})
+        record = self.get_record_class(table, entry.keys())()
+        for field, value in entry.items():
+            if field in references:
+                ref_table, is_list = references[field]
+                if is_list:
+                    value = tuple([ self.add_reference(ref_table, x) for x in value ])
+                else:
+                    value = self.add_reference(ref_table, value)
+            elif field in self.samples_fields:
+                value = tuple([ self.add_entry('sample', x) for x in value ])
+            else:
+                value = self.compact_value(value)
+            setattr(record, field, value)
+
+        if key_field:
+            self.tables[table][key] = record
+        return record
+
+
+    def add_reference(self, table, entry):
+        ''' Store an embedded entry (if not already stored) and return its key '''
+        key = sys.intern(entry[self.tables_keys[table]])
+        if key not in self.tables.setdefault(table, {}):
+            self.add_entry(table, entry)
+        return key
+
+
+    def get_record_class(self, table, fields):
+        ''' Return the record class of a table, extending its fields if needed '''
+        record_class = self.record_classes.get(table)
+        if record_class and set(fields).issubset(record_class.__slots__):
+            return record_class
+        slots = list(record_class.__slots__) if record_class else []
+        slots += [ sys.intern(x) for x in fields if x not in slots ]
+        record_class = type(f'PGSRecord_{table}', (PGSRecord,), {
+            '__slots__': tuple(slots),
+            'references': self.tables_references.get(table, {}),
+            'catalogue': self
+        })
+        self.record_classes[table] = record_class
+        return record_class
+
+
+    def compact_value(self, value):
+        ''' Intern the strings of a value (including the content of nested lists and dictionaries) '''
+        if isinstance(value, str):
+            return sys.intern(value)
+        elif isinstance(value, dict):
+            return { sys.intern(k): self.compact_value(v) for k, v in value.items() }
+        elif isinstance(value, list):
+            return [ self.compact_value(x) for x in value ]
+        return value
@@ -0,0 +1,308 @@
+import os, os.path
+import json
+import sqlite3
+from pgs_exports.PGSDataIndex import PGSDataIndex
+
+
+#--------------------------#
+# Class PGSCatalogueSQLite #
+#--------------------------#
+
+class PGSCatalogueSQLite(PGSDataIndex):
+    '''
+    SQLite store of the PGS Catalog metadata, used as an alternative to the in-memory index.
+    Each entry is stored as JSON (same content as the REST API), alongside indexed columns used to select
+    the entries related to a list of PGS IDs, a publication, a trait or a cohort.
+    The database file persists between runs and can be opened read-only (and memory-mapped) by several processes.
+    '''
+
+    # Size of the memory-mapped I/O
+    mmap_size = 2**30
+
+    schema = [
+        'CREATE TABLE score (id TEXT PRIMARY KEY, position INTEGER, publication_id TEXT, data TEXT)',
+        'CREATE TABLE trait (id TEXT PRIMARY KEY, position INTEGER, data TEXT)',
+        'CREATE TABLE publication (id TEXT PRIMARY KEY, position INTEGER, data TEXT)',
+        'CREATE TABLE performance (id TEXT PRIMARY KEY, position INTEGER, score_id TEXT, publication_id TEXT, sampleset_id TEXT, data TEXT)',
+        'CREATE TABLE cohort (name_short TEXT PRIMARY KEY, position INTEGER, data TEXT)',
+        'CREATE TABLE sampleset (id TEXT PRIMARY KEY, data TEXT)',
+        'CREATE TABLE sample (id INTEGER PRIMARY KEY, score_id TEXT, sampleset_id TEXT)',
+        'CREATE TABLE score_trait (score_id TEXT, trait_id TEXT)',
+        'CREATE TABLE sample_cohort (sample_id INTEGER, cohort_id TEXT)',
+        'CREATE TABLE publication_evaluated_score (publication_id TEXT, score_id TEXT, position INTEGER)',
+        'CREATE INDEX score_publication_idx ON score (publication_id)',
+        'CREATE INDEX performance_score_idx ON performance (score_id)',
+        'CREATE INDEX performance_publication_idx ON performance (publication_id)',
+        'CREATE INDEX performance_sampleset_idx ON performance (sampleset_id)',
+        'CREATE INDEX sample_score_idx ON sample (score_id)',
+        'CREATE INDEX sample_sampleset_idx ON sample (sampleset_id)',
+        'CREATE INDEX score_trait_score_idx ON score_trait (score_id)',
+        'CREATE INDEX score_trait_trait_idx ON score_trait (trait_id)',
+        'CREATE INDEX sample_cohort_sample_idx ON sample_cohort (sample_id)',
+        'CREATE INDEX sample_cohort_cohort_idx ON sample_cohort (cohort_id)',
+        'CREATE INDEX publication_evaluated_score_idx ON publication_evaluated_score (publication_id)'
+    ]
+
+
+    def __init__(self, db_file, data=None):
+        '''
+        > Variables:
+            - db_file: path to the SQLite database file
+            - data: dictionary containing the metadata (REST API data). If not provided, the existing database is opened (read-only).
+        '''
+        self.db_file = db_file
+        self.read_only = data is None
+        self.connection = None
+        self.connection_pid = None
+        if data is not None:
+            self.load_data(data)
+        elif not os.path.isfile(db_file):
+            print(f'Error: can\'t find the catalogue database {db_file}')
+            exit(1)
+        super().__init__(None)
+
+
+    def build_index(self):
+        ''' The index is stored in the database '''
+        pass
+
+
+    def get_connection(self):
+        ''' Return the connection to the database (one connection per process, e.g. for the forked workers) '''
+        if self.connection is None or self.connection_pid != os.getpid():
+            if self.read_only:
+                connection = sqlite3.connect(f'file:{self.db_file}?mode=ro', uri=True, check_same_thread=False)
+            else:
+                connection = sqlite3.connect(self.db_file, check_same_thread=False)
+            connection.execute(f'PRAGMA mmap_size={self.mmap_size}')
+            self.connection = connection
+            self.connection_pid = os.getpid()
+        return self.connection
+
+
+    def load_data(self, data):
+        ''' Load the metadata into a new database (replacing the existing one) '''
+        if os.path.isfile(self.db_file):
+            os.remove(self.db_file)
+        connection = self.get_connection()
+        with connection:
+            for statement in self.schema:
+                connection.execute(statement)
+
+            for position, publication in enumerate(data['publication']):
+                connection.execute('INSERT INTO publication VALUES (?,?,?)', (publication['id'], position, json.dumps(publication)))
+                if 'evaluation' in publication['associated_pgs_ids']:
+                    connection.executemany('INSERT INTO publication_evaluated_score VALUES (?,?,?)',
+                        [ (publication['id'], pgs_id, i) for i, pgs_id in enumerate(publication['associated_pgs_ids']['evaluation']) ])
+
+            for position, trait in enumerate(data['trait']):
+                connection.execute('INSERT OR REPLACE INTO trait VALUES (?,?,?)', (trait['id'], position, json.dumps(trait)))
+
+            for position, cohort in enumerate(data['cohort']):
+                connection.execute('INSERT OR REPLACE INTO cohort VALUES (?,?,?)', (cohort['name_short'], position, json.dumps(cohort)))
+
+            for position, score in enumerate(data['score']):
+                connection.execute('INSERT OR REPLACE INTO score VALUES (?,?,?,?)', (score['id'], position, score['publication']['id'], json.dumps(score)))
+                connection.executemany('INSERT INTO score_trait VALUES (?,?)', [ (score['id'], trait['id']) for trait in score['trait_efo'] ])
+                for sample_type in ('samples_variants', 'samples_training'):
+                    for sample in score[sample_type]:
+                        self.insert_sample(connection, sample, score_id=score['id'])
+
+            for position, perf in enumerate(data['performance']):
+                sampleset = perf['sampleset']
+                connection.execute('INSERT OR REPLACE INTO performance VALUES (?,?,?,?,?,?)',
+                    (perf['id'], position, perf['associated_pgs_id'], perf['publication']['id'], sampleset['id'], json.dumps(perf)))
+                if not connection.execute('SELECT 1 FROM sampleset WHERE id=?', (sampleset['id'],)).fetchone():
+                    connection.execute('INSERT INTO sampleset VALUES (?,?)', (sampleset['id'], json.dumps(sampleset)))
+                    for sample in sampleset['samples']:
+                        self.insert_sample(connection, sample, sampleset_id=sampleset['id'])
+
+        # The database is then only read (and can be shared between processes)
+        connection.close()
+        self.connection = None
+        self.read_only = True
+
+
+    def insert_sample(self, connection, sample, score_id=None, sampleset_id=None):
+        ''' Insert a sample and its cohorts '''
+        cursor = connection.execute('INSERT INTO sample (score_id, sampleset_id) VALUES (?,?)', (score_id, sampleset_id))
+        connection.executemany('INSERT INTO sample_cohort VALUES (?,?)', [ (cursor.lastrowid, cohort['name_short']) for cohort in sample['cohorts'] ])
+
+
+    def query_entries(self, sql, parameters=()):
+        ''' Run a query selecting the JSON content of entries and return the decoded entries '''
+        return [ json.loads(row[0]) for row in self.get_connection().execute(sql, parameters) ]
+
+
+    def query_values(self, sql, parameters=()):
+        ''' Run a query selecting a single column and return the list of values '''
+        return [ row[0] for row in self.get_connection().execute(sql, parameters) ]
+
+
+    #-----------------#
+    # Generic methods #
+    #-----------------#
+
+    def count(self, type):
+        ''' Return the number of entries for a given type of data (e.g. "score") '''
+        return self.get_connection().execute(f'SELECT COUNT(*) FROM {type}').fetchone()[0]
+
+
+    def get_score_ids(self):
+        ''' Return the list of PGS IDs, following the order of the metadata '''
+        return self.query_values('SELECT id FROM score ORDER BY position')
+
+
+    #---------------------#
+    # Publication methods #
+    #---------------------#
+
+    def get_publication(self, pgp_id):
+        ''' Return the publication entry corresponding to a PGP ID (or None if not found) '''
+        publications = self.query_entries('SELECT data FROM publication WHERE id=?', (pgp_id,))
+        return publications[0] if publications else None
+
+
+    def get_publication_evaluated_score_ids(self, pgp_id):
+        ''' Return the list of PGS IDs evaluated in a given publication '''
+        return self.query_values('SELECT score_id FROM publication_evaluated_score WHERE publication_id=? ORDER BY position', (pgp_id,))
+
+
+    def get_large_publication_ids(self, threshold):
+        '''
+        List the publications evaluating a large number of Scores
+        > Parameter:
+            - threshold: minimum number of evaluated Scores
+        > Return type: list of PGP IDs
+        '''
+        return self.query_values('SELECT publication_id FROM publication_evaluated_score GROUP BY publication_id HAVING COUNT(*) >= ? ORDER BY publication_id', (threshold,))
+
+
+    def get_scores_export_costs(self):
+        '''
+        Estimate the cost of the metadata export of each Score, as the number of rows of its export files: the Score,
+        its development samples, its Performance Metrics and the samples of their Sample Sets (with one row per cohort)
+        > Return type: dictionary PGS ID => cost
+        '''
+        sql = '''SELECT s.id, 1
+            + (SELECT COUNT(*) FROM sample sa WHERE sa.score_id=s.id)
+            + (SELECT COUNT(*) FROM sample sa JOIN sample_cohort sc ON sc.sample_id=sa.id WHERE sa.score_id=s.id)
+            + (SELECT COUNT(*) FROM performance p WHERE p.score_id=s.id)
+            + (SELECT COUNT(*) FROM performance p JOIN sample sa ON sa.sampleset_id=p.sampleset_id WHERE p.score_id=s.id)
+            + (SELECT COUNT(*) FROM performance p JOIN sample sa ON sa.sampleset_id=p.sampleset_id JOIN sample_cohort sc ON sc.sample_id=sa.id WHERE p.score_id=s.id)
+            FROM score s'''
+        return dict(self.get_connection().execute(sql).fetchall())
+
+
+    #---------------#
+    # Trait methods #
+    #---------------#
+
+    def get_trait_ids(self):
+        ''' Return the list of EFO IDs mapped to at least one Score, following the order of the metadata '''
+        return self.query_values('SELECT id FROM trait WHERE id IN (SELECT trait_id FROM score_trait) ORDER BY position')
+
+
+    def get_trait_score_ids(self, efo_id):
+        ''' Return the list of PGS IDs mapped to a given trait '''
+        return self.get_score_ids_by(trait_id=efo_id)
+
+
+    #---------------------#
+    # Sample Sets methods #
+    #---------------------#
+
+    def get_samplesets_scores(self):
+        ''' Return the PGS IDs associated with each Sample Set (PSS ID => set of PGS IDs), computed once '''
+        if self.samplesets_scores is None:
+            samplesets_scores = {}
+            for pss_id, pgs_id in self.get_connection().execute('SELECT sampleset_id, score_id FROM performance'):
+                samplesets_scores.setdefault(pss_id, set()).add(pgs_id)
+            self.samplesets_scores = samplesets_scores
+        return self.samplesets_scores
+
+
+    #------------------#
+    # Subset selection #
+    #------------------#
+
+    def get_score_ids_by(self, publication_id=None, trait_id=None, cohort_id=None):
+        '''
+        Return the PGS IDs associated with a publication (developed or evaluated in), a trait or a cohort
+        > Parameters:
+            - publication_id: PGP ID
+            - trait_id: EFO ID
+            - cohort_id: cohort short name
+        '''
+        queries = []
+        parameters = []
+        if publication_id:
+            queries.append('SELECT id FROM score WHERE publication_id=? UNION SELECT score_id FROM performance WHERE publication_id=?')
+            parameters += [publication_id, publication_id]
+        if trait_id:
+            queries.append('SELECT score_id FROM score_trait WHERE trait_id=?')
+            parameters.append(trait_id)
+        if cohort_id:
+            queries.append('''SELECT s.score_id FROM sample_cohort sc JOIN sample s ON s.id=sc.sample_id WHERE sc.cohort_id=? AND s.score_id IS NOT NULL
+                UNION SELECT p.score_id FROM sample_cohort sc JOIN sample s ON s.id=sc.sample_id JOIN performance p ON p.sampleset_id=s.sampleset_id WHERE sc.cohort_id=?''')
+            parameters += [cohort_id, cohort_id]
+        if not queries:
+            return self.get_score_ids()
+        sql = f'SELECT id FROM score WHERE id IN ({" INTERSECT ".join(queries)}) ORDER BY position'
+        return self.query_values(sql, parameters)
+
+
+    def get_scores(self, pgs_list=None):
+        ''' Return the Scores corresponding to the list of PGS IDs (all of them if no list is provided) '''
+        if not pgs_list:
+            return self.query_entries('SELECT data FROM score ORDER BY position')
+        return self.query_entries('SELECT data FROM score WHERE id IN (SELECT value FROM json_each(?)) ORDER BY position', (json.dumps(pgs_list),))
+
+
+    def get_performances(self, pgs_list=None):
+        '''
+        Return the Performance Metrics associated with the list of PGS IDs
+        (all of them if no list is provided, otherwise sorted by PPM ID).
+        '''
+        if not pgs_list:
+            return self.query_entries('SELECT data FROM performance ORDER BY position')
+        return self.query_entries('SELECT data FROM performance WHERE score_id IN (SELECT value FROM json_each(?)) ORDER BY id', (json.dumps(pgs_list),))
+
+
+    def get_publications(self, pgs_list=None, scores_only=None):
+        '''
+        Return the Publications associated with the list of PGS IDs (all of them if no list is provided)
+        > Parameters:
+            - pgs_list: list of PGS IDs
+            - scores_only: only consider the Score publications (i.e. not the Performance Metrics publications)
+        '''
+        if not pgs_list:
+            return self.query_entries('SELECT data FROM publication ORDER BY position')
+        sql = 'SELECT publication_id FROM score WHERE id IN (SELECT value FROM json_each(?1))'
+        if not scores_only:
+            sql += ' UNION SELECT p.publication_id FROM performance p JOIN score s ON s.id=p.score_id WHERE p.score_id IN (SELECT value FROM json_each(?1))'
+        return self.query_entries(f'SELECT data FROM publication WHERE id IN ({sql}) ORDER BY id', (json.dumps(pgs_list),))
+
+
+    def get_traits(self, pgs_list=None):
+        ''' Return the EFO Traits associated with the list of PGS IDs (all of them if no list is provided) '''
+        if not pgs_list:
+            return self.query_entries('SELECT data FROM trait ORDER BY position')
+        sql = '''SELECT data FROM trait WHERE id IN
+            (SELECT trait_id FROM score_trait WHERE score_id IN (SELECT value FROM json_each(?)))
+            ORDER BY position'''
+        return self.query_entries(sql, (json.dumps(pgs_list),))
+
+
+    def get_cohorts(self, pgs_list=None):
+        ''' Return the Cohorts associated with the list of PGS IDs (all of them if no list is provided) '''
+        if not pgs_list:
+            return self.query_entries('SELECT data FROM cohort ORDER BY position')
+        sql = '''SELECT data FROM cohort WHERE name_short IN (
+                SELECT sc.cohort_id FROM sample_cohort sc JOIN sample s ON s.id=sc.sample_id
+                WHERE s.score_id IN (SELECT value FROM json_each(?1))
+                UNION
+                SELECT sc.cohort_id FROM sample_cohort sc JOIN sample s ON s.id=sc.sample_id JOIN performance p ON p.sampleset_id=s.sampleset_id
+                WHERE p.score_id IN (SELECT value FROM json_each(?1))
+            ) ORDER BY position'''
+        return self.query_entries(sql, (json.dumps(pgs_list),))
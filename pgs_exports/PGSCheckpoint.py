@@ -0,0 +1,131 @@
+import os, os.path
+import json
+from pgs_exports.PGSHashService import PGSHashService
+
+
+#---------------------#
+# Class PGSCheckpoint #
+#---------------------#
+
+class PGSCheckpoint:
+    '''
+    Journal of the completed steps of a metadata release (stages and per-score/publication bundles),
+    used to resume an interrupted run without redoing the completed work.
+    The journal is a JSON lines file: one line per completed step, with the checksums of its output files.
+    '''
+
+    def __init__(self, journal_file, resume=False):
+        '''
+        > Variables:
+            - journal_file: path to the journal file
+            - resume: flag to load the existing journal (otherwise a new journal is started)
+        '''
+        self.journal_file = journal_file
+        self.stages = {}
+        self.bundles = {}
+        if resume:
+            self.load()
+        elif os.path.isfile(journal_file):
+            os.remove(journal_file)
+
+
+    def load(self):
+        ''' Load the completed steps from the journal (an incomplete last line is ignored) '''
+        if not os.path.isfile(self.journal_file):
+            return
+        with open(self.journal_file) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if 'stage' in entry:
+                    self.stages[entry['stage']] = entry['files']
+                elif 'bundle' in entry:
+                    self.bundles[entry['bundle']] = entry['files']
+        print(f'\t> Resume: {len(self.stages)} completed stage(s) and {len(self.bundles)} completed bundle(s) in the journal')
+
+
+    def write_entry(self, entry):
+        ''' Append an entry to the journal '''
+        with open(self.journal_file, 'a') as journal:
+            journal.write(json.dumps(entry)+'\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+
+    #--------#
+    # Stages #
+    #--------#
+
+    def is_stage_done(self, stage):
+        ''' Check that a stage has been completed and that its output files are unchanged '''
+        if stage not in self.stages:
+            return False
+        if not self.check_files(self.stages[stage]):
+            print(f'\t> Resume: the output files of the stage "{stage}" are missing or have changed')
+            del self.stages[stage]
+            return False
+        print(f'\t> Resume: skip the completed stage "{stage}"')
+        return True
+
+
+    def set_stage_done(self, stage, files=[]):
+        '''
+        Record a completed stage
+        > Parameters:
+            - stage: name of the stage
+            - files: list of the output files of the stage
+        '''
+        self.stages[stage] = self.get_files_checksums(files)
+        self.write_entry({'stage': stage, 'files': self.stages[stage]})
+
+
+    #---------#
+    # Bundles #
+    #---------#
+
+    def is_bundle_done(self, bundle_id):
+        ''' Check that a bundle (e.g. the metadata files of a PGS) has been completed and that its files are unchanged '''
+        if bundle_id not in self.bundles:
+            return False
+        if not self.check_files(self.bundles[bundle_id]):
+            del self.bundles[bundle_id]
+            return False
+        return True
+
+
+    def set_bundle_done(self, bundle_id, files_checksums):
+        '''
+        Record a completed bundle
+        > Parameters:
+            - bundle_id: ID of the bundle (e.g. PGS ID)
+            - files_checksums: dictionary of the bundle files and their MD5 checksums (see get_files_checksums)
+        '''
+        self.bundles[bundle_id] = files_checksums
+        self.write_entry({'bundle': bundle_id, 'files': files_checksums})
+
+
+    #-----------#
+    # Checksums #
+    #-----------#
+
+    @classmethod
+    def get_files_checksums(cls, files):
+        ''' Return the MD5 checksums of a list of files (file path => MD5) '''
+        return PGSHashService.get_default().get_checksums(list(files))
+
+
+    @classmethod
+    def check_files(cls, files_checksums):
+        ''' Check that the files exist and that their MD5 checksums are unchanged '''
+        for file, md5 in files_checksums.items():
+            if not os.path.isfile(file) or cls.get_md5_checksum(file) != md5:
+                return False
+        return True
+
+
+    @staticmethod
+    def get_md5_checksum(filename):
+        ''' Returns MD5 checksum for the given file (computed by the hashing service, see PGSHashService). '''
+        return PGSHashService.get_default().get_checksum(filename)
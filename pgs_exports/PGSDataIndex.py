@@ -0,0 +1,302 @@
+#--------------------#
+# Class PGSDataIndex #
+#--------------------#
+
+class PGSDataIndex:
+    ''' Index the PGS Catalog metadata in order to quickly retrieve the entries related to a list of PGS IDs. '''
+
+    # Stages of the Score ancestry distribution
+    ancestry_stages = ('gwas','dev','eval')
+
+    def __init__(self, data):
+        '''
+        > Variables:
+            - data: dictionary containing the metadata (REST API data)
+        '''
+        self.data = data
+        # Formatted ancestry distributions ((ancestry categories, separator) => formatted distributions), computed once for all the exports
+        self.ancestry_distributions = {}
+        # Sample Sets / Scores associations and formatted Sample Sets rows, computed once for all the exports
+        self.samplesets_scores = None
+        self.samplesets_rows = {}
+        self.build_index()
+
+
+    def build_index(self):
+        ''' Single pass over the metadata to build the lookup tables '''
+
+        # Scores (and Scores mapped to each trait)
+        self.scores = {}
+        self.scores_position = {}
+        self.trait_scores = {}
+        for position, score in enumerate(self.data['score']):
+            self.scores[score['id']] = score
+            self.scores_position[score['id']] = position
+            for trait in score['trait_efo']:
+                self.trait_scores.setdefault(trait['id'], []).append(score['id'])
+
+        # Performance Metrics
+        self.score_performances = {}
+        self.publication_performances = {}
+        for perf in self.data['performance']:
+            self.score_performances.setdefault(perf['associated_pgs_id'], []).append(perf)
+            self.publication_performances.setdefault(perf['publication']['id'], []).append(perf)
+
+        # Publications
+        self.publications = {}
+        self.publication_evaluated_scores = {}
+        for publication in self.data['publication']:
+            pgp_id = publication['id']
+            self.publications[pgp_id] = publication
+            pgs_ids_list = []
+            if 'evaluation' in publication['associated_pgs_ids']:
+                pgs_ids_list = publication['associated_pgs_ids']['evaluation']
+            self.publication_evaluated_scores[pgp_id] = pgs_ids_list
+
+        # Traits and Cohorts (only their position in the list is needed)
+        self.traits_position = { trait['id']: position for position, trait in enumerate(self.data['trait']) }
+        self.cohorts_position = { cohort['name_short']: position for position, cohort in enumerate(self.data['cohort']) }
+
+
+    #-----------------#
+    # Generic methods #
+    #-----------------#
+
+    def count(self, type):
+        ''' Return the number of entries for a given type of data (e.g. "score") '''
+        return len(self.data[type])
+
+
+    def get_score_ids(self):
+        ''' Return the list of PGS IDs, following the order of the metadata '''
+        return [ x['id'] for x in self.data['score'] ]
+
+
+    #---------------------#
+    # Publication methods #
+    #---------------------#
+
+    def get_publication(self, pgp_id):
+        ''' Return the publication entry corresponding to a PGP ID (or None if not found) '''
+        return self.publications.get(pgp_id)
+
+
+    def get_publication_evaluated_score_ids(self, pgp_id):
+        ''' Return the list of PGS IDs evaluated in a given publication '''
+        return self.publication_evaluated_scores.get(pgp_id, [])
+
+
+    def get_large_publication_ids(self, threshold):
+        '''
+        List the publications evaluating a large number of Scores
+        > Parameter:
+            - threshold: minimum number of evaluated Scores
+        > Return type: list of PGP IDs
+        '''
+        large_publication_ids = [ pgp_id for pgp_id, pgs_ids in self.publication_evaluated_scores.items() if len(pgs_ids) >= threshold ]
+        return sorted(large_publication_ids)
+
+
+    def get_scores_export_costs(self):
+        '''
+        Estimate the cost of the metadata export of each Score, as the number of rows of its export files: the Score,
+        its development samples, its Performance Metrics and the samples of their Sample Sets (with one row per cohort)
+        > Return type: dictionary PGS ID => cost
+        '''
+        costs = {}
+        for score in self.get_scores():
+            costs[score['id']] = 1 + sum([ 1 + len(sample['cohorts']) for sample_type in ('samples_variants', 'samples_training') for sample in score[sample_type] ])
+        for perf in self.get_performances():
+            cost = 1 + sum([ 1 + len(sample['cohorts']) for sample in perf['sampleset']['samples'] ])
+            costs[perf['associated_pgs_id']] = costs.get(perf['associated_pgs_id'], 0) + cost
+        return costs
+
+
+    def get_export_rows_counts(self, pgs_list=None, scores_only=None):
+        '''
+        Return the number of rows of each spreadsheet of an export, as generated by PGSExport
+        > Parameters:
+            - pgs_list: list of PGS IDs of the export (all the Scores if not provided)
+            - scores_only: only count the Score publications (exports focused on a large study)
+        > Return type: dictionary spreadsheet name (see PGSExport.spreadsheets_list) => number of rows
+        '''
+        scores = self.get_scores(pgs_list)
+        performances = self.get_performances(pgs_list)
+        samplesets = { perf['sampleset']['id']: perf['sampleset'] for perf in performances }
+        return {
+            'publications': len(self.get_publications(pgs_list, scores_only)),
+            'efo_traits': len(self.get_traits(pgs_list)),
+            'scores': len(scores),
+            'samples_development': sum([ len(score['samples_variants']) + len(score['samples_training']) for score in scores ]),
+            'perf': len(performances),
+            'samplesets': sum([ len(sampleset['samples']) for sampleset in samplesets.values() ]),
+            'cohorts': len(self.get_cohorts(pgs_list))
+        }
+
+
+    #---------------#
+    # Trait methods #
+    #---------------#
+
+    def get_trait_ids(self):
+        ''' Return the list of EFO IDs mapped to at least one Score, following the order of the metadata '''
+        return [ x['id'] for x in self.data['trait'] if x['id'] in self.trait_scores ]
+
+
+    def get_trait_score_ids(self, efo_id):
+        ''' Return the list of PGS IDs mapped to a given trait '''
+        return self.trait_scores.get(efo_id, [])
+
+
+    #---------------------#
+    # Sample Sets methods #
+    #---------------------#
+
+    def get_samplesets_scores(self):
+        ''' Return the PGS IDs associated with each Sample Set (PSS ID => set of PGS IDs), computed once '''
+        if self.samplesets_scores is None:
+            samplesets_scores = {}
+            for perf in self.get_performances():
+                samplesets_scores.setdefault(perf['sampleset']['id'], set()).add(perf['associated_pgs_id'])
+            self.samplesets_scores = samplesets_scores
+        return self.samplesets_scores
+
+
+    #----------------------#
+    # Ancestry information #
+    #----------------------#
+
+    def get_ancestry_distribution(self, pgs_id, stage, ancestry_categories, separator):
+        '''
+        Return the formatted ancestry distribution of a Score for a given stage, e.g. "European:66.7|African:33.3"
+        > Parameters:
+            - pgs_id: PGS ID
+            - stage: stage of the ancestry distribution ('gwas', 'dev' or 'eval')
+            - ancestry_categories: dictionary of the ancestry categories (code => label)
+            - separator: separator between the ancestry categories
+        '''
+        return self.format_ancestry_distributions(ancestry_categories, separator)[pgs_id][stage]
+
+
+    def format_ancestry_distributions(self, ancestry_categories, separator):
+        '''
+        Format the ancestry distributions of all the Scores in a single pass (computed once per ancestry categories and separator)
+        > Return type: dictionary (PGS ID => stage => formatted ancestry distribution)
+        '''
+        key = (tuple(ancestry_categories.items()), separator)
+        if key in self.ancestry_distributions:
+            return self.ancestry_distributions[key]
+        ancestry_distributions = {}
+        for score in self.get_scores():
+            ancestries = score['ancestry_distribution']
+            score_distributions = {}
+            for stage in self.ancestry_stages:
+                ancestry_data = ''
+                if stage in ancestries:
+                    dist = ancestries[stage]['dist']
+                    ancestry_data = separator.join([ f'{ancestry_categories[anc]}:{dist[anc]}' for anc in sorted(dist, key=lambda anc: float(dist[anc]), reverse=True) ])
+                score_distributions[stage] = ancestry_data
+            ancestry_distributions[score['id']] = score_distributions
+        self.ancestry_distributions[key] = ancestry_distributions
+        return ancestry_distributions
+
+
+    def get_ancestry_distribution_table(self, ancestry_categories, pgs_list=None):
+        '''
+        Return the ancestry distributions as a wide table: one row per Score and stage, and one column per ancestry category (percentage).
+        > Parameters:
+            - ancestry_categories: dictionary of the ancestry categories (code => label)
+            - pgs_list: list of PGS IDs (all the Scores if no list is provided)
+        > Return type: dictionary of columns
+        '''
+        table = { 'pgs_id': [], 'stage': [] }
+        for anc in ancestry_categories:
+            table[anc] = []
+        for score in self.get_scores(pgs_list):
+            ancestries = score['ancestry_distribution']
+            for stage in self.ancestry_stages:
+                if stage not in ancestries:
+                    continue
+                dist = ancestries[stage]['dist']
+                table['pgs_id'].append(score['id'])
+                table['stage'].append(stage)
+                for anc in ancestry_categories:
+                    table[anc].append(float(dist[anc]) if anc in dist else None)
+        return table
+
+
+    #------------------#
+    # Subset selection #
+    #------------------#
+
+    def get_scores(self, pgs_list=None):
+        ''' Return the Scores corresponding to the list of PGS IDs (all of them if no list is provided) '''
+        if not pgs_list:
+            return self.data['score']
+        pgs_ids = [ x for x in set(pgs_list) if x in self.scores ]
+        pgs_ids.sort(key=self.scores_position.get)
+        return [ self.scores[x] for x in pgs_ids ]
+
+
+    def get_performances(self, pgs_list=None):
+        '''
+        Return the Performance Metrics associated with the list of PGS IDs
+        (all of them if no list is provided, otherwise sorted by PPM ID).
+        '''
+        if not pgs_list:
+            return self.data['performance']
+        performances = {}
+        for pgs_id in set(pgs_list):
+            for perf in self.score_performances.get(pgs_id, []):
+                performances[perf['id']] = perf
+        return [ performances[x] for x in sorted(performances.keys()) ]
+
+
+    def get_publications(self, pgs_list=None, scores_only=None):
+        '''
+        Return the Publications associated with the list of PGS IDs (all of them if no list is provided)
+        > Parameters:
+            - pgs_list: list of PGS IDs
+            - scores_only: only consider the Score publications (i.e. not the Performance Metrics publications)
+        '''
+        if not pgs_list:
+            return self.data['publication']
+        publication_ids = set()
+        for score in self.get_scores(pgs_list):
+            publication_ids.add(score['publication']['id'])
+            if not scores_only:
+                for perf in self.score_performances.get(score['id'], []):
+                    publication_ids.add(perf['publication']['id'])
+        return [ self.publications[x] for x in sorted(publication_ids) if x in self.publications ]
+
+
+    def get_traits(self, pgs_list=None):
+        ''' Return the EFO Traits associated with the list of PGS IDs (all of them if no list is provided) '''
+        if not pgs_list:
+            return self.data['trait']
+        trait_ids = set()
+        for score in self.get_scores(pgs_list):
+            for trait in score['trait_efo']:
+                if trait['id'] in self.traits_position:
+                    trait_ids.add(trait['id'])
+        return [ self.data['trait'][x] for x in sorted(self.traits_position[x] for x in trait_ids) ]
+
+
+    def get_cohorts(self, pgs_list=None):
+        ''' Return the Cohorts associated with the list of PGS IDs (all of them if no list is provided) '''
+        if not pgs_list:
+            return self.data['cohort']
+        cohort_ids = set()
+        for score in self.get_scores(pgs_list):
+            # Development cohorts
+            for sample_type in ('samples_variants', 'samples_training'):
+                for sample in score[sample_type]:
+                    for cohort in sample['cohorts']:
+                        cohort_ids.add(cohort['name_short'])
+            # Evaluation cohorts (via Performance Metrics and Sample Sets)
+            for perf in self.score_performances.get(score['id'], []):
+                for sample in perf['sampleset']['samples']:
+                    for cohort in sample['cohorts']:
+                        cohort_ids.add(cohort['name_short'])
+        positions = [ self.cohorts_position[x] for x in cohort_ids if x in self.cohorts_position ]
+        return [ self.data['cohort'][x] for x in sorted(positions) ]
@@ -1,6 +1,13 @@
-import sys, os.path, tarfile
-import pandas as pd
+import sys, os.path
+import csv
+import datetime
+import io
+import gzip
 import hashlib
+import json
+from pgs_exports.PGSDataIndex import PGSDataIndex
+from pgs_exports.PGSHashService import PGSHashService
+from pgs_exports.PGSExportBundle import PGSExportBundle
 
 
 #-----------------#
@@ -134,35 +141,65 @@ class PGSExport:
     # Data separator
     separator = '|'
 
+    # Order of the spreadsheets
+    spreadsheets_list = [
+        'publications', 'efo_traits', 'scores',
+        'samples_development', 'perf', 'samplesets', 'cohorts'
+    ]
+
+    # Label of the spreadsheets (also used to name the CSV files)
+    spreadsheets_labels = {
+        'scores'     : 'Scores',
+        'perf'       : 'Performance Metrics',
+        'samplesets' : 'Evaluation Sample Sets',
+        'samples_development': 'Score Development Samples',
+        'publications': 'Publications',
+        'efo_traits' : 'EFO Traits',
+        'cohorts'    : 'Cohorts'
+    }
+
 
     #-----------------#
     # General methods #
     #-----------------#
 
-    def __init__(self, filename, data, ancestry_categories,pub_focused=None):
+    def __init__(self, filename, data, ancestry_categories,pub_focused=None,data_index=None,csv_backend='pandas',blob_store=None,in_memory_bundle=False):
         self.filename = filename
+        # Library used to write the CSV files: 'pandas' or 'csv' (lighter, for the small exports)
+        self.csv_backend = csv_backend
+        # Content-addressed store of the CSV files (PGSBlobStore), to write the identical files only once
+        self.blob_store = blob_store
+        # In-memory bundle of the files (PGSExportBundle): each file is written once, and the tar file is built from the buffers
+        self.bundle = PGSExportBundle() if in_memory_bundle else None
         self.data = data
+        # Index shared between the exports (built here if not provided)
+        if not data_index:
+            data_index = PGSDataIndex(data)
+        self.data_index = data_index
         self.ancestry_categories = ancestry_categories
         self.pub_focused = pub_focused
         self.pgs_list = []
         self.publication_ids = []
-        self.writer = pd.ExcelWriter(filename, engine='xlsxwriter')
-
-        # Order of the spreadsheets
-        self.spreadsheets_list = [
-            'publications', 'efo_traits', 'scores',
-            'samples_development', 'perf', 'samplesets', 'cohorts'
-        ]
+        # Pandas is only imported when needed (slow import)
+        import pandas as pd
+        if self.bundle:
+            self.excel_buffer = io.BytesIO()
+            self.writer = pd.ExcelWriter(self.excel_buffer, engine='xlsxwriter')
+        else:
+            self.writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+        # Fixed creation date, so the Excel file of an unchanged export is identical from a release to the next
+        self.writer.book.set_properties({ 'created': datetime.datetime.fromtimestamp(PGSExportBundle.files_mtime, datetime.timezone.utc).replace(tzinfo=None) })
 
         # Spreadsheets content creation
+        labels = self.spreadsheets_labels
         self.spreadsheets_conf = {
-            'scores'     : ('Scores', self.create_scores_spreadsheet),
-            'perf'       : ('Performance Metrics', self.create_performance_metrics_spreadsheet),
-            'samplesets' : ('Evaluation Sample Sets', self.create_samplesets_spreadsheet),
-            'samples_development': ('Score Development Samples', self.create_samples_development_spreadsheet),
-            'publications': ('Publications', self.create_publications_spreadsheet),
-            'efo_traits' : ('EFO Traits', self.create_efo_traits_spreadsheet),
-            'cohorts'    : ('Cohorts', self.create_cohorts_spreadsheet)
+            'scores'     : (labels['scores'], self.create_scores_spreadsheet),
+            'perf'       : (labels['perf'], self.create_performance_metrics_spreadsheet),
+            'samplesets' : (labels['samplesets'], self.create_samplesets_spreadsheet),
+            'samples_development': (labels['samples_development'], self.create_samples_development_spreadsheet),
+            'publications': (labels['publications'], self.create_publications_spreadsheet),
+            'efo_traits' : (labels['efo_traits'], self.create_efo_traits_spreadsheet),
+            'cohorts'    : (labels['cohorts'], self.create_cohorts_spreadsheet)
         }
 
         # Force data type in some columns
@@ -185,6 +222,24 @@ class PGSExport:
     def save(self):
         ''' Close the Pandas Excel writer and output the Excel file '''
         self.writer.close()
+        if self.bundle:
+            data = self.excel_buffer.getvalue()
+            with open(self.filename, 'wb') as excel_file:
+                excel_file.write(data)
+            self.bundle.add_file(self.filename, data)
+
+
+    def write_file(self, filename, content):
+        ''' Write a CSV file from its content (through the blob store if set), and add it to the in-memory bundle '''
+        # Always UTF-8 (whatever the locale): the file and the bundle have the same content
+        data = content.encode('utf-8')
+        if self.blob_store:
+            self.blob_store.write_file(filename, content)
+        else:
+            with open(filename, 'wb') as file:
+                file.write(data)
+        if self.bundle:
+            self.bundle.add_file(filename, data)
 
 
     def generate_sheets(self, csv_prefix):
@@ -200,7 +255,7 @@ class PGSExport:
         for spreadsheet_name in self.spreadsheets_list:
             spreadsheet_label = self.spreadsheets_conf[spreadsheet_name][0]
             try:
-                data = self.spreadsheets_conf[spreadsheet_name][1]()
+                data = self.get_spreadsheet_data(spreadsheet_name)
                 self.generate_sheet(data, spreadsheet_label)
                 print("Spreadsheet '"+spreadsheet_label+"' done")
                 self.generate_csv(data, csv_prefix, spreadsheet_name, spreadsheet_label)
@@ -210,8 +265,25 @@ class PGSExport:
                 exit()
 
 
+    def get_spreadsheet_data(self, spreadsheet_name):
+        ''' Return the content of a spreadsheet (column label => list of values) '''
+        return self.spreadsheets_conf[spreadsheet_name][1]()
+
+
+    def select_entries(self, spreadsheet_name, entries, key='id'):
+        '''
+        Return the entries to export in a spreadsheet: all of them (see PGSExportAllMetadata for the incremental export)
+        > Parameters:
+            - spreadsheet_name: name of the spreadsheet (see "spreadsheets_list")
+            - entries: list of the entries
+            - key: field identifying each entry (None if the entries are IDs)
+        '''
+        return entries
+
+
     def generate_sheet(self, data, sheet_label):
         ''' Generate the Pandas dataframe and insert it as a spreadsheet into to the Excel file '''
+        import pandas as pd
         try:
             # Create a Pandas dataframe.
             df = pd.DataFrame(data)
@@ -224,7 +296,12 @@ class PGSExport:
 
 
     def generate_csv(self, data, prefix, sheet_name, sheet_label):
-        ''' Generate the Pandas dataframe and create a CSV file '''
+        ''' Generate the Pandas dataframe and create a CSV file (the error is re-raised if the CSV file can't be generated) '''
+        if self.csv_backend == 'csv':
+            self.write_csv(data, prefix, sheet_name, sheet_label)
+            return
+        import pandas as pd
+        csv_filename = self.get_csv_filename(prefix, sheet_label)
         try:
             # Create a Pandas dataframe.
             df = pd.DataFrame(data)
@@ -232,19 +309,91 @@ class PGSExport:
             if sheet_name in self.spreadsheets_column_types:
                 df = df.astype(self.spreadsheets_column_types[sheet_name])
             # Convert the dataframe to an XlsxWriter Excel object.
-            sheet_label = sheet_label.lower().replace(' ', '_')
-            csv_filename = prefix+"_metadata_"+sheet_label+".csv"
-            df.to_csv(csv_filename, index=False)
-        except NameError:
-            print("CSV generation: At least one of the variables is not defined")
+            if self.blob_store or self.bundle:
+                self.write_file(csv_filename, df.to_csv(index=False))
+            else:
+                df.to_csv(csv_filename, index=False)
+        except Exception as e:
+            if isinstance(e, NameError):
+                print("CSV generation: At least one of the variables is not defined")
+            else:
+                print(f'CSV generation: There is an issue with the data of the type "{sheet_label}"\n> {e}')
+            # Same policy as the 'csv' backend: no partial CSV file is left in the export
+            if os.path.lexists(csv_filename):
+                os.remove(csv_filename)
+            raise
+
+
+    def write_csv(self, data, prefix, sheet_name, sheet_label):
+        '''
+        Create a CSV file directly from the spreadsheet data (without Pandas).
+        The values are formatted like the Pandas CSV export (same quoting, column types and formats).
+        '''
+        csv_filename = self.get_csv_filename(prefix, sheet_label)
+        try:
+            column_types = self.spreadsheets_column_types.get(sheet_name, {})
+            columns = list(data.keys())
+            rows_count = len(data[columns[0]]) if columns else 0
+            formatted_columns = []
+            for column in columns:
+                values = data[column]
+                if len(values) != rows_count:
+                    raise ValueError('All arrays must be of the same length')
+                formatted_columns.append(self.format_csv_column(values, column_types.get(column)))
+
+            if self.blob_store or self.bundle:
+                csv_content = io.StringIO()
+                self.write_csv_rows(csv_content, columns, formatted_columns)
+                self.write_file(csv_filename, csv_content.getvalue())
+            else:
+                # Always UTF-8, as the Pandas CSV export (whatever the locale)
+                with open(csv_filename, 'w', newline='', encoding='utf-8') as csv_file:
+                    self.write_csv_rows(csv_file, columns, formatted_columns)
         except Exception as e:
             print(f'CSV generation: There is an issue with the data of the type "{sheet_label}"\n> {e}')
+            # No partial CSV file is left in the export
+            if os.path.lexists(csv_filename):
+                os.remove(csv_filename)
+            raise
+
+
+    @staticmethod
+    def get_csv_filename(prefix, sheet_label):
+        ''' Return the name of the CSV file of a spreadsheet (e.g. "<prefix>_metadata_performance_metrics.csv") '''
+        return prefix+"_metadata_"+sheet_label.lower().replace(' ', '_')+".csv"
+
+
+    def write_csv_rows(self, csv_file, columns, formatted_columns):
+        ''' Write the header and the rows of a CSV file '''
+        csv_writer = csv.writer(csv_file, lineterminator='\n')
+        csv_writer.writerow(columns)
+        csv_writer.writerows(zip(*formatted_columns))
+
+
+    def format_csv_column(self, values, column_type=None):
+        '''
+        Format the values of a column as Pandas does when writing a CSV file:
+        - missing values are empty
+        - 'Int64' columns are written as integers
+        - numeric columns with missing or decimal values are written as floats (e.g. "1.0")
+        '''
+        if column_type == 'Int64':
+            return [ '' if v is None else str(int(v)) for v in values ]
+        non_null_values = [ v for v in values if v is not None ]
+        is_numeric = non_null_values and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in non_null_values)
+        if is_numeric and (len(non_null_values) != len(values) or any(isinstance(v, float) for v in non_null_values)):
+            return [ '' if v is None else repr(float(v)) for v in values ]
+        return [ '' if v is None else str(v) for v in values ]
 
 
     def generate_tarfile(self, output_filename, source_dir):
-        ''' Generate a tar.gz file from a directory '''
-        with tarfile.open(output_filename, "w:gz") as tar:
-            tar.add(source_dir, arcname=os.path.basename(source_dir))
+        ''' Generate a tar.gz file from a directory (from the in-memory bundle if set, without reading the directory) '''
+        if self.bundle:
+            self.bundle.write(output_filename, os.path.basename(source_dir))
+            return
+        # The hardlinked files (see PGSBlobStore) are added as regular files, with the same fixed attributes as the in-memory bundles
+        with PGSExportBundle.open_archive(output_filename, dereference=True) as tar:
+            tar.add(source_dir, arcname=os.path.basename(source_dir), filter=PGSExportBundle.reset_tarinfo)
 
 
     def get_column_labels(self, classname, exception_field=None, exception_classname=None):
@@ -271,15 +420,11 @@ class PGSExport:
         return value
 
 
-    def create_md5_checksum(self, md5_filename='md5_checksum.txt', blocksize=4096):
-        ''' Returns MD5 checksum for the generated file. '''
+    def create_md5_checksum(self, md5_filename='md5_checksum.txt'):
+        ''' Returns MD5 checksum for the generated file (computed by the hashing service, see PGSHashService). '''
 
-        md5 = hashlib.md5()
         try:
-            file = open(self.filename, 'rb')
-            with file:
-                for block in iter(lambda: file.read(blocksize), b""):
-                    md5.update(block)
+            md5 = PGSHashService.get_default().get_checksum(self.filename)
         except IOError:
             print('File \'' + self.filename + '\' not found!')
             return None
@@ -288,7 +433,7 @@ class PGSExport:
             return None
 
         md5file = open(md5_filename, 'w')
-        md5file.write(md5.hexdigest())
+        md5file.write(md5)
         md5file.close()
         print("MD5 checksum file '"+md5_filename+"' has been generated.")
 
@@ -306,11 +451,7 @@ class PGSExport:
         for label in list(score_labels.values()):
             scores_data[label] = []
 
-        scores = []
-        if len(self.pgs_list) == 0:
-            scores = self.data['score']
-        else:
-            scores = [ s for s in self.data['score'] if s['id'] in self.pgs_list ]
+        scores = self.select_entries('scores', self.data_index.get_scores(self.pgs_list))
 
         for score in scores:
             
@@ -329,16 +470,9 @@ class PGSExport:
             scores_data[score_labels['trait_label']].append(self.separator.join(trait_labels))
             scores_data[score_labels['trait_id']].append(self.separator.join(trait_ids))
             
-            # Ancestries
-            ancestries = score['ancestry_distribution']
-            for stage in ('gwas','dev','eval'):
-                ancestry_data = ''
-                if stage in ancestries:
-                    ancestry_datalist = []
-                    for anc,val in sorted(ancestries[stage]['dist'].items(), key=lambda item: float(item[1]), reverse=True):
-                        label = self.ancestry_categories[anc]
-                        ancestry_datalist.append(f'{label}:{val}')
-                    ancestry_data = self.separator.join(ancestry_datalist)
+            # Ancestries (formatted once and shared between the exports)
+            for stage in self.data_index.ancestry_stages:
+                ancestry_data = self.data_index.get_ancestry_distribution(score['id'], stage, self.ancestry_categories, self.separator)
                 scores_data[score_labels[f'ancestry_{stage}']].append(ancestry_data)
 
             # Load the data into the dictionnary
@@ -373,15 +507,8 @@ class PGSExport:
             full_header = metrics_header[m_header]
             perf_data[full_header]  = []
 
-        performances = []
-        if len(self.pgs_list) == 0:
-            performances = self.data['performance']
-        else:
-            score_performances = [ p for p in self.data['performance'] if p['associated_pgs_id'] in self.pgs_list ]
-            for score_perf in score_performances:
-                if score_perf not in performances:
-                    performances.append(score_perf)
-            performances.sort(key=lambda x: x['id'], reverse=False)
+        # Performances deduplicated on the PPM ID and sorted, when a list of PGS IDs is provided
+        performances = self.select_entries('perf', self.data_index.get_performances(self.pgs_list))
 
         for perf in performances:
             # Publication
@@ -456,68 +583,87 @@ class PGSExport:
         for label in list(sample_object_labels.values()):
             object_data[label] = []
 
-        if len(self.pgs_list) == 0:
-            performances = self.data['performance']
-        else:
-            # In this case, the Sample Sets / Score associations will be limited to the Score IDs from the provided list.
-            performances = [ p for p in self.data['performance'] if p['associated_pgs_id'] in self.pgs_list ]
-        
+        # If a list of PGS IDs is provided, the Sample Sets / Score associations will be limited to the Score IDs from the list.
+        performances = self.data_index.get_performances(self.pgs_list)
+
         samplesets = {}
-        score_samplesets = {}
         for perf in performances:
             sampleset = perf['sampleset']
-                
-            pss_id = sampleset['id']
-            score = perf['associated_pgs_id']
-            if not pss_id in score_samplesets:
-                score_samplesets[pss_id] = set()
-            score_samplesets[pss_id].add(score)
+            samplesets[sampleset['id']] = sampleset
 
-            samplesets[pss_id] = sampleset
+        # Sample Sets / Scores associations (computed once for all the exports)
+        samplesets_scores = self.data_index.get_samplesets_scores()
+        pgs_ids = set(self.pgs_list)
 
-        for pss_id in sorted(samplesets.keys()):
-            scores_ids = list(score_samplesets[pss_id])
+        for sampleset in self.select_entries('samplesets', [ samplesets[x] for x in sorted(samplesets.keys()) ]):
+            pss_id = sampleset['id']
+            scores_ids = samplesets_scores[pss_id]
+            if pgs_ids:
+                scores_ids = scores_ids & pgs_ids
             scores = ', '.join(sorted(scores_ids))
 
-            pss = samplesets[pss_id]
-            for sample in pss['samples']:
+            for sample_row in self.get_sampleset_rows(sampleset, sample_object_labels, object_labels):
                 object_data[sample_object_labels['associated_score']].append(scores)
-                object_data[sample_object_labels['cohorts_list']].append(self.separator.join([c['name_short'] for c in sample['cohorts']]))
-
-                for sample_column in sample_object_labels.keys():
-                    if self.not_in_extra_fields_to_include(sample_column):
-                        # Demographic data (not a simple key:value element)
-                        if sample_column in ('sample_age','followup_time'):
-                            demographic = sample[sample_column]
-                            sample_value = None
-                            if demographic:
-                                sample_value = ''
-                                if 'estimate' in demographic:
-                                    sample_value += '{}:{}'.format(demographic['estimate_type'],demographic['estimate'])
-                                if 'interval' in demographic:
-                                    if sample_value != '':
-                                        sample_value += ';'
-                                    interval = demographic['interval']
-                                    sample_value += '{}:[{},{}]'.format(interval['type'],interval['lower'],interval['upper'])
-                                if 'variability' in demographic:
-                                    if sample_value != '':
-                                        sample_value += ';'
-                                    sample_value += '{}:{}'.format(demographic['variability_type'],demographic['variability'])
-                                if 'unit' in demographic:
-                                    if sample_value != '':
-                                        sample_value += ';'
-                                    sample_value += 'unit:{}'.format(demographic['unit'])
-                        else:
-                            sample_value = self.cleanup_field_value(sample[sample_column])
-                        object_data[sample_object_labels[sample_column]].append(sample_value)
-
-                for column in object_labels.keys():
-                    if self.not_in_extra_fields_to_include(column):
-                        value = self.cleanup_field_value(pss[column])
-                        object_data[object_labels[column]].append(value)
+                for label, value in sample_row:
+                    object_data[label].append(value)
         return object_data
 
 
+    def get_sampleset_rows(self, pss, sample_object_labels, object_labels):
+        '''
+        Return the formatted rows (list of label/value tuples, without the associated Scores) of the Sample Set samples.
+        The rows are formatted once and cached on the data index, to be reused by the other exports.
+        '''
+        pss_id = pss['id']
+        if pss_id in self.data_index.samplesets_rows:
+            return self.data_index.samplesets_rows[pss_id]
+
+        sample_rows = []
+        for sample in pss['samples']:
+            sample_row = [ (sample_object_labels['cohorts_list'], self.separator.join([c['name_short'] for c in sample['cohorts']])) ]
+
+            for sample_column in sample_object_labels.keys():
+                if self.not_in_extra_fields_to_include(sample_column):
+                    # Demographic data (not a simple key:value element)
+                    if sample_column in ('sample_age','followup_time'):
+                        sample_value = self.format_demographic(sample[sample_column])
+                    else:
+                        sample_value = self.cleanup_field_value(sample[sample_column])
+                    sample_row.append((sample_object_labels[sample_column], sample_value))
+
+            for column in object_labels.keys():
+                if self.not_in_extra_fields_to_include(column):
+                    value = self.cleanup_field_value(pss[column])
+                    sample_row.append((object_labels[column], value))
+            sample_rows.append(sample_row)
+
+        self.data_index.samplesets_rows[pss_id] = sample_rows
+        return sample_rows
+
+
+    def format_demographic(self, demographic):
+        ''' Format the demographic data of a sample (e.g. "sample_age") '''
+        sample_value = None
+        if demographic:
+            sample_value = ''
+            if 'estimate' in demographic:
+                sample_value += '{}:{}'.format(demographic['estimate_type'],demographic['estimate'])
+            if 'interval' in demographic:
+                if sample_value != '':
+                    sample_value += ';'
+                interval = demographic['interval']
+                sample_value += '{}:[{},{}]'.format(interval['type'],interval['lower'],interval['upper'])
+            if 'variability' in demographic:
+                if sample_value != '':
+                    sample_value += ';'
+                sample_value += '{}:{}'.format(demographic['variability_type'],demographic['variability'])
+            if 'unit' in demographic:
+                if sample_value != '':
+                    sample_value += ';'
+                sample_value += 'unit:{}'.format(demographic['unit'])
+        return sample_value
+
+
 
     def create_samples_development_spreadsheet(self):
         ''' Samples used for score development (GWAS and/or training) spreadsheet '''
@@ -529,10 +675,7 @@ class PGSExport:
             object_data[label] = []
 
         # Get the relevant scores
-        if len(self.pgs_list) == 0:
-             scores = self.data['score']
-        else:
-            scores = [ s for s in self.data['score'] if s['id'] in self.pgs_list ]
+        scores = self.select_entries('samples_development', self.data_index.get_scores(self.pgs_list))
 
         #Loop through Scores to output their samples:
         score_studies = [
@@ -567,28 +710,13 @@ class PGSExport:
         for label in list(object_labels.values()):
             object_data[label] = []
 
-        publications = []
-        if len(self.pgs_list) == 0:
-            publications = self.data['publication']
-        else:
-            scores = [ s for s in self.data['score'] if s['id'] in self.pgs_list ]
-            tmp_publication_ids = set()
-            for score in scores:
-                # Score publication
-                tmp_publication_ids.add(score['publication']['id'])
-
-                # Check if export focused on large studies
-                if not self.pub_focused:
-                    # Performance publication
-                    score_performances = [ p for p in self.data['performance'] if p['associated_pgs_id'] == score['id'] ]
-                    for score_perf in score_performances:
-                        tmp_publication_ids.add(score_perf['publication']['id'])
-                else:
-                    self.publication_ids = tmp_publication_ids
-            publications = [ x for x in self.data['publication'] if x['id'] in tmp_publication_ids ]
-            publications.sort(key=lambda x: x['id'], reverse=False)
-
-        for publi in publications:
+        # Only the Score publications are listed if the export is focused on large studies,
+        # otherwise the Performance Metrics publications are listed too
+        publications = self.data_index.get_publications(self.pgs_list, self.pub_focused)
+        if self.pgs_list and self.pub_focused:
+            self.publication_ids = set([ x['id'] for x in publications ])
+
+        for publi in self.select_entries('publications', publications):
             for column in object_labels.keys():
                 if self.not_in_extra_fields_to_include(column):
                     value = self.cleanup_field_value(publi[column])
@@ -605,17 +733,7 @@ class PGSExport:
         for label in list(object_labels.values()):
             object_data[label] = []
 
-        traits = []
-        if len(self.pgs_list) == 0:
-            traits = self.data['trait']
-        else:
-            scores = [ s for s in self.data['score'] if s['id'] in self.pgs_list ]
-            tmp_trait_ids = set()
-            for score in scores:
-                score_traits = score['trait_efo']
-                for score_trait in score_traits:
-                    tmp_trait_ids.add(score_trait['id'])
-            traits = [ x for x in self.data['trait'] if x['id'] in tmp_trait_ids ]
+        traits = self.select_entries('efo_traits', self.data_index.get_traits(self.pgs_list))
 
         for trait in traits:
             for column in object_labels.keys():
@@ -634,29 +752,8 @@ class PGSExport:
         for label in list(object_labels.values()):
             object_data[label] = []
 
-        cohorts = []
-        if len(self.pgs_list) == 0:
-            cohorts = self.data['cohort']
-        else:
-            scores = [ s for s in self.data['score'] if s['id'] in self.pgs_list ]
-            tmp_cohort_ids = set()
-            for score in scores:
-                # Development cohorts
-                for sample in ('samples_variants', 'samples_training'):
-                    score_samples = score[sample]
-                    for score_sample in score_samples:
-                        for s_cohort in score_sample['cohorts']:
-                            tmp_cohort_ids.add(s_cohort['name_short'])
-                # Evaluation cohorts (via Performance Metrics and Sample Sets)
-                performances = [ p for p in self.data['performance'] if p['associated_pgs_id'] == score['id'] ]
-
-                for perf in performances:
-                    sampleset = perf['sampleset']
-                    for sample in sampleset['samples']:
-                        for s_cohort in sample['cohorts']:
-                            tmp_cohort_ids.add(s_cohort['name_short'])
-
-                cohorts = [ x for x in self.data['cohort'] if x['name_short'] in tmp_cohort_ids ]
+        # Development cohorts and evaluation cohorts (via Performance Metrics and Sample Sets)
+        cohorts = self.select_entries('cohorts', self.data_index.get_cohorts(self.pgs_list), 'name_short')
 
         for cohort in cohorts:
             for column in object_labels.keys():
@@ -671,19 +768,162 @@ class PGSExport:
 #----------------------------#
 
 class PGSExportAllMetadata(PGSExport):
-    ''' Export all the PGS metadata in a unique Excel file. '''
+    '''
+    Export all the PGS metadata in a unique Excel file.
+    The rows of each spreadsheet are kept by entry (see "tables") and saved, so the next release can patch them (incremental export):
+    only the rows of the entries whose source data changed since the previous release (or missing from its tables) are rebuilt,
+    and the other rows are copied from the previous tables, in the order of the full export.
+    The source data of an entry includes the entries embedded in its rows (e.g. the publication and traits of a Score, the cohorts
+    of a Sample Set), so an edited trait or cohort also rebuilds the rows displaying it.
+    '''
+
+    # Version of the format of the tables (see get_tables_fingerprint)
+    tables_version = 2
+
+    # Column identifying the entry of each row, for each spreadsheet
+    spreadsheets_key_columns = {
+        'publications': 'PGS Publication/Study (PGP) ID',
+        'efo_traits': 'Ontology Trait ID',
+        'scores': 'Polygenic Score (PGS) ID',
+        'samples_development': 'Polygenic Score (PGS) ID',
+        'perf': 'PGS Performance Metric (PPM) ID',
+        'samplesets': 'PGS Sample Set (PSS)',
+        'cohorts': 'Cohort ID'
+    }
+
+    def __init__(self, *args, previous_tables=None, **kwargs):
+        '''
+        > Variables (in addition to the PGSExport ones):
+            - previous_tables: tables of the all metadata export of the previous release (see read_tables), patched instead of
+              rebuilding all the rows
+        '''
+        super().__init__(*args, **kwargs)
+        self.previous_tables = previous_tables
+        # Spreadsheet name => { 'columns': list of column labels, 'rows': entry ID => list of rows, 'hashes': entry ID => hash of the source data }
+        self.tables = {}
+        # Spreadsheet name => IDs of the entries, in the order of the full export
+        self.entries_ids = {}
+        # Spreadsheet name => entry ID => hash of the source data of the entry
+        self.entries_hashes = {}
+        # Spreadsheet name => IDs of the entries rebuilt
+        self.rebuilt_ids = {}
+
+
+    def generate_sheets(self, csv_prefix):
+        ''' Generate the differents sheets (patching the tables of the previous release if provided) '''
+        if self.previous_tables and self.previous_tables.get('fingerprint') != self.get_tables_fingerprint():
+            print('The tables of the previous release have been generated with a different format: all the rows are rebuilt')
+            self.previous_tables = None
+        super().generate_sheets(csv_prefix)
+
+
+    def select_entries(self, spreadsheet_name, entries, key='id'):
+        ''' Return the entries to export in a spreadsheet: the entries changed or missing from the previous tables (all of them without previous tables) '''
+        entries_ids = [ x[key] if key else x for x in entries ]
+        self.entries_ids[spreadsheet_name] = entries_ids
+        self.entries_hashes[spreadsheet_name] = { x: self.get_source_hash(spreadsheet_name, entry) for entry, x in zip(entries, entries_ids) }
+        if not self.previous_tables:
+            self.rebuilt_ids[spreadsheet_name] = None
+            return entries
+        previous_table = self.previous_tables['tables'][spreadsheet_name]
+        previous_rows = previous_table['rows']
+        previous_hashes = previous_table['hashes']
+        entries_hashes = self.entries_hashes[spreadsheet_name]
+        rebuilt_ids = set([ x for x in entries_ids if x not in previous_rows or previous_hashes.get(x) != entries_hashes[x] ])
+        self.rebuilt_ids[spreadsheet_name] = rebuilt_ids
+        return [ entry for entry, entry_id in zip(entries, entries_ids) if entry_id in rebuilt_ids ]
+
+
+    def get_source_hash(self, spreadsheet_name, entry):
+        ''' Return the hash of the source data of the rows of an entry (the entry, with the entries it references, see get_source_data) '''
+        source_data = self.get_source_data(entry)
+        # The Sample Sets rows also list the associated Scores
+        if spreadsheet_name == 'samplesets':
+            source_data = [ source_data, sorted(self.data_index.get_samplesets_scores()[entry['id']]) ]
+        return hashlib.md5(json.dumps(source_data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+    @classmethod
+    def get_source_data(cls, value):
+        ''' Return the data of an entry as a JSON structure, with the referenced entries resolved (e.g. the publication and traits of a Score) '''
+        if isinstance(value, (list, tuple)):
+            return [ cls.get_source_data(x) for x in value ]
+        if hasattr(value, 'keys'):
+            return { key: cls.get_source_data(value[key]) for key in value.keys() }
+        return value
+
+
+    def get_spreadsheet_data(self, spreadsheet_name):
+        ''' Return the content of a spreadsheet: the rows rebuilt, merged with the rows of the previous tables (by entry ID) '''
+        data = super().get_spreadsheet_data(spreadsheet_name)
+        columns = list(data.keys())
+        key_column = self.spreadsheets_key_columns[spreadsheet_name]
+
+        # Rows grouped by entry
+        rows = {}
+        key_position = columns.index(key_column)
+        for row in zip(*[ data[x] for x in columns ]):
+            rows.setdefault(row[key_position], []).append(list(row))
+
+        rebuilt_ids = self.rebuilt_ids[spreadsheet_name]
+        if rebuilt_ids is not None:
+            previous_rows = self.previous_tables['tables'][spreadsheet_name]['rows']
+            rows = { x: rows.get(x, []) if x in rebuilt_ids else previous_rows[x] for x in self.entries_ids[spreadsheet_name] }
+            print(f'Spreadsheet "{self.spreadsheets_conf[spreadsheet_name][0]}": {len(rebuilt_ids)} of {len(rows)} entries rebuilt')
+            data = { column: [] for column in columns }
+            for entry_rows in rows.values():
+                for row in entry_rows:
+                    for column, value in zip(columns, row):
+                        data[column].append(value)
+        else:
+            rows = { x: rows.get(x, []) for x in self.entries_ids[spreadsheet_name] }
+        self.tables[spreadsheet_name] = { 'columns': columns, 'rows': rows, 'hashes': self.entries_hashes[spreadsheet_name] }
+        return data
+
+
+    def get_tables_fingerprint(self):
+        ''' Fingerprint of the format of the tables (version, columns, ancestry categories and separator) '''
+        tables_format = [ self.tables_version, self.fields_to_include, self.metrics_header, self.ancestry_categories, self.separator, self.spreadsheets_list ]
+        return hashlib.sha256(json.dumps(tables_format, sort_keys=True).encode()).hexdigest()
+
+
+    def write_tables(self, tables_file):
+        ''' Write the tables (rows of each spreadsheet, by entry), to patch them in the next release '''
+        tmp_tables_file = tables_file+'.tmp'
+        with gzip.open(tmp_tables_file, 'wt', compresslevel=1) as f:
+            json.dump({ 'fingerprint': self.get_tables_fingerprint(), 'tables': self.tables }, f)
+        os.replace(tmp_tables_file, tables_file)
+
+
+    @staticmethod
+    def read_tables(tables_file):
+        ''' Read the tables of a previous all metadata export (see write_tables) '''
+        with gzip.open(tables_file, 'rt') as f:
+            return json.load(f)
 
     def create_readme_spreadsheet(self, release):
         ''' Info/readme spreadsheet '''
 
+        import pandas as pd
         readme_data = {}
 
         readme_data['PGS Catalog version'] = [release]
-        readme_data['Number of Polygenic Scores'] = [len(self.data['score'])]
-        readme_data['Number of Traits'] = [len(self.data['trait'])]
-        readme_data['Number of Publications'] = [len(self.data['publication'])]
+        readme_data['Number of Polygenic Scores'] = [self.data_index.count('score')]
+        readme_data['Number of Traits'] = [self.data_index.count('trait')]
+        readme_data['Number of Publications'] = [self.data_index.count('publication')]
 
         df = pd.DataFrame(readme_data)
         df = df.transpose()
         df.to_excel(self.writer, sheet_name="Readme", header=False)
 
+
+    def generate_ancestry_distribution_csv(self, prefix):
+        ''' Generate a CSV file with the ancestry distribution percentages (one row per Score and stage, one column per ancestry category) '''
+        import pandas as pd
+        table = self.data_index.get_ancestry_distribution_table(self.ancestry_categories, self.pgs_list)
+        column_types = { anc: 'float64' for anc in self.ancestry_categories }
+        df = pd.DataFrame(table).astype(column_types)
+        csv_filename = prefix+"_metadata_ancestry_distribution.csv"
+        df.to_csv(csv_filename, index=False)
+        print("CSV 'Ancestry Distribution' done")
+
@@ -0,0 +1,85 @@
+import os, os.path
+import contextlib
+import io
+import gzip
+import tarfile
+
+
+#-----------------------#
+# Class PGSExportBundle #
+#-----------------------#
+
+class PGSExportBundle:
+    '''
+    In-memory bundle of the files of an export (Excel and CSV files): the content of each file is kept when it is written
+    (see PGSExport.write_file), and the tar.gz file is built from these buffers (TarInfo + BytesIO), without reading
+    the export directory again.
+    The archive has the same structure as the one built from the directory (directory entry, then the files sorted by name).
+    The archives are reproducible: the members have a fixed owner, permissions and modification time, and the gzip header
+    has no timestamp, so the archive of an unchanged export is identical from a release to the next.
+    '''
+
+    file_mode = 0o644
+    dir_mode = 0o755
+
+    # Modification time of the archive members (2020-01-01 00:00:00 UTC), also used as the creation date of the Excel files
+    files_mtime = 1577836800
+
+    def __init__(self):
+        # File name => content
+        self.files = {}
+
+
+    def add_file(self, filename, data):
+        '''
+        Add a file to the bundle
+        > Parameters:
+            - filename: path of the file (only its name is used in the archive)
+            - data: content of the file (bytes)
+        '''
+        self.files[os.path.basename(filename)] = data
+
+
+    def get_filenames(self):
+        ''' Return the names of the files of the bundle, sorted '''
+        return sorted(self.files.keys())
+
+
+    def write(self, output_filename, arcname=''):
+        '''
+        Write the tar.gz file of the bundle
+        > Parameters:
+            - output_filename: path of the tar.gz file
+            - arcname: name of the directory of the files in the archive (files at the root of the archive if empty)
+        '''
+        with self.open_archive(output_filename) as tar:
+            tar.addfile(self.get_tarinfo(arcname, tarfile.DIRTYPE, 0))
+            for filename in self.get_filenames():
+                data = self.files[filename]
+                tar.addfile(self.get_tarinfo(arcname+'/'+filename if arcname else filename, tarfile.REGTYPE, len(data)), io.BytesIO(data))
+
+
+    def get_tarinfo(self, name, type, size):
+        ''' Return the header of an archive member '''
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.type = type
+        tarinfo.size = size
+        return self.reset_tarinfo(tarinfo)
+
+
+    @classmethod
+    def reset_tarinfo(cls, tarinfo):
+        ''' Set the fixed owner (uid/gid 0, no names), permissions and modification time of an archive member (also used as a "tarfile.add" filter) '''
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        tarinfo.mode = cls.dir_mode if tarinfo.isdir() else cls.file_mode
+        tarinfo.mtime = cls.files_mtime
+        return tarinfo
+
+
+    @staticmethod
+    @contextlib.contextmanager
+    def open_archive(output_filename, **kwargs):
+        ''' Open a tar.gz file to write, without timestamp in the gzip header (the keyword arguments are passed to tarfile.open) '''
+        with gzip.GzipFile(output_filename, 'wb', mtime=0) as gzip_file, tarfile.open(fileobj=gzip_file, mode='w', **kwargs) as tar:
+            yield tar
@@ -1,5 +1,19 @@
 import os.path
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pgs_exports.PGSExport import PGSExport, PGSExportAllMetadata
+from pgs_exports.PGSDataIndex import PGSDataIndex
+from pgs_exports.PGSCheckpoint import PGSCheckpoint
+from pgs_exports.PGSExportScheduler import PGSExportScheduler
+
+
+# Generator used by the worker processes (inherited when the processes are forked)
+worker_generator = None
+
+def run_export_task(task):
+    ''' Run an export task (method name, ID) in a worker process '''
+    return worker_generator.run_export_task(task)
+
 
 #--------------------------------#
 # Class class PGSExportGenerator #
@@ -8,26 +22,90 @@ from pgs_exports.PGSExport import PGSExport, PGSExportAllMetadata
 class PGSExportGenerator:
     ''' Generates the different PGS exports. '''
 
-    def __init__(self,dirpath,data,scores_file,score_ids_list,large_publication_ids_list,latest_release,ancestry_categories,debug):
+    # Minimum number of evaluated Scores for a publication to be considered as a large study
+    large_publication_threshold = 500
+
+    # Library used to write the CSV files, for each type of export ('all', 'publication', 'trait' or 'score'):
+    # 'pandas' or 'csv' (lighter, for the numerous small per-score exports)
+    csv_backends = {
+        'all': 'pandas',
+        'publication': 'pandas',
+        'trait': 'pandas',
+        'score': 'csv'
+    }
+
+    # Exports built through an in-memory bundle (see PGSExportBundle), for each type of export: the files are written once,
+    # and the tar file is built from the buffers instead of reading the export directory again
+    in_memory_bundles = {
+        'all': False,
+        'publication': True,
+        'trait': True,
+        'score': True
+    }
+
+    # File of the all metadata tables (rows of each spreadsheet, by entry), saved in the export directory to patch them in the next release
+    all_metadata_tables_file = 'pgs_all_metadata_tables.json.gz'
+
+    # Type of the entry exported by each export task (sent to the FTP assembly, see "export_queue")
+    export_types = {
+        'generate_study_metadata_export': 'score',
+        'generate_large_study_metadata_export': 'publication',
+        'generate_trait_metadata_export': 'trait'
+    }
+
+    def __init__(self,dirpath,data,scores_file,score_ids_list,large_publication_ids_list,latest_release,ancestry_categories,debug,large_publication_threshold=None,workers=1,data_index=None,ancestry_table=False,checkpoint=None,csv_backends=None,blob_store=None,export_queue=None,memory_budget=None,previous_tables_file=None,trait_ids_list=None):
         '''
         > Variables:
             - dirpath: path to the directory where the metadata files will be stored
             - data: dictionary containing the metadata
             - scores_file: path to the file where we want to write the list of PGS IDs
             - score_ids_list: list of the PGS IDs
-            - large_publication_ids_list: list of the PGP IDs that require specific metadata files (large studies)
+            - large_publication_ids_list: list of the PGP IDs that require specific metadata files (large studies).
+              If None, the large studies are selected using the number of evaluated Scores (see "large_publication_threshold")
             - latest_release: date of the latest (i.e. new) release
             - ancestry_categories: list of the ancestry categories defined in the Catalog
             - debug: parameter to test the script (default:0 => non debug mode)
+            - large_publication_threshold: minimum number of evaluated Scores to select a large study
+            - workers: number of processes used to generate the PGS and large studies exports (default: 1 => no parallelisation)
+            - data_index: index of the metadata, shared between the exports (built from "data" if not provided)
+            - ancestry_table: flag to also export the ancestry distributions as a table of percentages (all metadata export only)
+            - checkpoint: journal of the completed exports (PGSCheckpoint), used to skip them when resuming a release
+            - csv_backends: library used to write the CSV files, for each type of export (see "csv_backends")
+            - blob_store: content-addressed store (PGSBlobStore) used to write the CSV files of the PGS and large studies exports only once
+            - export_queue: queue where each completed PGS and large study export is put, as a tuple (type, ID), to build its FTP structure
+              right away (see PGSFtpGenerator.start_pipeline)
+            - memory_budget: memory (bytes) available per worker process for the exports in progress (see PGSExportScheduler)
+            - previous_tables_file: path to the all metadata tables of the previous release (see "all_metadata_tables_file"): only the rows of
+              the changed entries are rebuilt in the all metadata export (incremental export, see PGSExportAllMetadata)
+            - trait_ids_list: list of the EFO IDs exported in their own metadata files (all the Scores mapped to the trait, see
+              PGSDataIndex.get_trait_score_ids). No trait export if not provided
         '''
         self.dirpath = dirpath
         self.data = data
         self.scores_file = scores_file 
         self.score_ids_list = score_ids_list
-        self.large_publication_ids_list = large_publication_ids_list
         self.latest_release = latest_release
         self.ancestry_categories = ancestry_categories
         self.debug = debug
+        self.workers = workers
+        self.ancestry_table = ancestry_table
+        self.checkpoint = checkpoint
+        self.blob_store = blob_store
+        self.export_queue = export_queue
+        self.memory_budget = memory_budget
+        self.previous_tables_file = previous_tables_file
+        self.trait_ids_list = trait_ids_list if trait_ids_list else []
+        self.csv_backends = dict(self.csv_backends)
+        if csv_backends:
+            self.csv_backends.update(csv_backends)
+        if not data_index:
+            data_index = PGSDataIndex(data)
+        self.data_index = data_index
+        if large_publication_threshold:
+            self.large_publication_threshold = large_publication_threshold
+        if large_publication_ids_list is None:
+            large_publication_ids_list = self.data_index.get_large_publication_ids(self.large_publication_threshold)
+        self.large_publication_ids_list = large_publication_ids_list
 
 
     def generate_scores_list_file(self):
@@ -59,8 +137,16 @@ class PGSExportGenerator:
             print(f'Can\'t create a directory for the metadata ({datadir})')
             exit(1)
 
+        # Tables of the previous release, patched with the rows of the released entries
+        previous_tables = None
+        if self.previous_tables_file:
+            if os.path.isfile(self.previous_tables_file):
+                previous_tables = PGSExportAllMetadata.read_tables(self.previous_tables_file)
+            else:
+                print(f'Can\'t find the tables of the previous release ({self.previous_tables_file}): all the rows are rebuilt')
+
         # Create export object
-        pgs_export = PGSExportAllMetadata(filename, self.data, self.ancestry_categories)
+        pgs_export = PGSExportAllMetadata(filename, self.data, self.ancestry_categories, data_index=self.data_index, csv_backend=self.csv_backends['all'], previous_tables=previous_tables)
 
         if self.debug:
             pgs_ids_list = []
@@ -75,6 +161,14 @@ class PGSExportGenerator:
         # Build the spreadsheets
         pgs_export.generate_sheets(csv_prefix)
 
+        # Tables of the spreadsheets, for the next release
+        tables_file = self.dirpath+self.all_metadata_tables_file
+        pgs_export.write_tables(tables_file)
+
+        # Ancestry distribution table (for analytics)
+        if self.ancestry_table:
+            pgs_export.generate_ancestry_distribution_csv(csv_prefix)
+
         # Close the Pandas Excel writer and output the Excel file.
         pgs_export.save()
 
@@ -84,6 +178,8 @@ class PGSExportGenerator:
         # Generate a tar file of the study data
         pgs_export.generate_tarfile(self.dirpath+"pgs_all_metadata.tar.gz",datadir)
 
+        return self.list_export_files(datadir, self.dirpath+"pgs_all_metadata.tar.gz") + [tables_file]
+
 
     def call_generate_large_studies_metadata_exports(self):
         ''' Generate PGS metadata export files for each large released studies '''
@@ -91,114 +187,277 @@ class PGSExportGenerator:
 
         print(f'> large_publication_ids_list: {self.large_publication_ids_list}')
 
+        self.run_export_tasks([ ('generate_large_study_metadata_export', pgp_id) for pgp_id in self.large_publication_ids_list ])
+
+
+    def call_generate_traits_metadata_exports(self):
+        ''' Generate PGS metadata export files for each trait (all the Scores mapped to the trait) '''
+        print("\t- Generate PGS metadata export files for each trait")
+
+        self.run_export_tasks([ ('generate_trait_metadata_export', efo_id) for efo_id in self.trait_ids_list ])
+
+
+    def call_generate_studies_metadata_exports(self):
+        ''' Generate PGS metadata export files for each released studies '''
+        print("\t- Generate PGS metadata export files for each released studies")
+
+        self.run_export_tasks([ ('generate_study_metadata_export', pgs_id) for pgs_id in self.get_pgs_ids_list() ])
+
+
+    def call_generate_studies_and_large_studies_metadata_exports(self):
+        '''
+        Generate PGS metadata export files for each large released studies and each released studies
+        (and for each trait, if any), sharing the same workers
+        '''
+        print("\t- Generate PGS metadata export files for each large released studies and each released studies")
+
+        print(f'> large_publication_ids_list: {self.large_publication_ids_list}')
+
+        # The tasks are scheduled by decreasing cost (see run_export_tasks)
+        tasks = [ ('generate_large_study_metadata_export', pgp_id) for pgp_id in self.large_publication_ids_list ]
+        tasks += [ ('generate_trait_metadata_export', efo_id) for efo_id in self.trait_ids_list ]
+        tasks += [ ('generate_study_metadata_export', pgs_id) for pgs_id in self.get_pgs_ids_list() ]
+        self.run_export_tasks(tasks)
+
+
+    def get_pgs_ids_list(self):
+        ''' List the PGS IDs to export '''
+        if self.debug:
+            pgs_ids_list = []
+            for i in range(1,self.debug+1):
+                num = i < 10 and '0'+str(i) or str(i)
+                pgs_ids_list.append('PGS0000'+num)
+        else:
+            pgs_ids_list = self.data_index.get_score_ids()
+        return pgs_ids_list
+
+
+    def run_export_tasks(self, tasks):
+        '''
+        Run the export tasks, sequentially or in parallel (depending on the number of workers)
+        > Parameter:
+            - tasks: list of tuples (method name, PGS/PGP/EFO ID)
+        '''
+        # Skip the exports already completed (resumed release)
+        completed_tasks = []
+        if self.checkpoint:
+            completed_tasks = [ task for task in tasks if self.checkpoint.is_bundle_done(task[1]) ]
+            tasks = [ task for task in tasks if not self.checkpoint.is_bundle_done(task[1]) ]
+            if completed_tasks:
+                print(f'\t> Resume: skip {len(completed_tasks)} completed export(s)')
+
+        if self.workers <= 1 or len(tasks) <= 1:
+            self.send_export_tasks(completed_tasks)
+            for task in tasks:
+                self.record_export_task(*self.run_export_task(task))
+                self.send_export_tasks([task])
+            return
+
+        # The worker processes are forked so they share the metadata (and its index) without copying it
+        self.prepare_shared_data()
+        global worker_generator
+        worker_generator = self
+        mp_context = multiprocessing.get_context('fork')
+
+        # Largest tasks first, within the memory budget
+        scheduler = PGSExportScheduler(self.workers, self.memory_budget)
+        costs = scheduler.get_tasks_costs(tasks, self.data_index)
+        def complete_export_task(task, result):
+            self.record_export_task(*result)
+            self.send_export_tasks([task])
+
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context) as executor:
+            # The completed exports are sent once the worker processes are forked (the FTP assembly threads are idle until then)
+            scheduler.run(executor, run_export_task, tasks, costs, complete_export_task, lambda: self.send_export_tasks(completed_tasks))
+        worker_generator = None
+        scheduler.report(costs)
+
+
+    def run_export_task(self, task):
+        '''
+        Run an export task
+        > Parameter:
+            - task: tuple (method name, PGS/PGP/EFO ID)
+        > Return type: tuple (PGS/PGP/EFO ID, dictionary of the generated files and their checksums)
+        '''
+        method_name, export_id = task
+        files = getattr(self, method_name)(export_id)
+        files_checksums = None
+        if self.checkpoint and files:
+            files_checksums = PGSCheckpoint.get_files_checksums(files)
+        return (export_id, files_checksums)
+
+
+    def record_export_task(self, export_id, files_checksums):
+        ''' Record a completed export task in the checkpoint journal '''
+        if self.checkpoint and files_checksums:
+            self.checkpoint.set_bundle_done(export_id, files_checksums)
+
+
+    def send_export_tasks(self, tasks):
+        ''' Send the entries of completed export tasks to the FTP assembly (blocks while the queue is full) '''
+        if self.export_queue is None:
+            return
+        for method_name, export_id in tasks:
+            if method_name in self.export_types:
+                self.export_queue.put((self.export_types[method_name], export_id))
+
+
+    def prepare_shared_data(self):
+        ''' Compute the data shared between the exports, e.g. before forking the worker processes '''
+        self.data_index.format_ancestry_distributions(self.ancestry_categories, PGSExport.separator)
+        self.data_index.get_samplesets_scores()
+
+
+    def generate_large_study_metadata_export(self, pgp_id):
+        ''' Generate the PGS metadata export files for a large study '''
+        print(f'>> Publication: {pgp_id}')
+
         pub_datadir = self.dirpath+'publications_metadata/'
         if not os.path.isdir(pub_datadir):
             try:
-                os.mkdir(pub_datadir)
+                os.makedirs(pub_datadir, exist_ok=True)
             except OSError:
                 print (f'Creation of the directory {pub_datadir} failed')
 
-        # Loop over the PGS IDs
-        for pgp_id in self.large_publication_ids_list:
-            print(f'>> Publication: {pgp_id}')
-            pgp_id_found = False
-            for publication in self.data['publication']:
+        publication = self.data_index.get_publication(pgp_id)
+        if not publication:
+            print(f'>>>> Warning - large studies: PGP ID "{pgp_id}" couldn\'t be found!')
+            return
+
+        print("\n# PGP "+pgp_id)
+
+        datadir = pub_datadir+pgp_id+'/'
+        filename = datadir+pgp_id+'_metadata.xlsx'
+
+        csv_prefix = datadir+pgp_id
+
+        pgs_ids_list = self.data_index.get_publication_evaluated_score_ids(pgp_id)
+
+        if not os.path.isdir(datadir):
+            try:
+                os.mkdir(datadir)
+            except OSError:
+                print (f'Creation of the directory {datadir} failed')
 
-                if publication['id'] != pgp_id:
-                    continue
+        if not os.path.isdir(datadir):
+            print(f'Can\'t create a directory for the metadata ({datadir})')
+            exit(1)
 
-                print("\n# PGP "+pgp_id)
-                pgp_id_found = True
+        # Create export object
+        pgs_export = PGSExport(filename, self.data, self.ancestry_categories, True, self.data_index, self.csv_backends['publication'], self.blob_store, self.in_memory_bundles['publication'])
+        pgs_export.set_pgs_list(pgs_ids_list)
 
-                datadir = pub_datadir+pgp_id+'/'
-                filename = datadir+pgp_id+'_metadata.xlsx'
+        # Build the spreadsheets
+        pgs_export.generate_sheets(csv_prefix)
 
-                csv_prefix = datadir+pgp_id
+        # Close the Pandas Excel writer and output the Excel file.
+        pgs_export.save()
 
-                pgs_ids_list = []
-                if 'evaluation' in publication['associated_pgs_ids']:
-                    pgs_ids_list = publication['associated_pgs_ids']['evaluation']
+        # Generate a tar file of the study data
+        pgs_export.generate_tarfile(pub_datadir+pgp_id+'_metadata.tar.gz',datadir)
 
-                if not os.path.isdir(datadir):
-                    try:
-                        os.mkdir(datadir)
-                    except OSError:
-                        print (f'Creation of the directory {datadir} failed')
+        return self.list_export_files(datadir, pub_datadir+pgp_id+'_metadata.tar.gz', pgs_export.bundle)
 
-                if not os.path.isdir(datadir):
-                    print(f'Can\'t create a directory for the metadata ({datadir})')
-                    exit(1)
 
+    def generate_trait_metadata_export(self, efo_id):
+        ''' Generate the PGS metadata export files for a trait (all the Scores mapped to the trait) '''
+        print(f'>> Trait: {efo_id}')
 
-                # Create export object
-                pgs_export = PGSExport(filename, self.data, self.ancestry_categories, True)
-                pgs_export.set_pgs_list(pgs_ids_list)
+        trait_datadir = self.dirpath+'traits_metadata/'
+        if not os.path.isdir(trait_datadir):
+            try:
+                os.makedirs(trait_datadir, exist_ok=True)
+            except OSError:
+                print (f'Creation of the directory {trait_datadir} failed')
 
-                # Build the spreadsheets
-                pgs_export.generate_sheets(csv_prefix)
+        pgs_ids_list = self.data_index.get_trait_score_ids(efo_id)
+        if not pgs_ids_list:
+            print(f'>>>> Warning - traits: no Score mapped to the EFO ID "{efo_id}"!')
+            return
 
-                # Close the Pandas Excel writer and output the Excel file.
-                pgs_export.save()
+        print("\n# Trait "+efo_id)
 
-                # Generate a tar file of the study data
-                pgs_export.generate_tarfile(pub_datadir+pgp_id+'_metadata.tar.gz',datadir)
+        datadir = trait_datadir+efo_id+'/'
+        filename = datadir+efo_id+'_metadata.xlsx'
 
-            if not pgp_id_found:
-                print(f'>>>> Warning - large studies: PGP ID "{pgp_id}" couldn\'t be found!')
+        csv_prefix = datadir+efo_id
 
+        if not os.path.isdir(datadir):
+            try:
+                os.mkdir(datadir)
+            except OSError:
+                print (f'Creation of the directory {datadir} failed')
 
-    def call_generate_studies_metadata_exports(self):
-        ''' Generate PGS metadata export files for each released studies '''
-        print("\t- Generate PGS metadata export files for each released studies")
+        if not os.path.isdir(datadir):
+            print(f'Can\'t create a directory for the metadata ({datadir})')
+            exit(1)
 
-        if self.debug:
-            pgs_ids_list = []
-            for i in range(1,self.debug+1):
-                num = i < 10 and '0'+str(i) or str(i)
-                pgs_ids_list.append('PGS0000'+num)
-        else:
-            pgs_ids_list = [  x['id'] for x in self.data['score'] ]
+        # Create export object (publications of the Scores and of their Performance Metrics)
+        pgs_export = PGSExport(filename, self.data, self.ancestry_categories, data_index=self.data_index, csv_backend=self.csv_backends['trait'], blob_store=self.blob_store, in_memory_bundle=self.in_memory_bundles['trait'])
+        pgs_export.set_pgs_list(pgs_ids_list)
 
-        # Loop over the PGS IDs
-        for pgs_id in pgs_ids_list:
+        # Build the spreadsheets
+        pgs_export.generate_sheets(csv_prefix)
 
-            print("\n# PGS "+pgs_id)
+        # Close the Pandas Excel writer and output the Excel file.
+        pgs_export.save()
 
-            pgs_dir = self.dirpath+pgs_id
-            study_dir = pgs_dir+"/Metadata/"
-            csv_prefix = study_dir+pgs_id
+        # Generate a tar file of the trait data
+        pgs_export.generate_tarfile(trait_datadir+efo_id+'_metadata.tar.gz',datadir)
 
-            # Check / create PGS directory
-            if not os.path.isdir(pgs_dir):
-                try:
-                    os.mkdir(pgs_dir)
-                except OSError:
-                    print ("Creation of the directory %s failed" % pgs_dir)
+        return self.list_export_files(datadir, trait_datadir+efo_id+'_metadata.tar.gz', pgs_export.bundle)
 
-            # Check / create PGS metadata directory
-            if os.path.isdir(pgs_dir) and not os.path.isdir(study_dir):
-                try:
-                    os.mkdir(study_dir)
-                except OSError:
-                    print ("Creation of the directory %s failed" % study_dir)
 
-            if not os.path.isdir(study_dir):
-                print("Can't create a directory for the study "+pgs_id)
-                break
+    def generate_study_metadata_export(self, pgs_id):
+        ''' Generate the PGS metadata export files for a released study '''
+        print("\n# PGS "+pgs_id)
 
-            filename = study_dir+pgs_id+"_metadata.xlsx"
+        pgs_dir = self.dirpath+pgs_id
+        study_dir = pgs_dir+"/Metadata/"
+        csv_prefix = study_dir+pgs_id
 
-            print("FILENAME: "+filename)
+        # Check / create PGS directory
+        if not os.path.isdir(pgs_dir):
+            try:
+                os.mkdir(pgs_dir)
+            except OSError:
+                print ("Creation of the directory %s failed" % pgs_dir)
 
-            # Create export object
-            pgs_export = PGSExport(filename, self.data, self.ancestry_categories)
-            pgs_export.set_pgs_list([pgs_id])
+        # Check / create PGS metadata directory
+        if os.path.isdir(pgs_dir) and not os.path.isdir(study_dir):
+            try:
+                os.mkdir(study_dir)
+            except OSError:
+                print ("Creation of the directory %s failed" % study_dir)
+
+        if not os.path.isdir(study_dir):
+            print("Can't create a directory for the study "+pgs_id)
+            return
+
+        filename = study_dir+pgs_id+"_metadata.xlsx"
+
+        print("FILENAME: "+filename)
+
+        # Create export object
+        pgs_export = PGSExport(filename, self.data, self.ancestry_categories, data_index=self.data_index, csv_backend=self.csv_backends['score'], blob_store=self.blob_store, in_memory_bundle=self.in_memory_bundles['score'])
+        pgs_export.set_pgs_list([pgs_id])
+
+        # Build the spreadsheets
+        pgs_export.generate_sheets(csv_prefix)
+
+        # Close the Pandas Excel writer and output the Excel file.
+        pgs_export.save()
+
+        # Generate a tar file of the study data
+        pgs_export.generate_tarfile(self.dirpath+pgs_id+"_metadata.tar.gz",study_dir)
 
-            # Build the spreadsheets
-            pgs_export.generate_sheets(csv_prefix)
+        return self.list_export_files(study_dir, self.dirpath+pgs_id+"_metadata.tar.gz", pgs_export.bundle)
 
-            # Close the Pandas Excel writer and output the Excel file.
-            pgs_export.save()
 
-            # Generate a tar file of the study data
-            pgs_export.generate_tarfile(self.dirpath+pgs_id+"_metadata.tar.gz",study_dir)
+    def list_export_files(self, datadir, tar_file, bundle=None):
+        ''' List the files generated by an export (files in the export directory, or in its in-memory bundle, and tar file) '''
+        filenames = bundle.get_filenames() if bundle else sorted(os.listdir(datadir))
+        files = [ datadir+x for x in filenames ]
+        files.append(tar_file)
+        return files
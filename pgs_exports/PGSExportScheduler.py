@@ -0,0 +1,141 @@
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+#--------------------------#
+# Class PGSExportScheduler #
+#--------------------------#
+
+class PGSExportScheduler:
+    '''
+    Schedule the export tasks (PGS, large studies and traits exports) on the worker processes, largest first.
+    The cost of each task is estimated from the indexed metadata (number of rows of its export files, see
+    PGSDataIndex.get_scores_export_costs), so the largest exports don't end up running alone at the end.
+    A task is only handed to a worker when it becomes idle (the workers take the next task from a shared list), and only
+    if its estimated memory fits in the memory budget of a worker (a smaller task is started instead). A task exceeding
+    the budget is run alone, once the tasks in progress are completed.
+    The utilization of the workers is reported at the end.
+    '''
+
+    # Fixed cost of an export (Excel file, tar file), as a number of rows
+    task_base_cost = 50
+
+    # Estimated memory used per exported row (bytes)
+    row_memory = 4096
+
+    def __init__(self, workers, memory_budget=None):
+        '''
+        > Variables:
+            - workers: number of worker processes
+            - memory_budget: memory (bytes) available per worker for the exports in progress (no limit if not set)
+        '''
+        self.workers = workers
+        self.memory_budget = memory_budget
+        self.durations = {}
+        self.duration = 0
+        self.idle_time = 0
+
+
+    def get_tasks_costs(self, tasks, data_index):
+        '''
+        Estimate the cost of each export task
+        > Parameters:
+            - tasks: list of tuples (method name, PGS/PGP/EFO ID)
+            - data_index: index of the metadata (PGSDataIndex)
+        > Return type: dictionary task => cost
+        '''
+        scores_costs = data_index.get_scores_export_costs()
+        costs = {}
+        for task in tasks:
+            method_name, export_id = task
+            if method_name == 'generate_large_study_metadata_export':
+                rows = sum([ scores_costs.get(x, 0) for x in data_index.get_publication_evaluated_score_ids(export_id) ])
+            elif method_name == 'generate_trait_metadata_export':
+                rows = sum([ scores_costs.get(x, 0) for x in data_index.get_trait_score_ids(export_id) ])
+            else:
+                rows = scores_costs.get(export_id, 0)
+            costs[task] = self.task_base_cost + rows
+        return costs
+
+
+    def get_task_memory(self, cost):
+        ''' Estimated memory used by an export task '''
+        return cost * self.row_memory
+
+
+    def get_next_task(self, pending_tasks, costs, running_memories):
+        '''
+        Return the position of the next task to start in the list of pending tasks (sorted by decreasing cost):
+        the largest one fitting in the memory budget of a worker, or None if none fits (the first one if no task is in progress)
+        > Parameters:
+            - pending_tasks: list of the tasks to start
+            - costs: estimated cost of each task (see get_tasks_costs)
+            - running_memories: estimated memory of each task in progress
+        '''
+        if not self.memory_budget or not running_memories:
+            return 0
+        # A task exceeding the budget runs alone
+        if max(running_memories) > self.memory_budget:
+            return None
+        for position, task in enumerate(pending_tasks):
+            if self.get_task_memory(costs[task]) <= self.memory_budget:
+                return position
+        return None
+
+
+    def run(self, executor, function, tasks, costs, on_complete, on_start=None):
+        '''
+        Run the tasks on the executor, largest first
+        > Parameters:
+            - executor: pool of worker processes (concurrent.futures executor)
+            - function: function running a task in a worker
+            - tasks: list of tasks
+            - costs: estimated cost of each task (see get_tasks_costs)
+            - on_complete: function called with each task and its result, as they are completed
+            - on_start: function called once the first tasks are started
+        '''
+        pending_tasks = sorted(tasks, key=lambda x: costs[x], reverse=True)
+        running = {}
+        start = time.perf_counter()
+        last_dispatch_time = None
+        while pending_tasks or running:
+            # Idle workers take the next tasks
+            while pending_tasks and len(running) < self.workers:
+                position = self.get_next_task(pending_tasks, costs, [ x[1] for x in running.values() ])
+                if position is None:
+                    break
+                task = pending_tasks.pop(position)
+                memory = self.get_task_memory(costs[task])
+                running[executor.submit(function, task)] = (task, memory, time.perf_counter())
+                if not pending_tasks:
+                    last_dispatch_time = time.perf_counter()
+            if on_start:
+                on_start()
+                on_start = None
+
+            done, not_done = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                task, memory, task_start = running.pop(future)
+                self.durations[task] = time.perf_counter() - task_start
+                on_complete(task, future.result())
+
+        end = time.perf_counter()
+        self.duration = end - start
+        # Time spent with idle workers at the end, once all the tasks have been started
+        self.idle_time = end - last_dispatch_time if last_dispatch_time else 0
+
+
+    def get_utilization(self):
+        ''' Fraction of the time the workers have been busy '''
+        if not self.duration:
+            return 0
+        return sum(self.durations.values()) / (self.duration * self.workers)
+
+
+    def report(self, costs):
+        ''' Print the utilization of the workers and the largest task '''
+        if not self.durations:
+            return
+        largest_task = max(self.durations.keys(), key=lambda x: costs[x])
+        print(f'\t> Scheduler: {len(self.durations)} export(s) on {self.workers} workers in {self.duration:.2f}s - utilization: {100*self.get_utilization():.0f}% '
+              f'(last export started {self.idle_time:.2f}s before the end) - largest export: {largest_task[1]} (cost {costs[largest_task]}, {self.durations[largest_task]:.2f}s)')
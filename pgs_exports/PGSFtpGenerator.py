@@ -1,8 +1,11 @@
 import sys, os, glob
 import re
+import queue
 import shutil
 import tarfile
+import threading
 from pgs_exports.PGSBuildFtp import PGSBuildFtp, PGSBuildFtpRemote
+from pgs_exports.PGSFtpPlan import PGSFtpPlan
 
 
 #------------------------#
@@ -12,7 +15,19 @@ from pgs_exports.PGSBuildFtp import PGSBuildFtp, PGSBuildFtpRemote
 class PGSFtpGenerator:
     ''' Generate the PGS FTP structure with metadata files. '''
 
-    def __init__(self,dirpath,dirpath_new,scores_id_list,large_publication_ids_list,previous_release,use_remote_ftp,debug):
+    # Streaming pipeline: number of threads building the FTP structure of the exported entries, and maximum number of
+    # exported entries waiting in the queue (the exports are paused when the queue is full)
+    pipeline_workers = 4
+    pipeline_queue_size = 64
+
+    # Directory of the metadata files of each type of entry on the FTP (relative to the FTP root)
+    entries_ftp_dirs = {
+        'score': 'scores/{}/Metadata/',
+        'publication': 'metadata/publications/{}/',
+        'trait': 'metadata/traits/{}/'
+    }
+
+    def __init__(self,dirpath,dirpath_new,scores_id_list,large_publication_ids_list,previous_release,use_remote_ftp,debug,ftp_listing_file=None,release_manifest=None,archive_by_reference=False,trait_ids_list=None):
         '''
         > Variables:
             - dirpath: path to the directory where the metadata files will be stored
@@ -22,6 +37,11 @@ class PGSFtpGenerator:
             - previous_release: date of the previous release
             - use_remote_ftp: flag to indicate if the FTP can be accessed locally of via FTP protocol
             - debug: parameter to test the script (default:0 => non debug mode)
+            - ftp_listing_file: path to the listing of the FTP files (built from the FTP if the file doesn't exist)
+            - release_manifest: manifest of the release (PGSReleaseManifest), computing the checksums of the files as they are copied
+            - archive_by_reference: flag to hardlink the archives of the previous release from the FTP (local FTP) and from the temporary
+              archive directory, instead of copying them (copied if the hardlink can't be created, e.g. different file systems)
+            - trait_ids_list: list of the EFO IDs that have specific metadata files (traits)
         '''
         self.dirpath = dirpath
         self.dirpath_new = dirpath_new
@@ -30,7 +50,195 @@ class PGSFtpGenerator:
         self.previous_release = previous_release
         self.use_remote_ftp = use_remote_ftp
         self.debug = debug
+        self.ftp_listing_file = ftp_listing_file
+        self.release_manifest = release_manifest
+        self.archive_by_reference = archive_by_reference
+        self.trait_ids_list = trait_ids_list if trait_ids_list else []
         self.scores_file = dirpath_new+'/pgs_scores_list.txt'
+        self.plan = None
+        self.ftp_listing = None
+        self.pipeline_queue = None
+        self.pipeline_threads = []
+        self.pipeline_errors = []
+
+
+    def get_pgs_ftp(self, id, type):
+        ''' Return the object fetching the files of a PGS/PGP/EFO ID from the FTP '''
+        if self.use_remote_ftp:
+            return PGSBuildFtpRemote(id, '_metadata.xlsx', type)
+        return PGSBuildFtp(id, '_metadata.xlsx', type)
+
+
+
+    #================#
+    #  Build plan    #
+    #================#
+
+    def get_plan(self):
+        ''' Return the plan of the FTP build (computed once, see build_plan) '''
+        if self.plan is None:
+            self.plan = self.build_plan()
+        return self.plan
+
+
+    def get_pgs_ftp_class(self):
+        ''' Return the class fetching the files from the FTP (local or remote) '''
+        return PGSBuildFtpRemote if self.use_remote_ftp else PGSBuildFtp
+
+
+    def get_ftp_listing(self):
+        ''' Return the listing of the FTP files (read or built once, see PGSBuildFtp.get_ftp_listing) '''
+        if self.ftp_listing is None:
+            self.ftp_listing = self.get_pgs_ftp_class().get_ftp_listing(self.ftp_listing_file)
+        return self.ftp_listing
+
+
+    def build_plan(self):
+        '''
+        Classify each PGS, PGP and EFO ID as new, changed, unchanged or removed, comparing the export files with
+        the listing of the FTP (see PGSFtpListing). No file is copied, extracted or downloaded.
+        > Return type: PGSFtpPlan object
+        '''
+        plan = PGSFtpPlan()
+
+        # Scores
+        for pgs_id in self.get_debug_ids_list(self.scores_id_list):
+            self.add_exported_plan_entry(plan, 'score', pgs_id)
+
+        # Large studies
+        for pgp_id in self.get_debug_ids_list(self.large_publication_ids_list):
+            self.add_exported_plan_entry(plan, 'publication', pgp_id)
+
+        # Traits
+        for efo_id in self.trait_ids_list:
+            self.add_exported_plan_entry(plan, 'trait', efo_id)
+
+        self.complete_plan(plan)
+        return plan
+
+
+    def add_exported_plan_entry(self, plan, type, id):
+        ''' Add the entry of an exported Score ('score'), large study ('publication') or trait ('trait') to the plan '''
+        targz_ext = self.get_pgs_ftp_class().meta_file_extension
+        if type == 'score':
+            temp_meta_dir = self.dirpath+'/'+id+'/Metadata/'
+            self.add_plan_entry(plan, self.get_ftp_listing(), type, id, temp_meta_dir, self.dirpath+id+'_metadata'+targz_ext, self.entries_ftp_dirs[type].format(id))
+        elif type == 'publication':
+            temp_data_dir = self.dirpath+'/publications_metadata/'
+            self.add_plan_entry(plan, self.get_ftp_listing(), type, id, temp_data_dir+'/'+id+'/', temp_data_dir+id+'_metadata'+targz_ext, self.entries_ftp_dirs[type].format(id))
+        else:
+            temp_data_dir = self.dirpath+'/traits_metadata/'
+            self.add_plan_entry(plan, self.get_ftp_listing(), type, id, temp_data_dir+'/'+id+'/', temp_data_dir+id+'_metadata'+targz_ext, self.entries_ftp_dirs[type].format(id))
+        return plan.entries[type][id]
+
+
+    def complete_plan(self, plan):
+        ''' Add the removed entries and the all metadata entry to the plan, once all the Scores, large studies and traits are planned '''
+        pgs_ftp_class = self.get_pgs_ftp_class()
+        ftp_listing = self.get_ftp_listing()
+        targz_ext = pgs_ftp_class.meta_file_extension
+
+        # Entries on the FTP which are not exported anymore
+        if not self.debug:
+            ftp_dirs_patterns = {
+                'score': re.compile(r'^scores/(PGS\d+)/Metadata/\1_metadata.xlsx$'),
+                'publication': re.compile(r'^metadata/publications/(PGP\d+)/\1_metadata.xlsx$'),
+                'trait': re.compile(r'^metadata/traits/([^/]+)/\1_metadata.xlsx$')
+            }
+            for type, ftp_dir_pattern in ftp_dirs_patterns.items():
+                for filepath in ftp_listing:
+                    m = ftp_dir_pattern.match(filepath)
+                    if m and m.group(1) not in plan.entries[type]:
+                        plan.add_entry(type, m.group(1), 'removed')
+
+        # All metadata (always copied, with the previous release archived)
+        all_meta_file = pgs_ftp_class.all_meta_file
+        files = self.get_export_files(self.dirpath+'all_metadata/', all_meta_file.replace(targz_ext, '.xlsx'), self.dirpath+all_meta_file, all_meta_file)
+        ftp_xls = 'metadata/'+all_meta_file.replace(targz_ext, '.xlsx')
+        ftp_tar = 'metadata/'+all_meta_file
+        status = 'unchanged'
+        if ftp_xls not in ftp_listing:
+            status = 'new'
+        elif ftp_listing.is_different(ftp_xls, files[0][0], PGSBuildFtp.get_md5_checksum):
+            status = 'changed'
+        plan.add_entry('all', 'all', status, files, ftp_tar, ftp_listing.get_size(ftp_tar), ftp_tar in ftp_listing)
+
+        # The checksums computed for the plan are saved with the listing
+        if self.ftp_listing_file:
+            ftp_listing.write(self.ftp_listing_file)
+
+
+    def add_plan_entry(self, plan, ftp_listing, type, id, temp_meta_dir, temp_tar_file, ftp_dir):
+        '''
+        Compare the export files of a PGS/PGP/EFO ID with the FTP ones and add the corresponding entry to the plan
+        > Parameters:
+            - plan: PGSFtpPlan object
+            - ftp_listing: listing of the FTP files (PGSFtpListing)
+            - type: type of the entry ('score', 'publication' or 'trait')
+            - id: PGS, PGP or EFO ID
+            - temp_meta_dir: directory of the exported metadata files
+            - temp_tar_file: exported archive of the metadata files
+            - ftp_dir: directory of the metadata files on the FTP (relative to the FTP root)
+        '''
+        meta_file_xls = id+'_metadata.xlsx'
+        meta_file_tar = os.path.basename(temp_tar_file)
+        files = self.get_export_files(temp_meta_dir, meta_file_xls, temp_tar_file, meta_file_tar)
+
+        # New entry (directory doesn't exist on the FTP)
+        if ftp_dir+meta_file_xls not in ftp_listing:
+            plan.add_entry(type, id, 'new', files)
+        # Unchanged entry: nothing to copy
+        elif not ftp_listing.is_different(ftp_dir+meta_file_xls, temp_meta_dir+meta_file_xls, PGSBuildFtp.get_md5_checksum):
+            plan.add_entry(type, id, 'unchanged')
+        # Updated metadata: the FTP archive is archived if the CSV files are different (files of different sizes are not hashed)
+        else:
+            ftp_csv_files = [ x for x in ftp_listing.get_dir_files(ftp_dir) if x.endswith('.csv') ]
+            archive = None
+            if ftp_csv_files:
+                archive = False
+                for source, filename, size in files:
+                    if filename.endswith('.csv') and ftp_listing.is_different(ftp_dir+filename, source, PGSBuildFtp.get_md5_checksum):
+                        archive = True
+                        break
+            plan.add_entry(type, id, 'changed', files, ftp_dir+meta_file_tar, ftp_listing.get_size(ftp_dir+meta_file_tar), archive)
+
+
+    def get_removed_files(self):
+        '''
+        List the FTP files of the entries removed from the release (see the plan), to delete from the FTP (e.g. delta archive).
+        Only the files directly in the directory of each entry are listed: the archives of the previous releases are kept.
+        > Return type: sorted list of file paths, relative to the FTP root
+        '''
+        plan = self.get_plan()
+        ftp_listing = self.get_ftp_listing()
+        removed_files = []
+        for type, ftp_dir_pattern in self.entries_ftp_dirs.items():
+            for id in plan.get_ids(type, 'removed'):
+                ftp_dir = ftp_dir_pattern.format(id)
+                removed_files += [ ftp_dir+x for x in ftp_listing.get_dir_files(ftp_dir) ]
+        return sorted(removed_files)
+
+
+    def get_export_files(self, temp_meta_dir, meta_file_xls, temp_tar_file, meta_file_tar):
+        ''' List the export files of an entry to copy to the FTP, as tuples (source path, file name, size) '''
+        files = [ (temp_meta_dir+meta_file_xls, meta_file_xls), (temp_tar_file, meta_file_tar) ]
+        for file in sorted(glob.glob(temp_meta_dir+'*.csv')):
+            files.append((file, os.path.basename(file)))
+        return [ (source, filename, os.path.getsize(source)) for source, filename in files ]
+
+
+    def get_debug_ids_list(self, ids_list):
+        ''' Return the list of IDs to process (in debug mode, only the IDs up to the debug number) '''
+        if not self.debug:
+            return ids_list
+        debug_ids_list = []
+        p = re.compile(r'PG[SP]0+(\d+)$')
+        for id in ids_list:
+            m = p.match(id)
+            if m and int(m.group(1)) > self.debug:
+                break
+            debug_ids_list.append(id)
+        return debug_ids_list
 
 
 
@@ -41,12 +249,17 @@ class PGSFtpGenerator:
     def build_metadata_ftp(self):
         ''' Generates PGS specific metadata files (PGS by PGS) '''
         print("\t- Generates PGS specific metadata files (PGS by PGS)")
-        temp_data_dir = self.dirpath
-        temp_ftp_dir  = self.dirpath_new+'/scores/'
+        self.prepare_metadata_ftp()
 
-        # Prepare the temporary FTP directory to copy/download all the PGS Scores
+        # Add metadata for each PGS Score, following the plan
+        for entry in self.get_plan().get_entries('score', ['new','changed','unchanged']):
+            self.build_score_ftp(entry)
+
+
+    def prepare_metadata_ftp(self):
+        ''' Prepare the temporary FTP directory of the PGS Scores and the temporary archive directory '''
         self.create_pgs_directory(self.dirpath_new)
-        self.create_pgs_directory(temp_ftp_dir)
+        self.create_pgs_directory(self.dirpath_new+'/scores/')
 
         # Create temporary archive directory
         tmp_archive = self.dirpath+'/pgs_archives/'
@@ -54,147 +267,70 @@ class PGSFtpGenerator:
             shutil.rmtree(tmp_archive,ignore_errors=True)
         self.create_pgs_directory(tmp_archive)
 
-        # 1 - Add metadata for each PGS Score
-        for pgs_id in self.scores_id_list:
 
-            # For test only
-            if self.debug:
-                p = re.compile(r'PGS0+(\d+)$')
-                m = p.match(pgs_id)
-                pgs_num = m.group(1)
-                if pgs_num and int(pgs_num) > self.debug:
-                    break
+    def build_score_ftp(self, entry):
+        ''' Build the FTP structure of a PGS Score entry of the plan '''
+        pgs_id = entry['id']
 
-            file_suffix = '_metadata.xlsx'
-            if self.use_remote_ftp:
-                pgs_ftp = PGSBuildFtpRemote(pgs_id, file_suffix, 'metadata')
-            else:
-                pgs_ftp = PGSBuildFtp(pgs_id, file_suffix, 'metadata')
+        # Build temporary FTP structure for the PGS Metadata
+        pgs_main_dir = self.dirpath_new+'/scores/'+pgs_id
+        self.create_pgs_directory(pgs_main_dir)
+        meta_file_dir = pgs_main_dir+'/Metadata/'
+        self.create_pgs_directory(meta_file_dir)
 
-            targz_ext = pgs_ftp.meta_file_extension
-            meta_file_tar = pgs_id+'_metadata'+targz_ext
-            meta_file_xls = pgs_id+file_suffix
-
-            # Build temporary FTP structure for the PGS Metadata
-            pgs_main_dir = temp_ftp_dir+pgs_id
-            self.create_pgs_directory(pgs_main_dir)
-            meta_file_dir = pgs_main_dir+'/Metadata/'
-            self.create_pgs_directory(meta_file_dir)
-
-            temp_meta_dir = temp_data_dir+"/"+pgs_ftp.pgs_id+"/Metadata/"
-
-            # 2 - Compare metadata files
-            new_file_md5_checksum = pgs_ftp.get_md5_checksum(temp_meta_dir+meta_file_xls)
-            ftp_file_md5_checksum = pgs_ftp.get_ftp_md5_checksum()
-
-            # 2 a) - New published Score (PGS directory doesn't exist)
-            if not ftp_file_md5_checksum:
-                # Copy new files
-                shutil.copy2(temp_meta_dir+meta_file_xls, meta_file_dir+meta_file_xls)
-                shutil.copy2(temp_data_dir+meta_file_tar, meta_file_dir+meta_file_tar)
-                for file in glob.glob(temp_meta_dir+'*.csv'):
-                    csv_filepath = file.split('/')
-                    filename = csv_filepath[-1]
-                    shutil.copy2(file, meta_file_dir+filename)
-
-            # 2 b) - PGS directory exist (Updated Metadata)
-            elif new_file_md5_checksum != ftp_file_md5_checksum:
-                # Fetch and Copy tar file from FTP
-                meta_archives_path = tmp_archive+pgs_id+'_metadata'
-                meta_archives_file_tar = pgs_id+'_metadata_'+self.previous_release+targz_ext
-                meta_archives_file = tmp_archive+'/'+meta_archives_file_tar
-                # Fetch and Copy tar file to the archive
-                pgs_ftp.get_ftp_file(meta_file_tar,meta_archives_file)
-
-                if meta_archives_file.endswith(targz_ext):
-                    tar = tarfile.open(meta_archives_file, 'r')
-                    tar.extractall(meta_archives_path)
-                    tar.close()
-                else:
-                    print("Error: can't extract the file '"+meta_archives_file+"'!")
-                    exit(1)
-
-                # Copy CSV files and compare them with the FTP ones
-                has_difference = False
-                for csv_file in glob.glob(temp_meta_dir+'*.csv'):
-                    csv_filepath = csv_file.split('/')
-                    filename = csv_filepath[-1]
-                    # Copy CSV file to the metadata directory
-                    shutil.copy2(csv_file, meta_file_dir+filename)
-
-                    # Compare CSV files
-                    ftp_csv_file = meta_archives_path+'/'+filename
-                    if os.path.exists(ftp_csv_file):
-                        new_csv = pgs_ftp.get_md5_checksum(csv_file)
-                        ftp_csv = pgs_ftp.get_md5_checksum(ftp_csv_file)
-                        if new_csv != ftp_csv:
-                            has_difference = True
-                    else:
-                        has_difference = True
-
-                # Copy other new files
-                shutil.copy2(temp_meta_dir+meta_file_xls, meta_file_dir+meta_file_xls)
-                shutil.copy2(temp_data_dir+meta_file_tar, meta_file_dir+meta_file_tar)
-
-                # Archive metadata from previous release
-                if has_difference:
-                    meta_archives = meta_file_dir+'archived_versions/'
-                    self.create_pgs_directory(meta_archives)
-                    # Copy tar file to the archive
-                    shutil.copy2(meta_archives_file, meta_archives+meta_archives_file_tar)
+        self.build_entry_ftp(self.get_pgs_ftp(pgs_id, 'metadata'), entry, meta_file_dir, self.dirpath+'/pgs_archives/')
 
 
     def build_bulk_metadata_ftp(self):
         ''' Generates the global metadata files (the ones containing all the PGS metadata) '''
         print("\t- Generates the global metadata files (the ones containing all the PGS metadata)")
 
-        temp_data_dir = self.dirpath
         temp_ftp_dir = self.dirpath_new+'/metadata/'
 
         # Prepare the temporary FTP directory to copy/download all the PGS Scores
         self.create_pgs_directory(self.dirpath_new)
         self.create_pgs_directory(temp_ftp_dir)
 
-        if self.use_remote_ftp:
-            pgs_ftp = PGSBuildFtpRemote('all', '', 'metadata')
-        else:
-            pgs_ftp = PGSBuildFtp('all', '', 'metadata')
+        pgs_ftp = self.get_pgs_ftp('all', 'metadata')
+        entry = self.get_plan().entries['all']['all']
 
         targz_ext = pgs_ftp.meta_file_extension
         meta_file = pgs_ftp.all_meta_file
-        meta_file_xls = meta_file.replace(targz_ext, '.xlsx')
 
         # Copy new metadata
-        shutil.copy2(temp_data_dir+meta_file, temp_ftp_dir+meta_file)
-        shutil.copy2(temp_data_dir+'all_metadata/'+meta_file_xls, temp_ftp_dir+meta_file_xls)
-
-        for file in glob.glob(temp_data_dir+'all_metadata/*.csv'):
-            csv_filepath = file.split('/')
-            filename = csv_filepath[-1]
-            shutil.copy2(file, temp_ftp_dir+filename)
+        for source, filename, size in entry['files']:
+            self.copy_file(source, temp_ftp_dir+filename)
 
         # Archiving metadata from previous release
-        meta_archives_file = meta_file.replace(targz_ext, '_'+self.previous_release+targz_ext)
+        if entry['archive']:
+            meta_archives_file = meta_file.replace(targz_ext, '_'+self.previous_release+targz_ext)
 
-        meta_archives_dir = temp_ftp_dir+'previous_releases/'
-        self.create_pgs_directory(meta_archives_dir)
+            meta_archives_dir = temp_ftp_dir+'previous_releases/'
+            self.create_pgs_directory(meta_archives_dir)
 
-        previous_release_date = self.previous_release.split('-')
-        meta_year_archives_dir = meta_archives_dir+previous_release_date[0]+'/'
-        self.create_pgs_directory(meta_year_archives_dir)
+            previous_release_date = self.previous_release.split('-')
+            meta_year_archives_dir = meta_archives_dir+previous_release_date[0]+'/'
+            self.create_pgs_directory(meta_year_archives_dir)
 
-        pgs_ftp.get_ftp_file(meta_file,meta_year_archives_dir+meta_archives_file)
+            pgs_ftp.get_ftp_file(meta_file,meta_year_archives_dir+meta_archives_file,self.archive_by_reference)
+            self.add_to_manifest(meta_year_archives_dir+meta_archives_file)
 
 
     def build_large_study_metadata_ftp(self):
         ''' Generates the large study metadata files (the ones containing the PGS metadata for the large studies) '''
         print("\t- Generates the large study metadata files (the ones containing the PGS metadata for the large studies)")
+        self.prepare_large_study_metadata_ftp()
 
-        temp_data_dir = self.dirpath+'/publications_metadata/'
-        temp_ftp_dir = self.dirpath_new+'/metadata/publications/'
+        # Add metadata for each PGS Study, following the plan
+        for entry in self.get_plan().get_entries('publication', ['new','changed','unchanged']):
+            self.build_large_study_ftp(entry)
 
-        # Prepare the temporary FTP directory to copy/download all the PGS Scores
-        self.create_pgs_directory(temp_ftp_dir)
+
+    def prepare_large_study_metadata_ftp(self):
+        ''' Prepare the temporary FTP directory of the large studies and the temporary archive directory '''
+        self.create_pgs_directory(self.dirpath_new)
+        self.create_pgs_directory(self.dirpath_new+'/metadata/')
+        self.create_pgs_directory(self.dirpath_new+'/metadata/publications/')
 
         # Create temporary archive directory
         tmp_archive = self.dirpath+'/publication_archives/'
@@ -202,92 +338,184 @@ class PGSFtpGenerator:
             shutil.rmtree(tmp_archive,ignore_errors=True)
         self.create_pgs_directory(tmp_archive)
 
-        # 1 - Add metadata for each PGS Study
-        for pgp_id in self.large_publication_ids_list:
 
-            # For test only
-            if self.debug:
-                p = re.compile(r'PGP0+(\d+)$')
-                m = p.match(pgp_id)
-                pgp_num = m.group(1)
-                if pgp_num and int(pgp_num) > self.debug:
-                    break
+    def build_large_study_ftp(self, entry):
+        ''' Build the FTP structure of a large study entry of the plan '''
+        pgp_id = entry['id']
+
+        # Build temporary FTP structure for the PGS Metadata
+        pgp_ftp_dir = self.dirpath_new+'/metadata/publications/'+pgp_id+'/'
+        self.create_pgs_directory(pgp_ftp_dir)
+
+        self.build_entry_ftp(self.get_pgs_ftp(pgp_id, 'publication'), entry, pgp_ftp_dir, self.dirpath+'/publication_archives/')
+
+
+    def build_trait_metadata_ftp(self):
+        ''' Generates the trait metadata files (the ones containing the PGS metadata of all the Scores mapped to a trait) '''
+        print("\t- Generates the trait metadata files (the ones containing the PGS metadata of all the Scores mapped to a trait)")
+        self.prepare_trait_metadata_ftp()
+
+        # Add metadata for each trait, following the plan
+        for entry in self.get_plan().get_entries('trait', ['new','changed','unchanged']):
+            self.build_trait_ftp(entry)
+
+
+    def prepare_trait_metadata_ftp(self):
+        ''' Prepare the temporary FTP directory of the traits and the temporary archive directory '''
+        self.create_pgs_directory(self.dirpath_new)
+        self.create_pgs_directory(self.dirpath_new+'/metadata/')
+        self.create_pgs_directory(self.dirpath_new+'/metadata/traits/')
+
+        # Create temporary archive directory
+        tmp_archive = self.dirpath+'/trait_archives/'
+        if os.path.isdir(tmp_archive):
+            shutil.rmtree(tmp_archive,ignore_errors=True)
+        self.create_pgs_directory(tmp_archive)
+
+
+    def build_trait_ftp(self, entry):
+        ''' Build the FTP structure of a trait entry of the plan '''
+        efo_id = entry['id']
+
+        # Build temporary FTP structure for the PGS Metadata
+        trait_ftp_dir = self.dirpath_new+'/metadata/traits/'+efo_id+'/'
+        self.create_pgs_directory(trait_ftp_dir)
+
+        self.build_entry_ftp(self.get_pgs_ftp(efo_id, 'trait'), entry, trait_ftp_dir, self.dirpath+'/trait_archives/')
+
 
-            file_suffix = '_metadata.xlsx'
-            if self.use_remote_ftp:
-                pgs_ftp = PGSBuildFtpRemote(pgp_id, file_suffix, 'publication')
-            else:
-                pgs_ftp = PGSBuildFtp(pgp_id, file_suffix, 'publication')
+    def build_entry_ftp(self, pgs_ftp, entry, ftp_entry_dir, tmp_archive):
+        '''
+        Copy the files of a new or changed entry of the plan and archive the metadata from the previous release
+        > Parameters:
+            - pgs_ftp: PGSBuildFtp object of the entry
+            - entry: entry of the plan (see PGSFtpPlan)
+            - ftp_entry_dir: directory of the entry in the new FTP structure
+            - tmp_archive: temporary directory where the FTP archive is downloaded
+        '''
+        if entry['status'] not in ('new', 'changed'):
+            return
 
+        # Copy the new files
+        for source, filename, size in entry['files']:
+            self.copy_file(source, ftp_entry_dir+filename)
+
+        # Archive metadata from previous release
+        if entry['status'] == 'changed' and entry['archive'] is not False:
             targz_ext = pgs_ftp.meta_file_extension
-            meta_file_tar = pgp_id+'_metadata'+targz_ext
-            meta_file_xls = meta_file_tar.replace(targz_ext, '.xlsx')
-
-            # Build temporary FTP structure for the PGS Metadata
-            pgp_ftp_dir = temp_ftp_dir+pgp_id+'/'
-            self.create_pgs_directory(pgp_ftp_dir)
-
-            temp_meta_dir = temp_data_dir+'/'+pgp_id+'/'
-
-            # 2 - Compare metadata files
-            new_file_md5_checksum = pgs_ftp.get_md5_checksum(temp_meta_dir+meta_file_xls)
-            ftp_file_md5_checksum = pgs_ftp.get_ftp_md5_checksum()
-
-            # 2 a) - New large publication (PGP directory doesn't exist)
-            if not ftp_file_md5_checksum:
-                # Copy new files
-                shutil.copy2(temp_meta_dir+meta_file_xls, pgp_ftp_dir+meta_file_xls)
-                shutil.copy2(temp_data_dir+meta_file_tar, pgp_ftp_dir+meta_file_tar)
-                for file in glob.glob(temp_meta_dir+'*.csv'):
-                    csv_filepath = file.split('/')
-                    filename = csv_filepath[-1]
-                    shutil.copy2(file, pgp_ftp_dir+filename)
-
-            # 2 b) - PGP directory exist (Updated Metadata)
-            elif new_file_md5_checksum != ftp_file_md5_checksum:
-                # Fetch and Copy tar file from FTP
-                meta_archives_path = tmp_archive+'/'+pgp_id+'_metadata'
-                meta_archives_file_tar = pgp_id+'_metadata_'+self.previous_release+targz_ext
-                meta_archives_file = tmp_archive+'/'+meta_archives_file_tar
-                # Fetch and Copy tar file to the archive
-                pgs_ftp.get_ftp_file(meta_file_tar,meta_archives_file)
-
-                if meta_archives_file.endswith(targz_ext):
-                    tar = tarfile.open(meta_archives_file, 'r')
-                    tar.extractall(meta_archives_path)
-                    tar.close()
+            meta_file_tar = pgs_ftp.pgs_id+'_metadata'+targz_ext
+            meta_archives_file_tar = pgs_ftp.pgs_id+'_metadata_'+self.previous_release+targz_ext
+            meta_archives_file = tmp_archive+meta_archives_file_tar
+            # Fetch and Copy tar file from FTP
+            pgs_ftp.get_ftp_file(meta_file_tar,meta_archives_file,self.archive_by_reference)
+
+            has_difference = entry['archive']
+            # The CSV files are not listed on the FTP: compare them with the ones from the FTP archive
+            if has_difference is None:
+                has_difference = self.compare_archived_csv_files(pgs_ftp, entry, meta_archives_file, tmp_archive+pgs_ftp.pgs_id+'_metadata')
+
+            if has_difference:
+                meta_archives = ftp_entry_dir+'archived_versions/'
+                self.create_pgs_directory(meta_archives)
+                # Copy tar file to the archive
+                self.copy_file(meta_archives_file, meta_archives+meta_archives_file_tar, self.archive_by_reference)
+
+
+    #======================#
+    #  Streaming pipeline  #
+    #======================#
+
+    def start_pipeline(self):
+        '''
+        Start the threads building the FTP structure of the Scores, large studies and traits as soon as they are exported
+        (instead of waiting for all the exports): each exported entry put in the returned queue, as a tuple (type, ID),
+        is planned and copied right away. The plan is completed by finish_pipeline.
+        > Return type: bounded queue of the exported entries (queue.Queue)
+        '''
+        self.plan = PGSFtpPlan()
+        self.get_ftp_listing()
+        self.prepare_metadata_ftp()
+        self.prepare_large_study_metadata_ftp()
+        if self.trait_ids_list:
+            self.prepare_trait_metadata_ftp()
+        self.pipeline_queue = queue.Queue(maxsize=self.pipeline_queue_size)
+        self.pipeline_errors = []
+        self.pipeline_threads = [ threading.Thread(target=self.run_pipeline_worker, daemon=True) for x in range(self.pipeline_workers) ]
+        for thread in self.pipeline_threads:
+            thread.start()
+        return self.pipeline_queue
+
+
+    def run_pipeline_worker(self):
+        ''' Plan and build the FTP structure of the exported entries taken from the queue, until the end of the exports '''
+        while True:
+            item = self.pipeline_queue.get()
+            if item is None:
+                break
+            type, id = item
+            try:
+                if self.pipeline_errors or not self.get_debug_ids_list([id]):
+                    continue
+                entry = self.add_exported_plan_entry(self.plan, type, id)
+                if type == 'score':
+                    self.build_score_ftp(entry)
+                elif type == 'publication':
+                    self.build_large_study_ftp(entry)
                 else:
-                    print("Error: can't extract the file '"+meta_archives_file+"'!")
-                    exit(1)
-
-                # Copy CSV files and compare them with the FTP ones
-                has_difference = False
-                for csv_file in glob.glob(temp_meta_dir+'*.csv'):
-                    csv_filepath = csv_file.split('/')
-                    filename = csv_filepath[-1]
-                    # Copy CSV file to the metadata directory
-                    shutil.copy2(csv_file, pgp_ftp_dir+filename)
-
-                    # Compare CSV files
-                    ftp_csv_file = meta_archives_path+'/'+filename
-                    if os.path.exists(ftp_csv_file):
-                        new_csv = pgs_ftp.get_md5_checksum(csv_file)
-                        ftp_csv = pgs_ftp.get_md5_checksum(ftp_csv_file)
-                        if new_csv != ftp_csv:
-                            has_difference = True
-                    else:
-                        has_difference = True
-
-                # Copy other new files
-                shutil.copy2(temp_meta_dir+meta_file_xls, pgp_ftp_dir+meta_file_xls)
-                shutil.copy2(temp_data_dir+meta_file_tar, pgp_ftp_dir+meta_file_tar)
-
-                # Archive metadata from previous release
-                if has_difference:
-                    meta_archives = pgp_ftp_dir+'archived_versions/'
-                    self.create_pgs_directory(meta_archives)
-                    # Copy tar file to the archive
-                    shutil.copy2(meta_archives_file, meta_archives+meta_archives_file_tar)
+                    self.build_trait_ftp(entry)
+            except BaseException as e:
+                self.pipeline_errors.append(e)
+
+
+    def finish_pipeline(self):
+        '''
+        Wait for the FTP structure of all the exported entries and complete the plan (removed entries and all metadata)
+        > Return type: PGSFtpPlan object
+        '''
+        for thread in self.pipeline_threads:
+            self.pipeline_queue.put(None)
+        for thread in self.pipeline_threads:
+            thread.join()
+        self.pipeline_threads = []
+        self.pipeline_queue = None
+        if self.pipeline_errors:
+            raise self.pipeline_errors[0]
+        self.complete_plan(self.plan)
+        return self.plan
+
+
+    def compare_archived_csv_files(self, pgs_ftp, entry, meta_archives_file, meta_archives_path):
+        ''' Extract the FTP archive of an entry and check whether its CSV files are different from the new ones '''
+        if meta_archives_file.endswith(pgs_ftp.meta_file_extension):
+            tar = tarfile.open(meta_archives_file, 'r')
+            tar.extractall(meta_archives_path)
+            tar.close()
+        else:
+            print("Error: can't extract the file '"+meta_archives_file+"'!")
+            exit(1)
+
+        for csv_file, filename, size in entry['files']:
+            if not filename.endswith('.csv'):
+                continue
+            ftp_csv_file = meta_archives_path+'/'+filename
+            if not os.path.exists(ftp_csv_file) or pgs_ftp.get_md5_checksum(csv_file) != pgs_ftp.get_md5_checksum(ftp_csv_file):
+                return True
+        return False
+
+
+    def copy_file(self, source, destination, link=False):
+        ''' Copy a file to the new FTP structure (or hardlink it, see PGSBuildFtp.link_file) '''
+        if link:
+            PGSBuildFtp.link_file(source, destination)
+        else:
+            shutil.copy2(source, destination)
+        self.add_to_manifest(destination)
+
+
+    def add_to_manifest(self, filepath):
+        ''' Compute the checksums of a new file of the FTP structure for the release manifest (in the background) '''
+        if self.release_manifest and os.path.isfile(filepath):
+            self.release_manifest.add_file(filepath)
 
 
     def create_pgs_directory(self, path, force_recreate=None):
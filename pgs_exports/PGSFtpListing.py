@@ -0,0 +1,166 @@
+import os, os.path
+import calendar
+import time
+
+
+#---------------------#
+# Class PGSFtpListing #
+#---------------------#
+
+class PGSFtpListing:
+    '''
+    Listing of the FTP files (path, size, modification time and MD5), built in one recursive walk of the "scores/" and "metadata/"
+    trees (os.scandir for a local FTP, MLSD for a remote FTP) and kept in memory, so checking whether a file exists or has changed
+    is a dictionary lookup. The MD5 checksums are only computed when needed (same size as the new file), and can be saved
+    with the listing in a file to be reused (only for the files with the same size and modification time - see reuse_checksums).
+    '''
+
+    # Trees listed, relative to the FTP root
+    listing_dirs = ['scores/', 'metadata/']
+
+    def __init__(self, files, checksum_function=None):
+        '''
+        > Variables:
+            - files: dictionary of the files (path relative to the FTP root => [size, mtime, MD5 or None if not computed yet]).
+              The modification time is in nanoseconds for a local FTP, and in seconds for a remote FTP (resolution of MLSD)
+            - checksum_function: function returning the MD5 of a FTP file from its path (relative to the FTP root)
+        '''
+        self.files = files
+        self.checksum_function = checksum_function
+        # Directory => names of the files directly in the directory
+        self.dirs = {}
+        for filepath in files:
+            dirname, filename = filepath.rsplit('/', 1) if '/' in filepath else ('', filepath)
+            self.dirs.setdefault(dirname+'/', []).append(filename)
+
+
+    def __contains__(self, filepath):
+        return filepath in self.files
+
+
+    def __iter__(self):
+        return iter(self.files)
+
+
+    def __len__(self):
+        return len(self.files)
+
+
+    def get(self, filepath):
+        ''' Return the listing entry of a file ([size, mtime, MD5]), or None if the file is not on the FTP '''
+        return self.files.get(filepath)
+
+
+    def get_size(self, filepath):
+        ''' Return the size of a FTP file (0 if the file is not on the FTP) '''
+        entry = self.files.get(filepath)
+        return entry[0] if entry else 0
+
+
+    def get_dir_files(self, dirpath):
+        ''' Return the names of the files directly in a FTP directory (path relative to the FTP root, ending with "/") '''
+        return self.dirs.get(dirpath, [])
+
+
+    def get_md5(self, filepath):
+        ''' Return the MD5 of a FTP file (computed once, if it's not in the listing) '''
+        entry = self.files.get(filepath)
+        if not entry:
+            return None
+        if entry[2] is None and self.checksum_function:
+            entry[2] = self.checksum_function(filepath)
+        return entry[2]
+
+
+    def reuse_checksums(self, listing):
+        ''' Reuse the checksums of another listing (e.g. read from a listing file) for the files with the same size and modification time '''
+        for filepath, entry in self.files.items():
+            previous_entry = listing.get(filepath)
+            if entry[2] is None and previous_entry and previous_entry[:2] == entry[:2]:
+                entry[2] = previous_entry[2]
+
+
+    def is_different(self, filepath, local_file, local_md5_function):
+        '''
+        Check whether a local file is different from a FTP file (True if the FTP file doesn't exist).
+        The checksums are only compared if the files have the same size.
+        > Parameters:
+            - filepath: path of the FTP file, relative to the FTP root
+            - local_file: path of the local file
+            - local_md5_function: function returning the MD5 of the local file
+        '''
+        entry = self.files.get(filepath)
+        if not entry or entry[0] != os.path.getsize(local_file):
+            return True
+        return self.get_md5(filepath) != local_md5_function(local_file)
+
+
+
+    #=================#
+    #  Build listing  #
+    #=================#
+
+    @classmethod
+    def scan_local_ftp(cls, ftp_path, checksum_function=None):
+        ''' List the files of a local FTP (recursive os.scandir walk), with their modification time in nanoseconds '''
+        files = {}
+        ftp_path = ftp_path.rstrip('/')+'/'
+        dirs = [ x for x in cls.listing_dirs if os.path.isdir(ftp_path+x) ]
+        while dirs:
+            dirpath = dirs.pop()
+            with os.scandir(ftp_path+dirpath) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(dirpath+entry.name+'/')
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files[dirpath+entry.name] = [stat.st_size, stat.st_mtime_ns, None]
+        return cls(dict(sorted(files.items())), checksum_function)
+
+
+    @classmethod
+    def scan_remote_ftp(cls, ftp, ftp_path, checksum_function=None):
+        '''
+        List the files of a remote FTP (recursive MLSD walk), from a connected ftplib.FTP object.
+        The modification time is in seconds (nothing finer is given by MLSD): a file replaced by one of the same size
+        within the same second keeps the checksum of the listing file.
+        '''
+        files = {}
+        ftp_path = ftp_path.rstrip('/')+'/'
+        dirs = list(cls.listing_dirs)
+        while dirs:
+            dirpath = dirs.pop()
+            for name, facts in ftp.mlsd(ftp_path+dirpath, facts=['type', 'size', 'modify']):
+                if facts.get('type') == 'dir':
+                    dirs.append(dirpath+name+'/')
+                elif facts.get('type') == 'file':
+                    mtime = calendar.timegm(time.strptime(facts['modify'][:14], '%Y%m%d%H%M%S')) if 'modify' in facts else 0
+                    files[dirpath+name] = [int(facts.get('size', 0)), mtime, None]
+        return cls(dict(sorted(files.items())), checksum_function)
+
+
+
+    #================#
+    #  Listing file  #
+    #================#
+
+    @classmethod
+    def read(cls, listing_file, checksum_function=None):
+        '''
+        Read a listing file (one line per file: MD5, size, mtime and path, tab separated - "-" if the MD5 hasn't been computed)
+        '''
+        files = {}
+        with open(listing_file) as f:
+            for line in f:
+                md5, size, mtime, filepath = line.rstrip('\n').split('\t')
+                files[filepath] = [int(size), int(mtime), md5 if md5 != '-' else None]
+        return cls(files, checksum_function)
+
+
+    def write(self, listing_file):
+        ''' Write the listing in a file (with the MD5 checksums computed so far) '''
+        tmp_listing_file = listing_file+'.tmp'
+        with open(tmp_listing_file, 'w') as f:
+            for filepath, (size, mtime, md5) in self.files.items():
+                f.write(f'{md5 if md5 else "-"}\t{size}\t{mtime}\t{filepath}\n')
+        os.replace(tmp_listing_file, listing_file)
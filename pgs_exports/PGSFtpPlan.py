@@ -0,0 +1,94 @@
+#------------------#
+# Class PGSFtpPlan #
+#------------------#
+
+class PGSFtpPlan:
+    '''
+    Plan of the FTP build: classification of each PGS (Score), PGP (large study) and EFO (trait) entry as new, changed, unchanged or removed,
+    with the files to transfer to the new FTP content and the FTP files to archive.
+    The plan is computed from the local export files and a checksum listing of the FTP, without copying or downloading any file.
+    '''
+
+    statuses = ('new', 'changed', 'unchanged', 'removed')
+    types = ('score', 'publication', 'trait', 'all')
+    types_labels = {
+        'score': 'Scores (PGS)',
+        'publication': 'Large studies (PGP)',
+        'trait': 'Traits (EFO)',
+        'all': 'All metadata'
+    }
+
+    def __init__(self):
+        # Type => dictionary of entries (ID => entry)
+        self.entries = { type: {} for type in self.types }
+
+
+    def add_entry(self, type, id, status, files=[], archive_file=None, archive_size=0, archive=False):
+        '''
+        Add an entry to the plan
+        > Parameters:
+            - type: type of the entry ('score', 'publication', 'trait' or 'all')
+            - id: ID of the entry (PGS, PGP or EFO ID, or 'all')
+            - status: status of the entry ('new', 'changed', 'unchanged' or 'removed')
+            - files: list of the files to transfer, as tuples (source path, file name, size)
+            - archive_file: path of the FTP file to archive (relative to the FTP root)
+            - archive_size: size of the FTP file to archive
+            - archive: flag to archive the FTP file (None if it can't be determined from the FTP listing)
+        '''
+        self.entries[type][id] = {
+            'id': id,
+            'status': status,
+            'files': files,
+            'archive_file': archive_file,
+            'archive_size': archive_size,
+            'archive': archive
+        }
+
+
+    def get_entries(self, type, statuses=None):
+        ''' Return the entries of a given type (optionally filtered by status), in the order they have been added '''
+        return [ x for x in self.entries[type].values() if not statuses or x['status'] in statuses ]
+
+
+    def get_ids(self, type, status):
+        ''' Return the IDs of the entries of a given type and status '''
+        return [ x['id'] for x in self.get_entries(type, [status]) ]
+
+
+    def get_transfer_size(self, type=None):
+        ''' Return the number of bytes to transfer to the new FTP content (for a type of entries or for all of them) '''
+        types = [type] if type else self.types
+        return sum([ sum([ f[2] for f in x['files'] ]) for t in types for x in self.entries[t].values() ])
+
+
+    def get_archive_size(self, type=None):
+        ''' Return the number of bytes of the FTP files to archive (entries which can't be determined from the listing included) '''
+        types = [type] if type else self.types
+        return sum([ x['archive_size'] for t in types for x in self.entries[t].values() if x['archive'] is not False ])
+
+
+    def report(self):
+        ''' Print the summary of the plan '''
+        print('\t- FTP build plan')
+        for type in self.types:
+            if not self.entries[type]:
+                continue
+            counts = [ f'{len(self.get_entries(type, [status]))} {status}' for status in self.statuses ]
+            print(f'\t\t> {self.types_labels[type]}: {", ".join(counts)}')
+            print(f'\t\t  To transfer: {self.format_size(self.get_transfer_size(type))} | To archive: {self.format_size(self.get_archive_size(type))}')
+        print(f'\t\t> Total to transfer: {self.format_size(self.get_transfer_size())}')
+        print(f'\t\t> Total to archive: {self.format_size(self.get_archive_size())}')
+        unknown_archives = [ x['id'] for t in self.types for x in self.entries[t].values() if x['archive'] is None ]
+        if unknown_archives:
+            print(f'\t\t  (including {len(unknown_archives)} archive(s) that will only be confirmed after comparison with the FTP files)')
+
+
+    @staticmethod
+    def format_size(size):
+        ''' Format a number of bytes, e.g. "12.3 MB" '''
+        if size < 1024:
+            return f'{size} B'
+        for unit in ('KB', 'MB', 'GB'):
+            size /= 1024
+            if size < 1024 or unit == 'GB':
+                return f'{size:.1f} {unit}'
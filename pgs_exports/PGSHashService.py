@@ -0,0 +1,127 @@
+import os, os.path
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+#----------------------#
+# Class PGSHashService #
+#----------------------#
+
+class PGSHashService:
+    '''
+    Compute the checksums of the files (large buffers, thread pool) and cache them, keyed by (path, size, mtime_ns, inode),
+    so an unchanged file is only read once between the steps of a release, and between runs if the cache is saved in a sidecar file.
+    The checksum methods of the other classes (PGSBuildFtp, PGSCheckpoint, PGSExport, ...) use the default service (see get_default).
+    '''
+
+    # Service used by the checksum methods of the other classes
+    default = None
+
+    # Buffer size used to read the files (if hashlib.file_digest is not available)
+    blocksize = 1024*1024
+
+    def __init__(self, cache_file=None, workers=4):
+        '''
+        > Variables:
+            - cache_file: path to the sidecar file where the checksums are saved (the cache is only kept in memory if not provided)
+            - workers: number of threads used to compute the checksums of a list of files
+        '''
+        self.cache_file = cache_file
+        self.workers = workers
+        self.lock = threading.Lock()
+        # Path => [size, mtime_ns, inode, {algorithm => hexdigest}]
+        self.cache = {}
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file) as f:
+                    self.cache = json.load(f)
+            except ValueError:
+                print(f'\t> Hash cache: the file {cache_file} is not valid, the checksums will be computed again')
+
+
+    @classmethod
+    def get_default(cls):
+        ''' Return the default service (created with an in-memory cache if not set) '''
+        if cls.default is None:
+            cls.default = cls()
+        return cls.default
+
+
+    @classmethod
+    def set_default(cls, service):
+        ''' Set the default service '''
+        cls.default = service
+
+
+    def get_checksum(self, filename, algorithm='md5'):
+        '''
+        Return the checksum of a file (hexdigest), from the cache if the file hasn't changed
+        > Parameters:
+            - filename: path of the file
+            - algorithm: hash algorithm (e.g. 'md5' or 'sha256')
+        '''
+        return self.get_file_checksums(filename, (algorithm,))[algorithm]
+
+
+    def get_file_checksums(self, filename, algorithms):
+        '''
+        Return the checksums of a file for several hash algorithms (algorithm => hexdigest).
+        The checksums missing from the cache are computed reading the file once.
+        '''
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        with self.lock:
+            entry = self.cache.get(path)
+            if entry and entry[:3] == key:
+                missing_algorithms = [ x for x in algorithms if x not in entry[3] ]
+                if not missing_algorithms:
+                    return { x: entry[3][x] for x in algorithms }
+            else:
+                missing_algorithms = list(algorithms)
+
+        digests = self.compute_checksums(path, missing_algorithms)
+
+        with self.lock:
+            entry = self.cache.get(path)
+            if not entry or entry[:3] != key:
+                entry = key+[{}]
+                self.cache[path] = entry
+            entry[3].update(digests)
+            return { x: entry[3][x] for x in algorithms }
+
+
+    def get_checksums(self, filenames, algorithm='md5'):
+        ''' Return the checksums of a list of files (path => hexdigest), computed in parallel '''
+        if self.workers > 1 and len(filenames) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                digests = list(executor.map(lambda x: self.get_checksum(x, algorithm), filenames))
+        else:
+            digests = [ self.get_checksum(x, algorithm) for x in filenames ]
+        return dict(zip(filenames, digests))
+
+
+    def compute_checksums(self, filename, algorithms):
+        ''' Read a file and compute its checksums (algorithm => hexdigest) '''
+        with open(filename, 'rb') as file:
+            if len(algorithms) == 1 and hasattr(hashlib, 'file_digest'):
+                return { algorithms[0]: hashlib.file_digest(file, algorithms[0]).hexdigest() }
+            digests = { x: hashlib.new(x) for x in algorithms }
+            for block in iter(lambda: file.read(self.blocksize), b""):
+                for digest in digests.values():
+                    digest.update(block)
+            return { x: digest.hexdigest() for x, digest in digests.items() }
+
+
+    def save(self):
+        ''' Save the cache in the sidecar file (the entries of the files which don't exist anymore are removed) '''
+        if not self.cache_file:
+            return
+        with self.lock:
+            cache = { path: entry for path, entry in self.cache.items() if os.path.isfile(path) }
+        tmp_cache_file = self.cache_file+'.tmp'
+        with open(tmp_cache_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_cache_file, self.cache_file)
@@ -0,0 +1,120 @@
+import os, os.path
+import io
+import tarfile
+from pgs_exports.PGSHashService import PGSHashService
+from pgs_exports.PGSReleaseManifest import PGSReleaseManifest
+
+
+#-----------------------#
+# Class PGSReleaseDelta #
+#-----------------------#
+
+class PGSReleaseDelta:
+    '''
+    Delta archive of a release: only the files added or changed since the previous release (compared with its manifest),
+    with the list of the deleted files and the manifest of the new release.
+    The release trees (e.g. "new_ftp_content") only contain the files of the new and updated entries, added on top of the FTP:
+    the files missing from a release tree are kept, and only the files of the removed entries are deleted (never the archives
+    of the previous releases). Applying the delta archive on a mirror of the FTP updates it to the new release.
+    The manifests are the release manifests (see PGSReleaseManifest): the manifest of the new release is added at the root
+    of the delta archive, as it is published on the FTP, and is used to check the updated tree.
+    '''
+
+    # Files added to the delta archive (the paths of the release files are relative to the release tree)
+    delta_dir = '.pgs_delta/'
+    deletions_file = delta_dir+'deleted_files.txt'
+
+    def __init__(self, tree_dir):
+        '''
+        > Variables:
+            - tree_dir: path to the directory of the release tree (e.g. "new_ftp_content")
+        '''
+        # Absolute path, to compare it with the normalised paths of the deleted files
+        self.tree_dir = os.path.abspath(tree_dir)+'/'
+
+
+    def get_manifest(self):
+        ''' Return the manifest of the release tree (file path, relative to the tree => (size, MD5, SHA-256)) '''
+        return PGSReleaseManifest(self.tree_dir).get_entries()
+
+
+    def create_delta_archive(self, archive_file, manifest, previous_manifest, deleted_files=None):
+        '''
+        Generate the delta archive of the release tree
+        > Parameters:
+            - archive_file: path of the delta archive (tar.gz)
+            - manifest: manifest of the release tree
+            - previous_manifest: manifest of the previous release
+            - deleted_files: FTP files of the entries removed from the release (see PGSFtpGenerator.get_removed_files)
+        > Return type: dictionary with the list of the added/changed files and of the deleted files
+        '''
+        changed_files = [ x for x in manifest if x not in previous_manifest or previous_manifest[x][1] != manifest[x][1] ]
+        deleted_files = sorted([ x for x in deleted_files if x not in manifest ]) if deleted_files else []
+
+        with tarfile.open(archive_file, 'w:gz') as tar:
+            for filepath in changed_files:
+                tar.add(self.tree_dir+filepath, arcname=filepath)
+            self.add_content_to_archive(tar, PGSReleaseManifest.manifest_file_name, PGSReleaseManifest.get_content(manifest))
+            self.add_content_to_archive(tar, self.deletions_file, ''.join([ x+'\n' for x in deleted_files ]))
+
+        changed_size = sum([ manifest[x][0] for x in changed_files ])
+        total_size = sum([ x[0] for x in manifest.values() ])
+        print(f'\t\t> Delta archive: {len(changed_files)} added/changed file(s) ({changed_size} bytes out of {total_size}) and {len(deleted_files)} deleted file(s)')
+        return { 'changed': changed_files, 'deleted': deleted_files }
+
+
+    @staticmethod
+    def add_content_to_archive(tar, filename, content):
+        ''' Add a file to an open archive, from its content '''
+        data = content.encode()
+        tarinfo = tarfile.TarInfo(filename)
+        tarinfo.size = len(data)
+        tar.addfile(tarinfo, io.BytesIO(data))
+
+
+    def apply_delta_archive(self, archive_file):
+        '''
+        Apply a delta archive on the release tree (mirror of the FTP), and check the resulting files against the new manifest
+        > Parameter:
+            - archive_file: path of the delta archive (tar.gz)
+        > Return type: list of the files which don't match the new manifest or haven't been deleted (empty list if the tree has been updated)
+        '''
+        with tarfile.open(archive_file, 'r:gz') as tar:
+            members = tar.getmembers()
+            release_members = [ x for x in members if not x.name.startswith(self.delta_dir) ]
+            # The updated files are replaced (new inodes), not overwritten in place
+            for member in release_members:
+                if member.isfile() and os.path.isfile(self.tree_dir+member.name):
+                    os.remove(self.tree_dir+member.name)
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(self.tree_dir, members=release_members, filter='data')
+            else:
+                tar.extractall(self.tree_dir, members=release_members)
+            deleted_files = tar.extractfile(self.deletions_file).read().decode().splitlines()
+
+        # Remove the deleted files (and the directories left empty)
+        for filepath in deleted_files:
+            full_filepath = os.path.normpath(self.tree_dir+filepath)
+            if not full_filepath.startswith(self.tree_dir) or not os.path.isfile(full_filepath):
+                continue
+            os.remove(full_filepath)
+            dirpath = os.path.dirname(full_filepath)
+            while dirpath.startswith(self.tree_dir) and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+                dirpath = os.path.dirname(dirpath)
+
+        # Check the updated tree: the files of the manifest and the deleted files (the other files of the tree are kept)
+        manifest = PGSReleaseManifest.read(self.tree_dir+PGSReleaseManifest.manifest_file_name)
+        hash_service = PGSHashService.get_default()
+        mismatches = []
+        for filepath, entry in manifest.items():
+            full_filepath = self.tree_dir+filepath
+            if not os.path.isfile(full_filepath):
+                mismatches.append(filepath)
+                continue
+            checksums = hash_service.get_file_checksums(full_filepath, PGSReleaseManifest.algorithms)
+            if entry != (os.path.getsize(full_filepath), checksums['md5'], checksums['sha256']):
+                mismatches.append(filepath)
+        mismatches = sorted(mismatches + [ x for x in deleted_files if os.path.isfile(self.tree_dir+x) ])
+        print(f'\t\t> Delta applied: {len(release_members)} added/changed file(s) and {len(deleted_files)} deleted file(s) - {len(mismatches)} file(s) not matching the manifest')
+        return mismatches
@@ -0,0 +1,100 @@
+import os, os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pgs_exports.PGSHashService import PGSHashService
+
+
+#--------------------------#
+# Class PGSReleaseManifest #
+#--------------------------#
+
+class PGSReleaseManifest:
+    '''
+    Checksum manifest of all the files of the release tree (path, size, MD5 and SHA-256), published with the release.
+    The checksums are computed in background threads as the files are written in the tree (see add_file),
+    so writing the manifest at the end of the release only reads the files modified afterwards.
+    '''
+
+    algorithms = ('md5', 'sha256')
+    manifest_file_name = 'pgs_ftp_manifest.tsv'
+
+    def __init__(self, tree_dir, workers=4):
+        '''
+        > Variables:
+            - tree_dir: path to the directory of the release tree (e.g. "new_ftp_content")
+            - workers: number of threads computing the checksums
+        '''
+        self.tree_dir = tree_dir.rstrip('/')+'/'
+        self.workers = workers
+        self.executor = None
+        self.futures = []
+        self.lock = threading.Lock()
+
+
+    def add_file(self, filepath):
+        ''' Start computing the checksums of a file written in the release tree (the files can be added from several threads) '''
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self.futures.append(self.executor.submit(PGSHashService.get_default().get_file_checksums, filepath, self.algorithms))
+
+
+    def wait(self):
+        ''' Wait for the checksums computed in the background '''
+        if self.executor is not None:
+            for future in self.futures:
+                future.result()
+            self.executor.shutdown()
+            self.executor = None
+            self.futures = []
+
+
+    def get_entries(self):
+        '''
+        Return the manifest entries of all the files of the release tree (file path, relative to the tree => (size, MD5, SHA-256)).
+        The checksums already computed are reused if the files haven't changed since.
+        '''
+        self.wait()
+        filepaths = []
+        for root, dirs, files in os.walk(self.tree_dir):
+            dirs.sort()
+            filepaths += [ os.path.join(root, file) for file in sorted(files) ]
+        filepaths = [ x for x in filepaths if os.path.relpath(x, self.tree_dir) != self.manifest_file_name ]
+
+        hash_service = PGSHashService.get_default()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            checksums = list(executor.map(lambda x: hash_service.get_file_checksums(x, self.algorithms), filepaths))
+        return { os.path.relpath(x, self.tree_dir): (os.path.getsize(x), c['md5'], c['sha256']) for x, c in zip(filepaths, checksums) }
+
+
+    def write(self, entries=None):
+        '''
+        Write the manifest file at the root of the release tree (tab separated, with a header)
+        > Parameter:
+            - entries: manifest entries of the release tree (computed if not given - see get_entries)
+        > Return type: path of the manifest file
+        '''
+        manifest_file = self.tree_dir+self.manifest_file_name
+        if entries is None:
+            entries = self.get_entries()
+        with open(manifest_file, 'w') as f:
+            f.write(self.get_content(entries))
+        print(f'\t- Release manifest: {len(entries)} files listed in {manifest_file}')
+        return manifest_file
+
+
+    @staticmethod
+    def get_content(entries):
+        ''' Return the content of the manifest file of the given entries '''
+        return 'path\tsize\tmd5\tsha256\n'+''.join([ f'{filepath}\t{size}\t{md5}\t{sha256}\n' for filepath, (size, md5, sha256) in entries.items() ])
+
+
+    @staticmethod
+    def read(manifest_file):
+        ''' Read a manifest file (file path => (size, MD5, SHA-256)) '''
+        entries = {}
+        with open(manifest_file) as f:
+            for line in f.read().splitlines()[1:]:
+                filepath, size, md5, sha256 = line.split('\t')
+                entries[filepath] = (int(size), md5, sha256)
+        return entries
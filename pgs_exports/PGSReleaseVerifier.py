@@ -0,0 +1,289 @@
+import os, os.path
+import re
+import csv
+import hashlib
+import multiprocessing
+import tarfile
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from pgs_exports.PGSExport import PGSExport
+
+
+#--------------------------#
+# Class PGSReleaseVerifier #
+#--------------------------#
+
+class PGSReleaseVerifier:
+    '''
+    Verify the files of the new FTP structure before the release is archived, one directory per task, in parallel processes:
+    - every tar.gz archive is read to the end (gzip checksum) and its members are compared with the files of the directory
+    - the Excel files are read (zip checksums) and their list of spreadsheets is checked
+    - the rows of the CSV files are counted (with the same number of columns as the header) and compared with the metadata
+    The numbers of files, rows and errors are reported, and written in a report file.
+    '''
+
+    # Directories of the metadata exports, relative to the FTP root: pattern => type of export
+    export_dirs_patterns = {
+        'score': re.compile(r'^scores/(PGS\d+)/Metadata/$'),
+        'publication': re.compile(r'^metadata/publications/(PGP\d+)/$'),
+        'trait': re.compile(r'^metadata/traits/([^/]+)/$'),
+        'all': re.compile(r'^metadata/$')
+    }
+
+    # Prefix of the export files in the directory of the all metadata export
+    all_metadata_prefix = 'pgs_all'
+
+    # Number of directories sent at once to a worker process
+    chunk_size = 16
+
+    # Size of the blocks read to compute the checksums (the files are not loaded in memory)
+    read_block_size = 1024*1024
+
+    def __init__(self, ftp_dir, data_index, workers=1):
+        '''
+        > Variables:
+            - ftp_dir: path to the new FTP structure
+            - data_index: index of the metadata (PGSDataIndex), giving the expected number of rows of the CSV files
+            - workers: number of processes verifying the directories
+        '''
+        self.ftp_dir = ftp_dir.rstrip('/')+'/'
+        self.data_index = data_index
+        self.workers = workers
+        self.stats = {}
+        self.errors = []
+        self.duration = 0
+
+
+    def get_tasks(self):
+        '''
+        List the directories of the FTP structure to verify (one walk), with the expected content of the metadata exports
+        > Return type: list of tuples (directory path, file names, expected content or None)
+        '''
+        tasks = []
+        dirs = ['']
+        while dirs:
+            dirpath = dirs.pop()
+            filenames = []
+            with os.scandir(self.ftp_dir+dirpath) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(dirpath+entry.name+'/')
+                    elif entry.is_file():
+                        filenames.append(entry.name)
+            if filenames:
+                tasks.append((self.ftp_dir+dirpath, sorted(filenames), self.get_expected_content(dirpath)))
+        return sorted(tasks)
+
+
+    def get_expected_content(self, dirpath):
+        '''
+        Return the expected content of the directory of a metadata export, or None for the other directories
+        > Parameter:
+            - dirpath: path of the directory, relative to the FTP root
+        > Return type: dictionary with the keys 'xlsx' (name of the Excel file), 'sheets' (list of its spreadsheets) and
+          'csv_rows' (CSV file name => number of rows), or with the key 'error' if the directory is not expected
+          (e.g. trait without Score)
+        '''
+        for type, pattern in self.export_dirs_patterns.items():
+            m = pattern.match(dirpath)
+            if not m:
+                continue
+            sheets = [ PGSExport.spreadsheets_labels[x] for x in PGSExport.spreadsheets_list ]
+            if type == 'score':
+                prefix = m.group(1)
+                rows_counts = self.data_index.get_export_rows_counts([prefix])
+            elif type in ('publication', 'trait'):
+                prefix = m.group(1)
+                if type == 'publication':
+                    score_ids = self.data_index.get_publication_evaluated_score_ids(prefix)
+                else:
+                    score_ids = self.data_index.get_trait_score_ids(prefix)
+                # Without Scores, the rows counts would be the ones of the whole catalogue
+                if not score_ids:
+                    return { 'error': f'unexpected {type} directory (no Score associated with {prefix})' }
+                rows_counts = self.data_index.get_export_rows_counts(score_ids, type == 'publication')
+            else:
+                prefix = self.all_metadata_prefix
+                rows_counts = self.data_index.get_export_rows_counts()
+                sheets = ['Readme'] + sheets
+            csv_rows = { PGSExport.get_csv_filename(prefix, PGSExport.spreadsheets_labels[x]): rows_counts[x] for x in PGSExport.spreadsheets_list }
+            return { 'xlsx': prefix+'_metadata.xlsx', 'sheets': sheets, 'csv_rows': csv_rows }
+        return None
+
+
+    def run(self):
+        ''' Verify all the directories of the FTP structure and return True if no error was found '''
+        start = time.perf_counter()
+        tasks = self.get_tasks()
+        if self.workers > 1 and len(tasks) > 1:
+            # The directories are verified by forked processes (only the tasks are sent to them)
+            mp_context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context) as executor:
+                results = list(executor.map(self.verify_directory, tasks, chunksize=self.chunk_size))
+        else:
+            results = [ self.verify_directory(task) for task in tasks ]
+
+        self.stats = { 'directories': len(tasks) }
+        self.errors = []
+        for stats, errors in results:
+            for key, value in stats.items():
+                self.stats[key] = self.stats.get(key, 0) + value
+            self.errors.extend(errors)
+        self.duration = time.perf_counter() - start
+        return not self.errors
+
+
+    @classmethod
+    def verify_directory(cls, task):
+        '''
+        Verify the files of a directory
+        > Parameter:
+            - task: tuple (directory path, file names, expected content of the metadata export or None)
+        > Return type: tuple (dictionary of the numbers of files, archives, members, rows, bytes..., list of the errors)
+        '''
+        dirpath, filenames, expected = task
+        stats = { 'files': len(filenames), 'bytes': 0, 'archives': 0, 'members': 0, 'xlsx_files': 0, 'csv_files': 0, 'csv_rows': 0 }
+        errors = []
+        # MD5 of the files of the directory
+        checksums = {}
+
+        if expected and 'error' in expected:
+            errors.append(f'{dirpath}: {expected["error"]}')
+            expected = None
+
+        for filename in filenames:
+            filepath = dirpath+filename
+            try:
+                checksums[filename], size = cls.get_file_checksum(filepath)
+            except OSError as e:
+                errors.append(f'{filepath}: can\'t be read ({e})')
+                continue
+            stats['bytes'] += size
+            try:
+                if filename.endswith('.xlsx'):
+                    stats['xlsx_files'] += 1
+                    sheets = cls.get_xlsx_sheets(filepath)
+                    if expected and filename == expected['xlsx'] and sheets != expected['sheets']:
+                        errors.append(f'{filepath}: spreadsheets {sheets} instead of {expected["sheets"]}')
+                elif filename.endswith('.csv'):
+                    stats['csv_files'] += 1
+                    rows_count = cls.count_csv_rows(filepath)
+                    stats['csv_rows'] += rows_count
+                    if expected and filename in expected['csv_rows'] and rows_count != expected['csv_rows'][filename]:
+                        errors.append(f'{filepath}: {rows_count} rows instead of {expected["csv_rows"][filename]}')
+            except Exception as e:
+                errors.append(f'{filepath}: invalid file ({e})')
+
+        # Files missing from the metadata export
+        if expected:
+            for filename in [expected['xlsx'], *expected['csv_rows'].keys()]:
+                if filename not in checksums:
+                    errors.append(f'{dirpath+filename}: missing file')
+
+        # The archives are read to the end, and their members compared with the files of the directory
+        loose_files = [ x for x in checksums if x.endswith(('.csv', '.xlsx')) ]
+        for filename in [ x for x in filenames if x.endswith('.tar.gz') ]:
+            stats['archives'] += 1
+            try:
+                members = cls.get_archive_checksums(dirpath+filename)
+            except (OSError, EOFError, tarfile.TarError) as e:
+                errors.append(f'{dirpath+filename}: invalid archive ({e})')
+                continue
+            stats['members'] += len(members)
+            if not loose_files:
+                continue
+            for name in sorted(set(members.keys()) | set(loose_files)):
+                if name not in members:
+                    errors.append(f'{dirpath+filename}: missing member {name}')
+                elif name not in checksums:
+                    errors.append(f'{dirpath+filename}: member {name} not in the directory')
+                elif members[name] != checksums[name]:
+                    errors.append(f'{dirpath+filename}: member {name} different from the file of the directory')
+        return stats, errors
+
+
+    @classmethod
+    def get_file_checksum(cls, filepath):
+        ''' Return the MD5 and the size of a file, read by blocks '''
+        with open(filepath, 'rb') as f:
+            return cls.get_stream_checksum(f)
+
+
+    @classmethod
+    def get_stream_checksum(cls, stream):
+        ''' Return the MD5 and the size of the content of a file object, read by blocks '''
+        md5 = hashlib.md5()
+        size = 0
+        for block in iter(lambda: stream.read(cls.read_block_size), b''):
+            md5.update(block)
+            size += len(block)
+        return md5.hexdigest(), size
+
+
+    @classmethod
+    def get_archive_checksums(cls, archive_file):
+        ''' Read an archive and return the MD5 of its files (file name => MD5) '''
+        checksums = {}
+        with tarfile.open(archive_file, 'r:gz') as tar:
+            for member in tar:
+                if member.isfile():
+                    checksums[os.path.basename(member.name)] = cls.get_stream_checksum(tar.extractfile(member))[0]
+            # The end of the compressed stream is read too, to check the gzip checksum
+            while tar.fileobj.read(cls.read_block_size):
+                pass
+        return checksums
+
+
+    @staticmethod
+    def get_xlsx_sheets(xlsx_file):
+        ''' Check the zip checksums of an Excel file and return the names of its spreadsheets '''
+        with zipfile.ZipFile(xlsx_file) as xlsx:
+            bad_file = xlsx.testzip()
+            if bad_file:
+                raise ValueError(f'corrupted part {bad_file}')
+            workbook = ET.fromstring(xlsx.read('xl/workbook.xml'))
+        return [ x.get('name') for x in workbook.iter() if x.tag.endswith('}sheet') ]
+
+
+    @staticmethod
+    def count_csv_rows(csv_file):
+        ''' Return the number of rows of a CSV file (without the header), checking that they have as many columns as the header '''
+        with open(csv_file, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                raise ValueError('empty file')
+            rows_count = 0
+            for row in reader:
+                rows_count += 1
+                if len(row) != len(header):
+                    raise ValueError(f'{len(row)} columns on row {rows_count} instead of {len(header)}')
+        return rows_count
+
+
+    def report(self):
+        ''' Print the summary of the verification and the errors '''
+        for line in self.get_report_lines():
+            print(line)
+
+
+    def get_report_lines(self):
+        ''' Return the summary of the verification and the errors, as a list of lines '''
+        stats = self.stats
+        lines = [
+            f'\t> Verified {stats.get("files", 0)} files ({stats.get("bytes", 0)} bytes) in {stats.get("directories", 0)} directories in {self.duration:.2f}s ({self.workers} process(es)):',
+            f'\t\t- {stats.get("archives", 0)} archives ({stats.get("members", 0)} members)',
+            f'\t\t- {stats.get("xlsx_files", 0)} Excel files',
+            f'\t\t- {stats.get("csv_files", 0)} CSV files ({stats.get("csv_rows", 0)} rows)',
+            f'\t> {len(self.errors)} error(s)'
+        ]
+        lines.extend([ f'\t\t/!\\ {x}' for x in self.errors ])
+        return lines
+
+
+    def write_report(self, report_file):
+        ''' Write the summary of the verification and the errors in a file '''
+        with open(report_file, 'w') as f:
+            f.write('\n'.join([ x.strip() for x in self.get_report_lines() ])+'\n')
@@ -0,0 +1,72 @@
+import os, os.path
+import hashlib
+import json
+import threading
+
+
+#--------------------#
+# Class PGSRestCache #
+#--------------------#
+
+class PGSRestCache:
+    '''
+    On-disk cache of the REST API responses, keyed by URL, with their validators (ETag and Last-Modified).
+    The cached responses are sent back as conditional requests (If-None-Match/If-Modified-Since),
+    and reused when the REST API answers that they haven't changed (HTTP 304).
+    '''
+
+    def __init__(self, cache_dir):
+        '''
+        > Variables:
+            - cache_dir: path to the directory of the cache
+        '''
+        self.cache_dir = cache_dir.rstrip('/')+'/'
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def get_entry_file(self, url):
+        ''' Return the path of the cache file of a URL '''
+        return self.cache_dir+hashlib.sha256(url.encode()).hexdigest()+'.json'
+
+
+    def get(self, url):
+        ''' Return the cached response of a URL (dictionary with the keys 'url', 'etag', 'last_modified' and 'content'), or None '''
+        entry_file = self.get_entry_file(url)
+        if not os.path.isfile(entry_file):
+            return None
+        try:
+            with open(entry_file) as f:
+                entry = json.load(f)
+        except ValueError:
+            return None
+        return entry if entry.get('url') == url else None
+
+
+    def set(self, url, etag, last_modified, content):
+        '''
+        Store the response of a URL (only if it has a validator)
+        > Parameters:
+            - url: URL of the request
+            - etag: value of the ETag header
+            - last_modified: value of the Last-Modified header
+            - content: JSON content of the response
+        '''
+        if not etag and not last_modified:
+            return
+        entry_file = self.get_entry_file(url)
+        tmp_entry_file = f'{entry_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_entry_file, 'w') as f:
+            json.dump({ 'url': url, 'etag': etag, 'last_modified': last_modified, 'content': content }, f)
+        os.replace(tmp_entry_file, entry_file)
+
+
+    @staticmethod
+    def get_conditional_headers(entry):
+        ''' Return the headers of a conditional request, from a cached response '''
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
@@ -0,0 +1,248 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+#----------------------#
+# Class PGSRestFetcher #
+#----------------------#
+
+class PGSRestFetcher:
+    '''
+    Fetch the PGS Catalog metadata and release data from the REST API, with concurrent requests:
+    the endpoints are fetched at the same time, and so are the pages of each endpoint.
+    All the requests share the same concurrency limit (number of requests in progress) and rate limit (requests per second).
+    The requests are sent by the "requests" library, in threads driven by asyncio. The responses are compressed (gzip, or
+    brotli if available), the pages are as large as the REST API allows, and the responses can be cached (see PGSRestCache).
+    '''
+
+    # Maximum number of results per page allowed by the REST API ("limit" parameter)
+    max_page_size = 250
+
+    # HTTP status of the temporary errors, retried after a delay (doubled after each attempt)
+    retry_statuses = (429, 500, 502, 503, 504)
+    retry_delay = 1
+
+    # Endpoints of the metadata: type => (endpoint, parameters)
+    data_endpoints = {
+        'score': ('score/all', None),
+        'trait': ('trait/all', None),
+        'publication': ('publication/all', None),
+        'performance': ('performance/all', None),
+        'cohort': ('cohort/all', 'fetch_all=1')
+    }
+
+    def __init__(self, url_root, concurrency=4, rate_limit=None, cache=None, page_size=None, retries=3):
+        '''
+        > Variables:
+            - url_root: root of the REST API URL
+            - concurrency: maximum number of requests in progress
+            - rate_limit: maximum number of requests started per second (no limit if not set)
+            - cache: on-disk cache of the responses (PGSRestCache), used to send conditional requests
+            - page_size: number of results per page (default: max_page_size)
+            - retries: number of times a request is sent again after a temporary error (connection error or HTTP 429/5xx)
+        '''
+        if not url_root.endswith('/'):
+            url_root += '/'
+        self.url_root = url_root
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.cache = cache
+        self.page_size = page_size if page_size else self.max_page_size
+        self.retries = retries
+        self.stats_lock = threading.Lock()
+        self.requests_count = 0
+        self.not_modified_count = 0
+        self.retries_count = 0
+        # Size of the decoded response bodies (after the gzip/deflate decoding, not the size on the wire)
+        self.received_bytes = 0
+
+
+    #------------------#
+    # Fetch the data   #
+    #------------------#
+
+    def fetch_release_data(self):
+        '''
+        Fetch all the metadata, the current and previous releases and the ancestry categories
+        > Return type: dictionary with the keys 'data' (entity type => list of the REST API entries), 'current_release',
+          'previous_release' and 'ancestry_categories'
+        '''
+        return asyncio.run(self.fetch_all())
+
+
+    async def fetch_all(self):
+        ''' Fetch all the endpoints concurrently '''
+        # asyncio objects are created in the event loop of the fetch
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.rate_lock = asyncio.Lock()
+        self.next_request_time = 0
+        import requests
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = self.get_accept_encoding()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        try:
+            types = list(self.data_endpoints.keys())
+            results = await asyncio.gather(
+                *[ self.fetch_endpoint(*self.data_endpoints[type], paginated=True) for type in types ],
+                self.fetch_endpoint('release/current'),
+                self.fetch_endpoint('release/all', paginated=True),
+                self.fetch_endpoint('ancestry_categories')
+            )
+        finally:
+            self.session.close()
+        print(f'\t\t> {self.requests_count} requests ({self.not_modified_count} not modified, reused from the cache - {self.retries_count} retried) - {self.received_bytes} bytes received (decoded)')
+
+        data = {}
+        for type, type_data in zip(types, results):
+            if type_data:
+                print(f'\t\t> {type}s: {len(type_data)} entries')
+                data[type] = type_data
+            else:
+                print(f'\t/!\\ Error: cannot retrieve "{type}" data')
+        current_release, releases, ancestry_data = results[len(types):]
+        if isinstance(releases, dict) and 'results' in releases:
+            releases = releases['results']
+        return {
+            'data': data,
+            'current_release': current_release,
+            'previous_release': releases[1] if releases and len(releases) > 1 else '',
+            'ancestry_categories': { anc: ancestry_data[anc]['display_category'] for anc in ancestry_data } if ancestry_data else {}
+        }
+
+
+    async def fetch_endpoint(self, endpoint, parameters=None, paginated=False):
+        '''
+        Fetch all the results of an endpoint. For the paginated endpoints, the first page gives the number of results and
+        the page size, and the other pages are requested concurrently (following the "next" links if the pagination
+        doesn't use offsets).
+        '''
+        url = self.url_root+endpoint
+        if paginated:
+            parameters = f'{parameters}&limit={self.page_size}' if parameters else f'limit={self.page_size}'
+        if parameters:
+            url += '?'+parameters
+        response_json = await self.get_json(url)
+
+        # Response without pagination
+        if not isinstance(response_json, dict) or 'next' not in response_json:
+            return response_json
+
+        count_items = response_json['count']
+        results = response_json['results']
+        next_url = response_json['next']
+        if next_url and count_items > len(results):
+            page_urls = self.get_page_urls(next_url, len(results), count_items)
+            # Offset pagination: the pages are fetched concurrently
+            if page_urls:
+                pages = await asyncio.gather(*[ self.get_json(x) for x in page_urls ])
+                for page in pages:
+                    results = results + page['results']
+            # Other pagination: the "next" links are followed
+            else:
+                while next_url and count_items > len(results):
+                    response_json = await self.get_json(next_url)
+                    results = results + response_json['results']
+                    next_url = response_json['next']
+        if count_items != len(results):
+            print(f'The number of items are differents from expected: {len(results)} found instead of {count_items}')
+        return results
+
+
+    @staticmethod
+    def get_page_urls(next_url, page_size, count_items):
+        ''' Build the URLs of the remaining pages from the "next" link, if the pagination uses offsets (otherwise return None) '''
+        url_parts = urlsplit(next_url)
+        parameters = dict(parse_qsl(url_parts.query))
+        if 'offset' not in parameters or not page_size:
+            return None
+        page_urls = []
+        for offset in range(int(parameters['offset']), count_items, page_size):
+            parameters['offset'] = str(offset)
+            page_urls.append(urlunsplit(url_parts._replace(query=urlencode(parameters))))
+        return page_urls
+
+
+    #-----------#
+    # Requests  #
+    #-----------#
+
+    async def get_json(self, url):
+        ''' Request a URL (within the concurrency and rate limits) and return the JSON response '''
+        async with self.semaphore:
+            await self.wait_rate_limit()
+            print("\t\t> URL: "+url)
+            return await asyncio.to_thread(self.send_request, url)
+
+
+    async def wait_rate_limit(self):
+        ''' Wait until a new request can be started, according to the rate limit '''
+        if not self.rate_limit:
+            return
+        async with self.rate_lock:
+            now = time.monotonic()
+            if self.next_request_time > now:
+                await asyncio.sleep(self.next_request_time - now)
+            self.next_request_time = max(now, self.next_request_time) + 1/self.rate_limit
+
+
+    def send_request(self, url):
+        '''
+        Send a GET request (in a thread) and return the JSON response.
+        If the response is cached, the request is conditional and the cached response is returned if it hasn't changed.
+        The temporary errors are retried.
+        '''
+        import requests
+        cached_entry = self.cache.get(url) if self.cache else None
+        headers = self.cache.get_conditional_headers(cached_entry) if cached_entry else None
+        try:
+            for attempt in range(self.retries+1):
+                try:
+                    response = self.session.get(url, headers=headers)
+                except requests.exceptions.ConnectionError as e:
+                    if attempt == self.retries:
+                        raise
+                    self.wait_retry(url, attempt, e)
+                    continue
+                with self.stats_lock:
+                    self.requests_count += 1
+                    self.received_bytes += len(response.content)
+                if response.status_code not in self.retry_statuses or attempt == self.retries:
+                    break
+                self.wait_retry(url, attempt, f'HTTP {response.status_code}', response.headers.get('Retry-After'))
+            # Not modified: the cached response is reused
+            if response.status_code == 304 and cached_entry:
+                with self.stats_lock:
+                    self.not_modified_count += 1
+                return cached_entry['content']
+            response.raise_for_status()
+            content = response.json()
+        except requests.exceptions.RequestException as e:
+            raise SystemExit(e)
+        if self.cache:
+            self.cache.set(url, response.headers.get('ETag'), response.headers.get('Last-Modified'), content)
+        return content
+
+
+    def wait_retry(self, url, attempt, error, retry_after=None):
+        ''' Wait before sending a request again (delay given by the "Retry-After" header, or doubled after each attempt) '''
+        with self.stats_lock:
+            self.retries_count += 1
+        delay = self.retry_delay * 2**attempt
+        if retry_after and retry_after.isdigit():
+            delay = int(retry_after)
+        print(f'\t\t> Retry in {delay}s ({error}): {url}')
+        time.sleep(delay)
+
+
+    @staticmethod
+    def get_accept_encoding():
+        ''' Compressed encodings accepted for the responses (brotli is only decoded if the "brotli" package is installed) '''
+        try:
+            import brotli
+            return 'br, gzip, deflate'
+        except ImportError:
+            return 'gzip, deflate'
@@ -1,131 +1,20 @@
 import os, os.path
 import argparse
-import requests
+import json
 import shutil
 import tarfile
-import time
+from pgs_exports.PGSBlobStore import PGSBlobStore
+from pgs_exports.PGSCatalogue import PGSCatalogue
+from pgs_exports.PGSCatalogueSQLite import PGSCatalogueSQLite
+from pgs_exports.PGSCheckpoint import PGSCheckpoint
 from pgs_exports.PGSExportGenerator import PGSExportGenerator
 from pgs_exports.PGSFtpGenerator import PGSFtpGenerator
-
-
-large_publication_ids_list = ['PGP000244','PGP000263','PGP000332','PGP000393']
-
-
-def rest_api_call(url,endpoint,parameters=None):
-    """"
-    Generic method to perform REST API calls to the PGS Catalog
-    > Parameters:
-        - url: URL to the REST API
-        - endpoint: REST API endpoint
-        - parameters: extra parameters to the REST API endpoint, if needed
-    > Return type: dictionary
-    """
-    if not url.endswith('/'):
-        url += '/'
-    rest_full_url = url+endpoint
-    if parameters:
-        rest_full_url += '?'+parameters
-    
-    print("\t\t> URL: "+rest_full_url)
-    try:
-        response = requests.get(rest_full_url)
-        response_json = response.json()
-        # Response with pagination
-        if 'next' in response_json:
-            count_items = response_json['count']
-            results = response_json['results']
-            # Loop over the pages
-            while response_json['next'] and count_items > len(results):
-                time.sleep(1)
-                response = requests.get(response_json['next'])
-                response_json = response.json()
-                results = results + response_json['results']
-            if count_items != len(results):
-                print(f'The number of items are differents from expected: {len(results)} found instead of {count_items}')
-        # Respone without pagination
-        else:
-            results = response_json
-    except requests.exceptions.RequestException as e:  # This is the correct syntax
-        raise SystemExit(e)
-    return results
-
-
-def get_all_pgs_data(url_root):
-    """ 
-    Fetch all the PGS data via the REST API
-    > Parameter:
-        - url_root: Root of the REST API URL
-    > Return type: dictionary
-    """
-    data = {}
-    for type in ['score', 'trait', 'publication', 'performance', 'cohort']:
-        print(f'\t- Fetch all {type}s')
-        if type == 'cohort':
-            tmp_data = rest_api_call(url_root, f'{type}/all', 'fetch_all=1')
-        else:
-            tmp_data = rest_api_call(url_root, f'{type}/all')
-        # Wait a bit to avoid reaching the maximum of allowed queries/min (might be increased)
-        time.sleep(5)
-        if tmp_data:
-            print(f'\t\t> {type}s: {len(tmp_data)} entries')
-            data[type] = tmp_data
-        else:
-            print(f'\t/!\ Error: cannot retrieve "{type}" data')
-    return data
-
-
-def get_latest_release(url_root) -> dict:
-    """
-    Fetch the date of the latest the PGS Catalog release
-    > Parameter:
-        - url_root: Root of the REST API URL
-    > Return type: dictionary
-    """
-    release = ''
-    release_data = rest_api_call(url_root, 'release/current')
-    if release_data:
-        release = release_data
-        print(f'\t\t> Release: {release["date"]}')
-    else:
-        print('\t/!\ Error: cannot retrieve current release')
-    return release
-
-
-def get_previous_release(url_root):
-    """
-    Fetch the date of the latest the PGS Catalog release
-    > Parameter:
-        - url_root: Root of the REST API URL
-    > Return type: dictionary
-    """
-    release = ''
-    release_data = rest_api_call(url_root, 'release/all')
-    if release_data:
-        if 'results' in release_data:
-            release = release_data['results'][1]
-        else:
-            release = release_data[1]
-        print(f'\t\t> Previous release: {release["date"]}')
-    else:
-        print('\t/!\ Error: cannot retrieve previous release')
-    return release
-
-
-def get_ancestry_categories(url_root):
-    """
-    Fetch the list of ancestry categories
-    > Parameter:
-        - url_root: Root of the REST API URL
-    > Return type: dictionary
-    """
-    data = {}
-    ancestry_data = rest_api_call(url_root, 'ancestry_categories')
-    if ancestry_data:
-        for anc in ancestry_data:
-            data[anc] = ancestry_data[anc]['display_category']
-    else:
-        print('\t/!\ Error: cannot retrieve the list of ancestry categories')
-    return data
+from pgs_exports.PGSHashService import PGSHashService
+from pgs_exports.PGSReleaseDelta import PGSReleaseDelta
+from pgs_exports.PGSReleaseManifest import PGSReleaseManifest
+from pgs_exports.PGSReleaseVerifier import PGSReleaseVerifier
+from pgs_exports.PGSRestCache import PGSRestCache
+from pgs_exports.PGSRestFetcher import PGSRestFetcher
 
 
 def create_pgs_directory(path, force_recreate=None):
@@ -165,12 +54,12 @@ def tardir(path, tar_name):
                 tar_handle.add(os.path.join(root, file))
 
 
-def check_new_data_entry_in_metadata(dirpath_new,data,release_data):
+def check_new_data_entry_in_metadata(dirpath_new,catalogue,release_data):
     """
     Check that the metadata directory for the new Scores and Performance Metrics exists
     > Parameters:
         - dirpath_new: path to the directory where the metadata files have be copied
-        - data: dictionary containing the metadata
+        - catalogue: catalogue of the metadata (PGSCatalogue or PGSCatalogueSQLite)
         - release_data: data related to the current release
     """
     scores_dir = dirpath_new+'/scores/'
@@ -183,7 +72,7 @@ def check_new_data_entry_in_metadata(dirpath_new,data,release_data):
     # Performance Metric(s)
     missing_perf_dir = set()
     new_performances = release_data['released_performance_ids']
-    for perf in [ x for x in data['performance'] if x['id'] in new_performances]:
+    for perf in [ x for x in catalogue.get_performances() if x['id'] in new_performances]:
         score_id = perf['associated_pgs_id']
         if not os.path.isdir(scores_dir+score_id):
             missing_perf_dir.add(score_id)
@@ -203,109 +92,365 @@ def check_new_data_entry_in_metadata(dirpath_new,data,release_data):
 #  Main method  #
 #===============#
 
-def main():
+debug = 0
+tmp_export_dir_name = 'export'
+tmp_ftp_dir_name = 'new_ftp_content'
+checkpoint_file_name = 'pgs_release_checkpoint.jsonl'
+rest_data_file_name = 'pgs_rest_data.json'
+release_info_file_name = 'pgs_release_info.json'
+blob_store_dir_name = '.blobs'
+hash_cache_file_name = 'pgs_hash_cache.json'
+rest_cache_dir_name = 'pgs_rest_cache'
+verification_report_file_name = 'pgs_release_verification.txt'
+
+# Steps of the release, run in this order by the "release" command
+commands = ['fetch', 'export', 'build-ftp', 'verify', 'archive']
+
+
+class PGSRelease:
+    ''' Steps of the metadata release, sharing the paths, the checkpoint journal and the catalogue. '''
+
+    def __init__(self, args, new_release):
+        '''
+        > Variables:
+            - args: script parameters
+            - new_release: flag to start a new release (the export and FTP directories are recreated), unless "--resume" is set
+        '''
+        self.args = args
+        self.content_dir = args.dir
+        self.new_ftp_dir = self.content_dir+'/'+tmp_ftp_dir_name
+        self.export_dir = self.content_dir+'/'+tmp_export_dir_name+'/'
+        self.rest_data_file = self.content_dir+'/'+rest_data_file_name
+        self.release_info_file = self.content_dir+'/'+release_info_file_name
+        self.scores_list_file = self.new_ftp_dir+'/pgs_scores_list.txt'
+        self.catalogue = None
+        self.release_info = None
+        self.ftp_generator = None
+        # Checksums of the files of the new FTP structure, computed as they are copied
+        self.release_manifest = PGSReleaseManifest(self.new_ftp_dir)
+
+        # Journal of the completed stages, used to resume an interrupted release
+        resume = args.resume or not new_release
+        self.checkpoint = PGSCheckpoint(self.content_dir+'/'+checkpoint_file_name, resume)
+
+        # Setup new FTP directory and temporary export directory
+        create_pgs_directory(self.new_ftp_dir, not resume)
+        create_pgs_directory(self.export_dir, not resume)
+
+
+    def get_release_info(self):
+        ''' Return the release data (current release, previous release date and ancestry categories) '''
+        if self.release_info is None:
+            if not os.path.isfile(self.release_info_file):
+                print(f'Error: can\'t find the file {self.release_info_file}. Please run the "fetch" command first.')
+                exit(1)
+            with open(self.release_info_file) as f:
+                self.release_info = json.load(f)
+        return self.release_info
+
+
+    def get_catalogue(self):
+        ''' Return the catalogue of the metadata, stored in memory or in a SQLite database '''
+        if self.catalogue is None:
+            checkpoint = self.checkpoint
+            if self.args.catalogue_db and checkpoint.is_stage_done('catalogue_db'):
+                self.catalogue = PGSCatalogueSQLite(self.args.catalogue_db)
+            else:
+                if not os.path.isfile(self.rest_data_file):
+                    print(f'Error: can\'t find the file {self.rest_data_file}. Please run the "fetch" command first.')
+                    exit(1)
+                with open(self.rest_data_file) as f:
+                    data = json.load(f)
+                # Compact model of the metadata (the REST API dictionaries are released)
+                if self.args.catalogue_db:
+                    self.catalogue = PGSCatalogueSQLite(self.args.catalogue_db, data)
+                    checkpoint.set_stage_done('catalogue_db', [self.args.catalogue_db])
+                else:
+                    self.catalogue = PGSCatalogue(data)
+        return self.catalogue
+
+
+    def get_large_publication_ids(self):
+        ''' Large studies, selected from the number of evaluated Scores '''
+        return self.get_catalogue().get_large_publication_ids(self.args.large_study_threshold)
+
+
+    def get_trait_ids(self):
+        ''' Traits exported in their own metadata files (all the traits mapped to a Score, if the trait exports are enabled) '''
+        if not self.args.trait_exports:
+            return []
+        return self.get_catalogue().get_trait_ids()
+
+
+    def fetch(self):
+        ''' Fetch all the metadata, releases data and ancestry categories (via REST API) '''
+        if self.checkpoint.is_stage_done('fetch'):
+            return
+        rest_url_root = self.args.url
+        if not rest_url_root:
+            print('Error: the parameter "--url" is required to fetch the metadata')
+            exit(1)
+
+        # Fetch the metadata, the releases data (current and previous) and the list of ancestry categories, with concurrent requests
+        print('\t- Fetch metadata, release dates and ancestry categories')
+        rest_cache = PGSRestCache(self.args.rest_cache if self.args.rest_cache else self.args.dir+'/'+rest_cache_dir_name)
+        fetcher = PGSRestFetcher(rest_url_root, self.args.rest_concurrency, self.args.rest_rate_limit, rest_cache, self.args.rest_page_size, self.args.rest_retries)
+        fetched_data = fetcher.fetch_release_data()
+        if not fetched_data['current_release'] or not fetched_data['previous_release']:
+            print('\t/!\ Error: cannot retrieve the current and previous releases')
+            exit(1)
+        print(f'\t\t> Release: {fetched_data["current_release"]["date"]} | Previous release: {fetched_data["previous_release"]["date"]}')
+        with open(self.rest_data_file, 'w') as f:
+            json.dump(fetched_data['data'], f)
+
+        release_info = {}
+        release_info['current_release'] = fetched_data['current_release']
+        release_info['previous_release_date'] = fetched_data['previous_release']['date']
+        release_info['ancestry_categories'] = fetched_data['ancestry_categories']
+
+        with open(self.release_info_file, 'w') as f:
+            json.dump(release_info, f)
+        self.checkpoint.set_stage_done('fetch', [self.rest_data_file, self.release_info_file])
+
+
+    def export(self, stream_ftp=False):
+        '''
+        Generate the export files
+        > Parameters:
+            - stream_ftp: flag to build the FTP structure of each Score and large study as soon as it is exported
+              (streaming pipeline, see PGSFtpGenerator.start_pipeline), instead of waiting for the "build-ftp" step
+        '''
+        checkpoint = self.checkpoint
+        release_info = self.get_release_info()
+        catalogue = self.get_catalogue()
+
+        # Get the list of published PGS IDs
+        score_ids_list = catalogue.get_score_ids()
+
+        # Content-addressed store of the CSV files of the PGS and large studies exports
+        blob_store = None
+        if self.args.blob_store:
+            blob_store = PGSBlobStore(self.export_dir+blob_store_dir_name)
+
+        current_release = release_info['current_release']
+
+        exports_generator = PGSExportGenerator(self.export_dir,catalogue.data,self.scores_list_file,score_ids_list,None,current_release['date'],release_info['ancestry_categories'],debug,self.args.large_study_threshold,self.args.workers,catalogue,self.args.ancestry_table,checkpoint,blob_store=blob_store,memory_budget=self.args.worker_memory*1024*1024 if self.args.worker_memory else None,previous_tables_file=self.args.previous_tables,trait_ids_list=self.get_trait_ids())
+
+        # Generate file listing all the released Scores
+        exports_generator.generate_scores_list_file()
+
+        # Generate all PGS metadata export files
+        if not checkpoint.is_stage_done('all_metadata'):
+            all_metadata_files = exports_generator.call_generate_all_metadata_exports()
+            checkpoint.set_stage_done('all_metadata', all_metadata_files)
+
+        # Generate PGS metadata export files for each large released studies and each released studies (and each trait, if enabled)
+        # (the completed exports are recorded one by one in the journal)
+        if not checkpoint.is_stage_done('studies_metadata'):
+            # Streaming pipeline: the FTP structure is built while the Scores and large studies are exported
+            stream_ftp = stream_ftp and not checkpoint.is_stage_done('metadata_ftp')
+            if stream_ftp:
+                ftp_generator = self.get_ftp_generator()
+                exports_generator.export_queue = ftp_generator.start_pipeline()
+            exports_generator.call_generate_studies_and_large_studies_metadata_exports()
+            if stream_ftp:
+                # The plan is completed with the all metadata (exported first) and the removed entries
+                print("\t- Wait for the FTP structure of the PGS and large studies metadata files (streaming pipeline)")
+                ftp_generator.finish_pipeline()
+                checkpoint.set_stage_done('metadata_ftp')
+                checkpoint.set_stage_done('large_study_metadata_ftp')
+                checkpoint.set_stage_done('trait_metadata_ftp')
+            checkpoint.set_stage_done('studies_metadata')
+            if blob_store:
+                blob_store.report()
+
+
+    def get_ftp_generator(self):
+        ''' Return the generator of the FTP structure (created once, so the plan is shared between the steps) '''
+        if self.ftp_generator is None:
+            release_info = self.get_release_info()
+            catalogue = self.get_catalogue()
+            self.ftp_generator = PGSFtpGenerator(self.export_dir,self.new_ftp_dir,catalogue.get_score_ids(),self.get_large_publication_ids(),release_info['previous_release_date'],self.args.remote_ftp,debug,self.args.ftp_listing,self.release_manifest,self.args.archive_by_reference,self.get_trait_ids())
+        return self.ftp_generator
+
+
+    def plan(self):
+        ''' Report the changes between the export files and the FTP, without copying or downloading any file '''
+        plan = self.get_ftp_generator().get_plan()
+        plan.report()
+        return plan
+
+
+    def build_ftp(self):
+        ''' Generate the FTP structure '''
+        checkpoint = self.checkpoint
+        catalogue = self.get_catalogue()
+        release_info = self.get_release_info()
+
+        # The plan (classification of the entries) drives the build
+        ftp_generator = self.get_ftp_generator()
+        ftp_generator.get_plan().report()
+
+        # Build FTP structure for metadata files
+        if not checkpoint.is_stage_done('metadata_ftp'):
+            ftp_generator.build_metadata_ftp()
+            checkpoint.set_stage_done('metadata_ftp')
+
+        # Check that the new entries have a PGS directory
+        check_new_data_entry_in_metadata(self.new_ftp_dir,catalogue,release_info['current_release'])
+
+        # Build FTP structure for the bulk metadata files
+        if not checkpoint.is_stage_done('bulk_metadata_ftp'):
+            ftp_generator.build_bulk_metadata_ftp()
+            checkpoint.set_stage_done('bulk_metadata_ftp')
+
+        # Build FTP structure for the large study metadata files
+        if not checkpoint.is_stage_done('large_study_metadata_ftp'):
+            ftp_generator.build_large_study_metadata_ftp()
+            checkpoint.set_stage_done('large_study_metadata_ftp')
+
+        # Build FTP structure for the trait metadata files
+        if self.args.trait_exports and not checkpoint.is_stage_done('trait_metadata_ftp'):
+            ftp_generator.build_trait_metadata_ftp()
+            checkpoint.set_stage_done('trait_metadata_ftp')
+
+        # Wait for the checksums of the copied files (saved in the hash cache, for the release manifest)
+        self.release_manifest.wait()
+
+
+    def verify(self):
+        ''' Verify the files of the new FTP structure (archives, Excel and CSV files), in parallel processes '''
+        if self.checkpoint.is_stage_done('verify'):
+            return
+        print("\t- Verify the files of the new FTP structure")
+        verifier = PGSReleaseVerifier(self.new_ftp_dir, self.get_catalogue(), self.args.workers)
+        verified = verifier.run()
+        verifier.report()
+        report_file = self.content_dir+'/'+verification_report_file_name
+        verifier.write_report(report_file)
+        if not verified:
+            print(f'Error: the new FTP structure contains invalid files (see {report_file})')
+            exit(1)
+        self.checkpoint.set_stage_done('verify', [report_file])
+
+
+    def archive(self):
+        ''' Generate the release file, the manifest of the release and the compressed archive (full or delta) '''
+        checkpoint = self.checkpoint
+        current_release_date = self.get_release_info()['current_release']['date']
+        archive_file_name = '{}/../pgs_ftp_{}.tar.gz'.format(self.export_dir,current_release_date)
+
+        if not checkpoint.is_stage_done('release_file'):
+            # Generate release file (containing the release date)
+            release_filename = f'{self.new_ftp_dir}/release_date.txt'
+            try:
+               release_file = open(release_filename,'w')
+               release_file.write(current_release_date)
+               release_file.close()
+            except:
+                print(f"Can't create the release file '{release_filename}'.")
+                exit()
+
+            # Publish the checksums of all the files of the release, next to the release file
+            # (the manifest is also used to generate the delta archive of the next release)
+            release_manifest_file = self.release_manifest.write()
+            checkpoint.set_stage_done('release_file', [release_filename, release_manifest_file])
+
+        # Generates the compressed archive to be copied to the EBI Private FTP
+        if not checkpoint.is_stage_done('archive'):
+            # Delta archive: only the files added or changed since the previous release
+            if self.args.previous_manifest:
+                archive_file_name = archive_file_name.replace('.tar.gz', '_delta.tar.gz')
+                manifest = PGSReleaseManifest.read(f'{self.new_ftp_dir}/{PGSReleaseManifest.manifest_file_name}')
+                previous_manifest = PGSReleaseManifest.read(self.args.previous_manifest)
+                # Only the files of the entries removed from the release are deleted
+                deleted_files = self.get_ftp_generator().get_removed_files()
+                PGSReleaseDelta(self.new_ftp_dir).create_delta_archive(archive_file_name, manifest, previous_manifest, deleted_files)
+            else:
+                tardir(self.new_ftp_dir, archive_file_name)
+            checkpoint.set_stage_done('archive', [archive_file_name])
+
+
+    def status(self):
+        ''' Print the completed stages and exports recorded in the journal '''
+        stages = list(self.checkpoint.stages.keys())
+        print(f'Completed stage(s): {", ".join(stages) if stages else "none"}')
+        print(f'Completed export(s): {len(self.checkpoint.bundles)}')
+
 
-    debug = 0
-    tmp_export_dir_name = 'export'
-    tmp_ftp_dir_name = 'new_ftp_content'
+def main():
 
     # Script parameters
     argparser = argparse.ArgumentParser()
-    argparser.add_argument("--url", help='The URL root of the REST API, e.g. "http://127.0.0.1:8000/rest/"', required=True)
+    argparser.add_argument("command", help=f'Step of the release to run - Default: "release" (all the steps: {", ".join(commands)}). "status" lists the completed steps, "plan" reports the changes to build on the FTP (no file copied or downloaded) and "apply-delta" applies a delta archive on a mirror of the FTP.', nargs='?', choices=['release', *commands, 'status', 'plan', 'apply-delta'], default='release')
+    argparser.add_argument("--url", help='The URL root of the REST API, e.g. "http://127.0.0.1:8000/rest/" (required to fetch the metadata)')
+    argparser.add_argument("--rest_concurrency", help='Maximum number of concurrent requests to the REST API - Default: 4', type=int, default=4)
+    argparser.add_argument("--rest_rate_limit", help='Maximum number of requests per second to the REST API (0: no limit) - Default: 1.5', type=float, default=1.5)
+    argparser.add_argument("--rest_page_size", help=f'Number of results per page requested to the REST API - Default: {PGSRestFetcher.max_page_size} (maximum allowed)', type=int, default=PGSRestFetcher.max_page_size)
+    argparser.add_argument("--rest_retries", help='Number of times a REST API request is sent again after a temporary error (connection error or HTTP 429/5xx) - Default: 3', type=int, default=3)
+    argparser.add_argument("--rest_cache", help=f'Path to the directory where the REST API responses are cached, to only download the pages changed since the last fetch (conditional requests) - Default: "<dir>/{rest_cache_dir_name}"')
     argparser.add_argument("--dir", help=f'The path of the root dir of the metadata "<dir>/{tmp_ftp_dir_name}"', required=True)
     argparser.add_argument("--remote_ftp", help='Flag to indicate whether the FTP is remote (FTP protocol) or local (file system) - Default: False (file system)', action='store_true')
+    argparser.add_argument("--large_study_threshold", help=f'Minimum number of evaluated Scores for a publication to get its own metadata files (large study) - Default: {PGSExportGenerator.large_publication_threshold}', type=int, default=PGSExportGenerator.large_publication_threshold)
+    argparser.add_argument("--workers", help='Number of processes used to generate the metadata files of the Scores and large studies - Default: 1', type=int, default=1)
+    argparser.add_argument("--worker_memory", help='Memory (in MB) available per worker process for the exports in progress: the exports are scheduled largest first, a worker only starts an export whose estimated memory fits in its budget, and an export exceeding the budget runs alone - Default: no limit', type=int)
+    argparser.add_argument("--catalogue_db", help='Path to a SQLite database file where the metadata will be stored and queried from (instead of memory)')
+    argparser.add_argument("--resume", help=f'Flag to resume an interrupted release: the completed stages and exports recorded in "<dir>/{checkpoint_file_name}" are checked and skipped', action='store_true')
+    argparser.add_argument("--blob_store", help=f'Flag to write the identical CSV files of the PGS and large studies exports only once, in a content-addressed store ("<dir>/{tmp_export_dir_name}/{blob_store_dir_name}"), hardlinked to the export directories', action='store_true')
+    argparser.add_argument("--ftp_listing", help='Path to the listing of the FTP files (MD5, size, modification time and path, tab separated), used to plan the FTP build. The listing is built in one walk of the FTP (os.scandir, or MLSD with "--remote_ftp") and saved in this file, with the checksums computed for the plan: the checksums of the file are reused for the FTP files with the same size and modification time')
+    argparser.add_argument("--trait_exports", help='Flag to also generate the metadata files of each trait (all the Scores mapped to the EFO trait), in "metadata/traits/<EFO ID>/" on the FTP', action='store_true')
+    argparser.add_argument("--archive_by_reference", help='Flag to hardlink the files of the previous release archived in the new FTP structure ("archived_versions" and "previous_releases"), from the local FTP, instead of copying them. They are copied if the hardlink can\'t be created (e.g. different file systems). The FTP files must then be replaced, not overwritten in place, when the new FTP structure is published', action='store_true')
+    argparser.add_argument("--previous_manifest", help='Path to the manifest of the previous release ("pgs_ftp_manifest.tsv", published with the release): the archive only contains the files added or changed since the previous release, with the list of the deleted files ("pgs_ftp_<date>_delta.tar.gz")')
+    argparser.add_argument("--previous_tables", help=f'Path to the all metadata tables of the previous release ("<previous dir>/{tmp_export_dir_name}/{PGSExportGenerator.all_metadata_tables_file}"): only the rows of the entries changed since then are rebuilt in the all metadata files, the other rows are copied from these tables')
+    argparser.add_argument("--delta_archive", help='Path to the delta archive to apply with the command "apply-delta"')
+    argparser.add_argument("--previous_tree", help='Path to the mirror of the FTP (tree of the previous release), updated in place with the command "apply-delta"')
+    argparser.add_argument("--stream_ftp", help='Flag to build the FTP structure of each Score and large study as soon as it is exported, overlapping the exports and the FTP build (streaming pipeline, "release" command only)', action='store_true')
+    argparser.add_argument("--ancestry_table", help='Flag to also export the ancestry distributions as a table of percentages (one row per Score and stage) in the all metadata files', action='store_true')
 
     args = argparser.parse_args()
 
-    rest_url_root = args.url
-    content_dir = args.dir
-
-    use_remote_ftp = False
-    if args.remote_ftp:
-        use_remote_ftp = True
-
-    if not os.path.isdir(content_dir):
-        print(f'Directory {content_dir} can\'t be found!')
+    if not os.path.isdir(args.dir):
+        print(f'Directory {args.dir} can\'t be found!')
         exit(1)
 
-    # Setup new FTP directory
-    new_ftp_dir = content_dir+'/'+tmp_ftp_dir_name
-    create_pgs_directory(new_ftp_dir , 1)
-
-    # Setup temporary export directory
-    export_dir = content_dir+'/'+tmp_export_dir_name+'/'
-    create_pgs_directory(export_dir, 1)
-
-    # Fetch all the metadata (via REST API)
-    print('\t- Fetch metadata')
-    data = get_all_pgs_data(rest_url_root)
-
-    # Fetch releases data (current and previous)
-    print('\t- Fetch release dates')
-    current_release = get_latest_release(rest_url_root)
-    current_release_date = current_release['date']
-    previous_release_date = get_previous_release(rest_url_root)['date']
-
-    # Fetch the list of ancestry categories
-    print('\t- Fetch ancestry categories')
-    ancestry_categories = get_ancestry_categories(rest_url_root)
-
-    # Setup path to some of the extra export files
-    scores_list_file = new_ftp_dir+'/pgs_scores_list.txt'
-    archive_file_name = '{}/../pgs_ftp_{}.tar.gz'.format(export_dir,current_release_date)
-
-    #-----------------------#
-    # Generate Export files #
-    #-----------------------#
-
-    # Get the list of published PGS IDs
-    score_ids_list = [ x['id'] for x in data['score'] ]
-
-    exports_generator = PGSExportGenerator(export_dir,data,scores_list_file,score_ids_list,large_publication_ids_list,current_release_date,ancestry_categories,debug)
-
-    # Generate file listing all the released Scores
-    exports_generator.generate_scores_list_file()
-
-    # Generate all PGS metadata export files
-    exports_generator.call_generate_all_metadata_exports()
-
-    # Generate all PGS metadata export files
-    exports_generator.call_generate_large_studies_metadata_exports()
-
-    # Generate PGS metadata export files for each released studies
-    exports_generator.call_generate_studies_metadata_exports()
-
-
-    #------------------------#
-    # Generate FTP structure #
-    #------------------------#
-    ftp_generator = PGSFtpGenerator(export_dir,new_ftp_dir,score_ids_list,large_publication_ids_list,previous_release_date,use_remote_ftp,debug)
-
-    # Build FTP structure for metadata files
-    ftp_generator.build_metadata_ftp()
-
-    # Check that the new entries have a PGS directory
-    check_new_data_entry_in_metadata(new_ftp_dir,data,current_release)
-
-    # Build FTP structure for the bulk metadata files
-    ftp_generator.build_bulk_metadata_ftp()
-
-    # Build FTP structure for the large study metadata files
-    ftp_generator.build_large_study_metadata_ftp()
-
-    # Generates the compressed archive to be copied to the EBI Private FTP
-    tardir(new_ftp_dir, archive_file_name)
-
-    # Generate release file (containing the release date)
-    release_filename = f'{new_ftp_dir}/release_date.txt'
+    command = args.command
+
+    # Rebuild the tree of a release from the tree of the previous release and a delta archive
+    if command == 'apply-delta':
+        if not args.delta_archive or not args.previous_tree:
+            print('Error: the parameters "--delta_archive" and "--previous_tree" are required to apply a delta archive')
+            exit(1)
+        mismatches = PGSReleaseDelta(args.previous_tree).apply_delta_archive(args.delta_archive)
+        if mismatches:
+            print(f'Error: the rebuilt tree doesn\'t match the manifest of the release:\n - '+'\n - '.join(mismatches))
+            exit(1)
+        return
+
+    # A new release is started by the "release" and "fetch" commands, the other commands continue the current release
+    release = PGSRelease(args, command in ('release', 'fetch'))
+
+    if command == 'status':
+        release.status()
+        return
+
+    # Checksums of the files, cached between the steps and between the runs
+    hash_service = PGSHashService(args.dir+'/'+hash_cache_file_name)
+    PGSHashService.set_default(hash_service)
     try:
-       release_file = open(release_filename,'w')
-       release_file.write(current_release_date)
-       release_file.close()
-    except:
-        print(f"Can't create the release file '{release_filename}'.")
-        exit()
-
+        if command == 'plan':
+            release.plan()
+        if command in ('release', 'fetch'):
+            release.fetch()
+        if command in ('release', 'export'):
+            release.export(command == 'release' and args.stream_ftp)
+        if command in ('release', 'build-ftp'):
+            release.build_ftp()
+        if command in ('release', 'verify'):
+            release.verify()
+        if command in ('release', 'archive'):
+            release.archive()
+    finally:
+        hash_service.save()
 
 
 if __name__ == '__main__':
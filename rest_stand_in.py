@@ -0,0 +1,201 @@
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import benchmark
+
+
+#======================#
+#  REST API stand-in   #
+#======================#
+
+class PGSRestStandIn:
+    '''
+    Local stand-in of the PGS Catalog REST API, serving the test data (or a synthetic catalogue),
+    with the same pagination as the REST API ("limit" and "offset" parameters, "count", "next" and "results" in the responses),
+    the same validators (ETag and Last-Modified headers, HTTP 304 for the conditional requests) and gzip compression.
+    Latency and errors (HTTP 503) can be injected; the errors are drawn from a seeded generator, so a run can be replayed.
+    '''
+
+    default_page_size = 50
+    max_page_size = 250
+
+    def __init__(self, data=None, port=0, latency=0, page_size=None, error_rate=0, seed=0):
+        '''
+        > Variables:
+            - data: dictionary containing the metadata (test data if not provided)
+            - port: port of the server (a free port is used if not set)
+            - latency: delay (in seconds) added to each response
+            - page_size: default number of results per page
+            - error_rate: fraction of the requests answered with an error (HTTP 503)
+            - seed: seed of the generator of the errors
+        '''
+        self.data = data if data else benchmark.load_test_data()
+        self.latency = latency
+        self.page_size = page_size if page_size else self.default_page_size
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests_count = 0
+        self.not_modified_count = 0
+        self.errors_count = 0
+        # The data doesn't change while the server is running
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        # All the entries are released in the current release
+        self.releases = [
+            {
+                'date': '2020-12-15',
+                'score_count': len(self.data['score']),
+                'performance_count': len(self.data['performance']),
+                'publication_count': len(self.data['publication']),
+                'released_score_ids': [ x['id'] for x in self.data['score'] ],
+                'released_performance_ids': [ x['id'] for x in self.data['performance'] ],
+                'released_publication_ids': [ x['id'] for x in self.data['publication'] ]
+            },
+            {
+                'date': '2020-12-01', 'score_count': 0, 'performance_count': 0, 'publication_count': 0,
+                'released_score_ids': [], 'released_performance_ids': [], 'released_publication_ids': []
+            }
+        ]
+        self.ancestry_categories = { code: { 'display_category': label } for code, label in benchmark.ancestry_categories.items() }
+
+        stand_in = self
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.handle_request(self)
+            def log_message(self, format, *args):
+                pass
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+
+    @property
+    def url(self):
+        ''' Root URL of the REST API stand-in '''
+        return f'http://127.0.0.1:{self.server.server_address[1]}/rest/'
+
+
+    def start(self):
+        ''' Start the server in a background thread '''
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        ''' Stop the server '''
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def handle_request(self, handler):
+        ''' Send the response of a request '''
+        with self.lock:
+            self.requests_count += 1
+            error = self.error_rate and self.random.random() < self.error_rate
+            if error:
+                self.errors_count += 1
+        url_parts = urlsplit(handler.path)
+        parameters = dict(parse_qsl(url_parts.query))
+        endpoint = url_parts.path[len('/rest/'):].strip('/') if url_parts.path.startswith('/rest/') else None
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if error:
+            self.send_json(handler, 503, { 'detail': 'Service temporarily unavailable (injected error).' })
+            return
+
+        response = None
+        if endpoint and endpoint.endswith('/all') and endpoint[:-4] in self.data:
+            # All the cohorts can be fetched in one page
+            page_size = len(self.data[endpoint[:-4]]) if parameters.get('fetch_all') == '1' else self.page_size
+            response = self.get_page(handler, self.data[endpoint[:-4]], parameters, page_size)
+        elif endpoint == 'release/current':
+            response = self.releases[0]
+        elif endpoint == 'release/all':
+            response = self.get_page(handler, self.releases, parameters, self.page_size)
+        elif endpoint == 'ancestry_categories':
+            response = self.ancestry_categories
+
+        if response is None:
+            self.send_json(handler, 404, { 'detail': 'Not found.' })
+        else:
+            self.send_json(handler, 200, response)
+
+
+    def get_page(self, handler, results, parameters, page_size):
+        ''' Return a page of results ("limit" and "offset" parameters) '''
+        limit = min(int(parameters.get('limit', page_size)) or page_size, max(page_size, self.max_page_size))
+        offset = int(parameters.get('offset', 0))
+        next_url = None
+        if offset+limit < len(results):
+            next_parameters = dict(parameters, limit=limit, offset=offset+limit)
+            next_url = f'http://{handler.headers["Host"]}{urlsplit(handler.path).path}?{urlencode(next_parameters)}'
+        return {
+            'size': len(results[offset:offset+limit]),
+            'count': len(results),
+            'next': next_url,
+            'previous': None,
+            'results': results[offset:offset+limit]
+        }
+
+
+    def send_json(self, handler, status, content):
+        ''' Send a JSON response (HTTP 304 if the client has the same version, gzip compressed if the client accepts it) '''
+        body = json.dumps(content).encode()
+        headers = { 'Content-Type': 'application/json' }
+        if status == 200:
+            headers['ETag'] = '"'+hashlib.md5(body).hexdigest()+'"'
+            headers['Last-Modified'] = self.last_modified
+            if handler.headers.get('If-None-Match') == headers['ETag'] or \
+               (not handler.headers.get('If-None-Match') and handler.headers.get('If-Modified-Since') == self.last_modified):
+                with self.lock:
+                    self.not_modified_count += 1
+                status = 304
+                body = b''
+        if body and 'gzip' in handler.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(body))
+        handler.send_response(status)
+        for header, value in headers.items():
+            handler.send_header(header, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Local stand-in of the PGS Catalog REST API (test data or synthetic catalogue)')
+    argparser.add_argument("--port", help='Port of the server', type=int, default=8000)
+    argparser.add_argument("--scores", help='Number of Scores of the synthetic catalogue (test data if not set)', type=int)
+    argparser.add_argument("--latency", help='Delay (in seconds) added to each response', type=float, default=0)
+    argparser.add_argument("--page_size", help='Default number of results per page', type=int, default=PGSRestStandIn.default_page_size)
+    argparser.add_argument("--data_file", help='Path to metadata recorded by a previous fetch ("<dir>/pgs_rest_data.json"), served instead of the test data')
+    argparser.add_argument("--error_rate", help='Fraction of the requests answered with an error (HTTP 503)', type=float, default=0)
+    argparser.add_argument("--seed", help='Seed of the generator of the errors (the same seed replays the same errors)', type=int, default=0)
+    args = argparser.parse_args()
+
+    data = None
+    if args.data_file:
+        with open(args.data_file) as f:
+            data = json.load(f)
+    elif args.scores:
+        data = benchmark.build_synthetic_data(args.scores)
+    stand_in = PGSRestStandIn(data, args.port, args.latency, args.page_size, args.error_rate, args.seed)
+    print(f'REST API stand-in: {stand_in.url}')
+    try:
+        stand_in.server.serve_forever()
+    except KeyboardInterrupt:
+        stand_in.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,33 @@
 import os.path, shutil
+import sys
+import subprocess
+import errno
+import tarfile
+import zipfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import unittest
 import json
+import gzip
+import csv
 import hashlib
+from pgs_exports.PGSCatalogue import PGSCatalogue
+from pgs_exports.PGSCatalogueSQLite import PGSCatalogueSQLite
 from pgs_exports.PGSExportGenerator import PGSExportGenerator
+from pgs_exports.PGSExport import PGSExportAllMetadata
+from pgs_exports.PGSExportScheduler import PGSExportScheduler
 from pgs_exports.PGSBuildFtp import PGSBuildFtp
+from pgs_exports.PGSCheckpoint import PGSCheckpoint
+from pgs_exports.PGSBlobStore import PGSBlobStore
+from pgs_exports.PGSHashService import PGSHashService
+from pgs_exports.PGSFtpGenerator import PGSFtpGenerator
+from pgs_exports.PGSReleaseDelta import PGSReleaseDelta
+from pgs_exports.PGSReleaseManifest import PGSReleaseManifest
+from pgs_exports.PGSReleaseVerifier import PGSReleaseVerifier
+from pgs_exports.PGSRestCache import PGSRestCache
+from pgs_exports.PGSRestFetcher import PGSRestFetcher
+from rest_stand_in import PGSRestStandIn
 
 
 class TestSum(unittest.TestCase):
@@ -35,6 +59,8 @@ class TestSum(unittest.TestCase):
     }
 
     large_publication_ids_list = ['PGP1']
+    large_publication_threshold = 2
+    workers = 2
     
     export_dir = current_dir+'/tests/export/'
     scores_list_file = export_dir+'pgs_scores_list.txt'
@@ -62,10 +88,13 @@ class TestSum(unittest.TestCase):
 
         self.create_pgs_directory(self.export_dir)
 
+        # Compact model of the metadata
+        catalogue = PGSCatalogue(self.data)
+
         # Get the list of published PGS IDs
-        self.score_ids_list = [ x['id'] for x in self.data['score'] ]
+        self.score_ids_list = catalogue.get_score_ids()
 
-        exports_generator = PGSExportGenerator(self.export_dir,self.data,self.scores_list_file,self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug)
+        exports_generator = PGSExportGenerator(self.export_dir,catalogue.data,self.scores_list_file,self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,workers=self.workers,data_index=catalogue)
 
         # Generate file listing all the released Scores
         exports_generator.generate_scores_list_file()
@@ -80,6 +109,764 @@ class TestSum(unittest.TestCase):
         exports_generator.call_generate_studies_metadata_exports()
 
 
+    def check_large_publication_selection(self):
+        """ Check the automatic selection of the large studies (from the number of evaluated Scores) """
+        exports_generator = PGSExportGenerator(self.export_dir,self.data,self.scores_list_file,self.score_ids_list,None,self.current_release_date,self.ancestry_categories,self.debug,self.large_publication_threshold)
+        self.assertEqual(exports_generator.large_publication_ids_list,self.large_publication_ids_list)
+
+
+    def check_sqlite_catalogue(self):
+        """ Check that the SQLite catalogue returns the same entries as the in-memory catalogue """
+        catalogue = PGSCatalogue(self.data)
+        sqlite_catalogue = PGSCatalogueSQLite(self.export_dir+'catalogue.db', self.data)
+
+        # The records behave like the REST API dictionaries (only their fields are keys, not the class attributes or methods)
+        score = catalogue.get_scores([self.data['score'][0]['id']])[0]
+        self.assertEqual(sorted(score.keys()),sorted(self.data['score'][0].keys()))
+        for field in ('catalogue', 'references', 'keys', 'get', '__slots__'):
+            self.assertNotIn(field,score)
+            self.assertIsNone(score.get(field))
+        self.assertIn('trait_efo',score)
+
+        self.assertEqual(sqlite_catalogue.get_score_ids(),catalogue.get_score_ids())
+        self.assertEqual(sqlite_catalogue.get_large_publication_ids(self.large_publication_threshold),catalogue.get_large_publication_ids(self.large_publication_threshold))
+        for type in ['score', 'trait', 'publication', 'performance', 'cohort']:
+            self.assertEqual(sqlite_catalogue.count(type),catalogue.count(type))
+
+        pgs_lists = [ [], *[ [x] for x in self.score_ids_list ] ]
+        pgs_lists += [ catalogue.get_publication_evaluated_score_ids(x) for x in self.large_publication_ids_list ]
+        for pgs_list in pgs_lists:
+            for method, key in (('get_scores','id'), ('get_performances','id'), ('get_publications','id'), ('get_traits','id'), ('get_cohorts','name_short')):
+                sqlite_ids = [ x[key] for x in getattr(sqlite_catalogue,method)(pgs_list) ]
+                ids = [ x[key] for x in getattr(catalogue,method)(pgs_list) ]
+                self.assertEqual(sqlite_ids,ids)
+
+        # Subset queries
+        self.assertEqual(sqlite_catalogue.get_score_ids_by(publication_id='PGP1'),['PGS1','PGS2'])
+        self.assertEqual(sqlite_catalogue.get_score_ids_by(trait_id='EFO_0000305'),['PGS1'])
+        self.assertEqual(sqlite_catalogue.get_trait_ids(),catalogue.get_trait_ids())
+        for efo_id in catalogue.get_trait_ids():
+            self.assertEqual(sqlite_catalogue.get_trait_score_ids(efo_id),catalogue.get_trait_score_ids(efo_id))
+
+        # Estimated costs of the exports
+        self.assertEqual(sqlite_catalogue.get_scores_export_costs(),catalogue.get_scores_export_costs())
+
+
+    def check_export_scheduler(self):
+        """ Check that the export tasks are started largest first, within the memory budget """
+        scheduler = PGSExportScheduler(2, memory_budget=600)
+        scheduler.row_memory = 1
+        tasks = [ ('generate_study_metadata_export', f'PGS{x}') for x in range(5) ]
+        costs = dict(zip(tasks, [100, 1000, 100, 900, 200]))
+        lock = threading.Lock()
+        running = []
+        started = []
+        running_costs = []
+        def run_task(task):
+            with lock:
+                running.append(task)
+                started.append(costs[task])
+                running_costs.append([ costs[x] for x in running ])
+            time.sleep(0.01*costs[task]/100)
+            with lock:
+                running.remove(task)
+            return task[1]
+        completed = []
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            scheduler.run(executor, run_task, tasks, costs, lambda task, result: completed.append(result))
+        # The 2 largest tasks exceed the budget of a worker (600): they run alone, then the smaller ones run together
+        self.assertEqual(started, [1000, 900, 200, 100, 100])
+        for task_costs in running_costs:
+            self.assertTrue(len(task_costs) == 1 or max(task_costs) <= 600)
+        self.assertTrue(max([ len(x) for x in running_costs ]) == 2)
+        self.assertEqual(sorted(completed), sorted([ x[1] for x in tasks ]))
+        self.assertTrue(0 < scheduler.get_utilization() <= 1)
+
+        # Costs estimated from the metadata: the large study is the largest task
+        catalogue = PGSCatalogue(self.data)
+        tasks = [ ('generate_large_study_metadata_export', 'PGP1') ] + [ ('generate_study_metadata_export', x) for x in self.score_ids_list ]
+        costs = scheduler.get_tasks_costs(tasks, catalogue)
+        self.assertEqual(max(costs, key=lambda x: costs[x]), tasks[0])
+
+
+    def check_csv_backends(self):
+        """ Check that the CSV files written without Pandas are identical to the reference files, for all the types of export """
+        csv_backends = { 'all': 'csv', 'publication': 'csv', 'score': 'csv' }
+        export_dir = self.export_dir
+        self.export_dir = self.current_dir+'/tests/export_csv/'
+        self.scores_list_file = self.export_dir+'pgs_scores_list.txt'
+        self.create_pgs_directory(self.export_dir)
+        try:
+            catalogue = PGSCatalogue(self.data)
+            exports_generator = PGSExportGenerator(self.export_dir,catalogue.data,self.scores_list_file,self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,data_index=catalogue,csv_backends=csv_backends)
+            exports_generator.generate_scores_list_file()
+            exports_generator.call_generate_all_metadata_exports()
+            exports_generator.call_generate_studies_and_large_studies_metadata_exports()
+            self.compare_files()
+        finally:
+            shutil.rmtree(self.export_dir,ignore_errors=True)
+            self.export_dir = export_dir
+            self.scores_list_file = self.export_dir+'pgs_scores_list.txt'
+
+
+    def check_csv_encoding(self):
+        """ Check that the CSV files are written in UTF-8 whatever the locale, and that a failed CSV file is not left in the export """
+        export_dir = self.current_dir+'/tests/export_encoding/'
+        self.create_pgs_directory(export_dir)
+        code = (
+            'import os, sys\n'
+            'from pgs_exports.PGSExport import PGSExport\n'
+            'export_dir = sys.argv[1]\n'
+            'pgs_export = PGSExport(export_dir+"test_metadata.xlsx", { x: [] for x in ("score", "trait", "publication", "performance", "cohort") }, {}, csv_backend="csv")\n'
+            'pgs_export.write_csv({"Name": ["J\\u00f6nk\\u00f6ping"]}, export_dir+"test", "cohorts", "Cohorts")\n'
+            'try:\n'
+            '    pgs_export.write_csv({"Name": ["a", "b"], "Country": ["c"]}, export_dir+"failed", "cohorts", "Cohorts")\n'
+            'except ValueError:\n'
+            '    print("failed")\n'
+            'pandas_export = PGSExport(export_dir+"pandas_metadata.xlsx", { x: [] for x in ("score", "trait", "publication", "performance", "cohort") }, {})\n'
+            'try:\n'
+            '    pandas_export.generate_csv({"Name": ["a", "b"], "Country": ["c"]}, export_dir+"failed_pandas", "cohorts", "Cohorts")\n'
+            'except ValueError:\n'
+            '    print("failed_pandas")\n'
+            'pgs_export = PGSExport(export_dir+"bundle_metadata.xlsx", { x: [] for x in ("score", "trait", "publication", "performance", "cohort") }, {}, csv_backend="csv", in_memory_bundle=True)\n'
+            'pgs_export.write_csv({"Name": ["J\\u00f6nk\\u00f6ping"]}, export_dir+"bundle", "cohorts", "Cohorts")\n'
+            'sys.stdout.flush()\n'
+            'sys.stdout.buffer.write(pgs_export.bundle.files["bundle_metadata_cohorts.csv"])\n'
+        )
+        # ASCII locale (without the coercion to UTF-8)
+        env = dict(os.environ, LC_ALL='C', PYTHONCOERCECLOCALE='0', PYTHONUTF8='0')
+        try:
+            result = subprocess.run([sys.executable, '-c', code, export_dir], cwd=self.current_dir, env=env, capture_output=True)
+            self.assertEqual(result.returncode, 0, result.stderr.decode(errors='replace'))
+            self.assertIn(b'failed', result.stdout)
+            self.assertIn(b'failed_pandas', result.stdout)
+            csv_data = 'Name\nJ\u00f6nk\u00f6ping\n'.encode('utf-8')
+            for filename in ['test_metadata_cohorts.csv', 'bundle_metadata_cohorts.csv']:
+                with open(export_dir+filename, 'rb') as f:
+                    self.assertEqual(f.read(), csv_data)
+            # The file kept in the in-memory bundle has the same content
+            self.assertTrue(result.stdout.endswith(csv_data))
+            self.assertFalse(os.path.exists(export_dir+'failed_metadata_cohorts.csv'))
+            self.assertFalse(os.path.exists(export_dir+'failed_pandas_metadata_cohorts.csv'))
+        finally:
+            shutil.rmtree(export_dir,ignore_errors=True)
+
+
+    def check_ancestry_table(self):
+        """ Check the table of the ancestry distributions (--ancestry_table) and the formatted distributions of each separator """
+        export_dir = self.export_dir
+        self.export_dir = self.current_dir+'/tests/export_ancestry/'
+        self.scores_list_file = self.export_dir+'pgs_scores_list.txt'
+        self.create_pgs_directory(self.export_dir)
+        try:
+            catalogue = PGSCatalogue(self.data)
+            exports_generator = PGSExportGenerator(self.export_dir,catalogue.data,self.scores_list_file,self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,data_index=catalogue,ancestry_table=True)
+            exports_generator.generate_scores_list_file()
+            exports_generator.call_generate_all_metadata_exports()
+            with open(self.export_dir+'all_metadata/pgs_all_metadata_ancestry_distribution.csv') as f:
+                rows = { (row['pgs_id'], row['stage']): row for row in csv.DictReader(f) }
+            self.assertEqual(list(rows.keys())[:3],[('PGS1','gwas'),('PGS1','dev'),('PGS1','eval')])
+            self.assertEqual(rows[('PGS3','eval')]['AFR'],'12.5')
+            self.assertEqual(rows[('PGS3','eval')]['EUR'],'42.5')
+            self.assertEqual(rows[('PGS3','eval')]['GME'],'')
+            self.assertEqual(rows[('PGS2','eval')]['EUR'],'100.0')
+            self.assertNotIn(('PGS2','dev'),rows)
+
+            # The formatted distributions depend on the separator
+            self.assertEqual(catalogue.get_ancestry_distribution('PGS1','eval',self.ancestry_categories,'|'),'European:66.7|Multi-ancestry (including European):33.3')
+            self.assertEqual(catalogue.get_ancestry_distribution('PGS1','eval',self.ancestry_categories,', '),'European:66.7, Multi-ancestry (including European):33.3')
+        finally:
+            shutil.rmtree(self.export_dir,ignore_errors=True)
+            self.export_dir = export_dir
+            self.scores_list_file = self.export_dir+'pgs_scores_list.txt'
+
+
+    def check_blob_store(self):
+        """ Check that the CSV files written through the blob store are identical to the reference files, and stored once """
+        export_dir = self.export_dir
+        self.export_dir = self.current_dir+'/tests/export_blobs/'
+        self.scores_list_file = self.export_dir+'pgs_scores_list.txt'
+        self.create_pgs_directory(self.export_dir)
+        try:
+            blob_store = PGSBlobStore(self.export_dir+'.blobs')
+            catalogue = PGSCatalogue(self.data)
+            exports_generator = PGSExportGenerator(self.export_dir,catalogue.data,self.scores_list_file,self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,data_index=catalogue,blob_store=blob_store)
+            exports_generator.generate_scores_list_file()
+            exports_generator.call_generate_all_metadata_exports()
+            exports_generator.call_generate_studies_and_large_studies_metadata_exports()
+            self.compare_files()
+
+            stats = blob_store.report()
+            csv_count = len([ x for pgs_id in self.score_ids_list for x in os.listdir(f'{self.export_dir}{pgs_id}/Metadata') if x.endswith('.csv') ])
+            csv_count += len([ x for x in os.listdir(f'{self.export_dir}publications_metadata/PGP1') if x.endswith('.csv') ])
+            self.assertEqual(stats['files'], csv_count)
+            self.assertLess(stats['blobs'], stats['files'])
+            self.assertGreater(stats['dedup_ratio'], 1)
+        finally:
+            shutil.rmtree(self.export_dir,ignore_errors=True)
+            self.export_dir = export_dir
+            self.scores_list_file = self.export_dir+'pgs_scores_list.txt'
+
+
+    def check_export_bundle(self):
+        """ Check that the tar files built from the in-memory bundles are identical to the ones built from the directories, and reproducible """
+        export_dir = self.current_dir+'/tests/export_disk/'
+        self.create_pgs_directory(export_dir)
+        try:
+            catalogue = PGSCatalogue(self.data)
+            exports_generator = PGSExportGenerator(export_dir,catalogue.data,export_dir+'pgs_scores_list.txt',self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,data_index=catalogue)
+            exports_generator.in_memory_bundles = { 'all': False, 'publication': False, 'score': False }
+            exports_generator.call_generate_studies_and_large_studies_metadata_exports()
+            tar_files = [ (f'{pgs_id}_metadata.tar.gz', f'{pgs_id}/Metadata/') for pgs_id in self.score_ids_list ]
+            tar_files += [ (f'publications_metadata/{pgp_id}_metadata.tar.gz', f'publications_metadata/{pgp_id}/') for pgp_id in self.large_publication_ids_list ]
+            for tar_file, datadir in tar_files:
+                with tarfile.open(self.export_dir+tar_file) as bundle_tar, tarfile.open(export_dir+tar_file) as disk_tar:
+                    bundle_members = bundle_tar.getmembers()
+                    disk_members = disk_tar.getmembers()
+                    self.assertEqual([ (x.name, x.type, x.mode, x.uname) for x in bundle_members ], [ (x.name, x.type, x.mode, x.uname) for x in disk_members ])
+                    for member in bundle_members[1:]:
+                        content = bundle_tar.extractfile(member).read()
+                        # Same content as the loose file
+                        with open(self.export_dir+datadir+member.name, 'rb') as f:
+                            self.assertEqual(content, f.read())
+                        self.assertEqual(content, disk_tar.extractfile(member.name).read())
+                # The exports generated at different times are identical (Excel files and archives)
+                self.assertEqual(self.get_md5_file_checksum(self.export_dir+tar_file), self.get_md5_file_checksum(export_dir+tar_file))
+                for filename in os.listdir(self.export_dir+datadir):
+                    self.assertEqual(self.get_md5_file_checksum(self.export_dir+datadir+filename), self.get_md5_file_checksum(export_dir+datadir+filename))
+        finally:
+            shutil.rmtree(export_dir,ignore_errors=True)
+
+
+    def check_incremental_all_metadata(self):
+        """ Check that the all metadata files patched from the tables of a previous release are identical to a full rebuild """
+        export_dir = self.current_dir+'/tests/export_incremental/'
+        self.create_pgs_directory(export_dir)
+        try:
+            tables = PGSExportAllMetadata.read_tables(self.export_dir+PGSExportGenerator.all_metadata_tables_file)
+            scores_rows = tables['tables']['scores']['rows']
+            self.assertEqual(list(scores_rows.keys()), self.score_ids_list)
+            # Previous release: PGS2 not released yet, and PGS3 with different values (different hash of its source data)
+            del scores_rows['PGS2']
+            del tables['tables']['scores']['hashes']['PGS2']
+            del tables['tables']['samples_development']['rows']['PGS2']
+            scores_rows['PGS3'][0][1] = 'Previous name'
+            tables['tables']['scores']['hashes']['PGS3'] = 'previous'
+            previous_tables_file = export_dir+'previous_tables.json.gz'
+
+            catalogue = PGSCatalogue(self.data)
+            for unchanged_name in ('Unchanged name', None):
+                # The rows of the entries which haven't changed are copied from the previous tables
+                if unchanged_name:
+                    original_name = scores_rows['PGS1'][0][1]
+                    scores_rows['PGS1'][0][1] = unchanged_name
+                else:
+                    scores_rows['PGS1'][0][1] = original_name
+                with gzip.open(previous_tables_file, 'wt') as f:
+                    json.dump(tables, f)
+                exports_generator = PGSExportGenerator(export_dir,catalogue.data,export_dir+'pgs_scores_list.txt',self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,data_index=catalogue,previous_tables_file=previous_tables_file)
+                exports_generator.call_generate_all_metadata_exports()
+                with open(export_dir+'all_metadata/pgs_all_metadata_scores.csv') as f:
+                    scores_csv = f.read()
+                if unchanged_name:
+                    self.assertIn(unchanged_name, scores_csv)
+                    self.assertNotIn('Previous name', scores_csv)
+            self.compare_incremental_all_metadata(export_dir)
+
+            # Previous release with another label for a trait and another name for a cohort: the rows of the Scores,
+            # samples and Sample Sets displaying them are rebuilt, not only the trait and cohort rows
+            trait_id = self.data['score'][0]['trait_efo'][0]['id']
+            cohort_id = self.data['performance'][0]['sampleset']['samples'][0]['cohorts'][0]['name_short']
+            def edit_entries(value):
+                if isinstance(value, list):
+                    for x in value:
+                        edit_entries(x)
+                elif isinstance(value, dict):
+                    if value.get('id') == trait_id and 'label' in value:
+                        value['label'] = 'Previous trait label'
+                    if value.get('name_short') == cohort_id and 'name_full' in value:
+                        value['name_full'] = 'Previous cohort name'
+                    for x in value.values():
+                        edit_entries(x)
+            previous_data = json.loads(json.dumps(self.data))
+            edit_entries(previous_data)
+            previous_export_dir = export_dir+'previous/'
+            self.create_pgs_directory(previous_export_dir)
+            previous_catalogue = PGSCatalogue(previous_data)
+            exports_generator = PGSExportGenerator(previous_export_dir,previous_catalogue.data,previous_export_dir+'pgs_scores_list.txt',self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,data_index=previous_catalogue)
+            exports_generator.call_generate_all_metadata_exports()
+            with open(previous_export_dir+'all_metadata/pgs_all_metadata_scores.csv') as f:
+                self.assertIn('Previous trait label', f.read())
+
+            exports_generator = PGSExportGenerator(export_dir,catalogue.data,export_dir+'pgs_scores_list.txt',self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,data_index=catalogue,previous_tables_file=previous_export_dir+PGSExportGenerator.all_metadata_tables_file)
+            exports_generator.call_generate_all_metadata_exports()
+            for csv_file in os.listdir(export_dir+'all_metadata'):
+                if csv_file.endswith('.csv'):
+                    with open(export_dir+'all_metadata/'+csv_file) as f:
+                        csv_content = f.read()
+                    self.assertNotIn('Previous trait label', csv_content)
+                    self.assertNotIn('Previous cohort name', csv_content)
+            self.compare_incremental_all_metadata(export_dir)
+        finally:
+            shutil.rmtree(export_dir,ignore_errors=True)
+
+
+    def compare_incremental_all_metadata(self, export_dir):
+        """ Check that the all metadata files patched from the tables of a previous release are the same as the full export ones """
+        # Same files as the full rebuild (the Excel files only differ by their creation date)
+        csv_files = sorted([ x for x in os.listdir(self.export_dir+'all_metadata') if x.endswith('.csv') ])
+        self.assertEqual(csv_files, sorted([ x for x in os.listdir(export_dir+'all_metadata') if x.endswith('.csv') ]))
+        for csv_file in csv_files:
+            with open(self.export_dir+'all_metadata/'+csv_file) as full_file, open(export_dir+'all_metadata/'+csv_file) as patched_file:
+                self.assertEqual(full_file.read(), patched_file.read())
+        with zipfile.ZipFile(self.export_dir+'all_metadata/pgs_all_metadata.xlsx') as full_xlsx, zipfile.ZipFile(export_dir+'all_metadata/pgs_all_metadata.xlsx') as patched_xlsx:
+            for name in full_xlsx.namelist():
+                if name != 'docProps/core.xml':
+                    self.assertEqual(full_xlsx.read(name), patched_xlsx.read(name))
+        # The patched tables are the same as the full export ones
+        self.assertEqual(PGSExportAllMetadata.read_tables(export_dir+PGSExportGenerator.all_metadata_tables_file), PGSExportAllMetadata.read_tables(self.export_dir+PGSExportGenerator.all_metadata_tables_file))
+
+
+    def check_hash_service(self):
+        """ Check the checksums computed by the hashing service, and the persistent cache """
+        cache_file = self.export_dir+'hash_cache.json'
+        filenames = [ f'{self.export_dir}{pgs_id}/Metadata/{pgs_id}_metadata_scores.csv' for pgs_id in self.score_ids_list ]
+        hash_service = PGSHashService(cache_file)
+        checksums = hash_service.get_checksums(filenames)
+        for filename in filenames:
+            self.assertEqual(checksums[filename], self.get_md5_file_checksum(filename))
+        self.assertEqual(hash_service.get_checksum(filenames[0], 'sha256'), hashlib.sha256(open(filenames[0],'rb').read()).hexdigest())
+        hash_service.save()
+
+        # Unchanged files: the checksums are read from the cache file
+        hash_service = PGSHashService(cache_file)
+        compute_checksums = hash_service.compute_checksums
+        hash_service.compute_checksums = None
+        self.assertEqual(hash_service.get_checksums(filenames), checksums)
+
+        # Modified file: the checksum is computed again
+        hash_service.compute_checksums = compute_checksums
+        content = open(filenames[0]).read()
+        with open(filenames[0], 'a') as f:
+            f.write('\n')
+        self.assertEqual(hash_service.get_checksum(filenames[0]), self.get_md5_file_checksum(filenames[0]))
+        with open(filenames[0], 'w') as f:
+            f.write(content)
+        os.remove(cache_file)
+
+
+    def check_rest_fetcher(self):
+        """ Check the data fetched concurrently from a local stand-in of the REST API (with pagination), then fetched again from the cache """
+        cache_dir = self.export_dir+'rest_cache'
+        stand_in = PGSRestStandIn().start()
+        try:
+            fetcher = PGSRestFetcher(stand_in.url, concurrency=4, cache=PGSRestCache(cache_dir), page_size=2)
+            fetched_data = fetcher.fetch_release_data()
+            # Second fetch: conditional requests, all the responses are reused from the cache
+            cached_fetcher = PGSRestFetcher(stand_in.url, concurrency=4, cache=PGSRestCache(cache_dir), page_size=2)
+            cached_data = cached_fetcher.fetch_release_data()
+        finally:
+            stand_in.stop()
+            shutil.rmtree(cache_dir,ignore_errors=True)
+        self.assertEqual(fetched_data['data'], self.data)
+        self.assertEqual(fetched_data['current_release']['date'], self.current_release_date)
+        self.assertEqual(fetched_data['previous_release']['date'], '2020-12-01')
+        self.assertEqual(fetched_data['ancestry_categories'], self.ancestry_categories)
+        # First page of each endpoint, then the other pages
+        self.assertEqual(fetcher.requests_count+cached_fetcher.requests_count, stand_in.requests_count)
+        self.assertEqual(fetcher.not_modified_count, 0)
+        self.assertEqual(cached_data, fetched_data)
+        self.assertEqual(cached_fetcher.not_modified_count, cached_fetcher.requests_count)
+        self.assertEqual(cached_fetcher.requests_count, fetcher.requests_count)
+
+        # Injected errors: the requests are retried
+        stand_in = PGSRestStandIn(error_rate=0.3, seed=1).start()
+        try:
+            retry_fetcher = PGSRestFetcher(stand_in.url, concurrency=4, page_size=2, retries=10)
+            retry_fetcher.retry_delay = 0
+            retry_data = retry_fetcher.fetch_release_data()
+        finally:
+            stand_in.stop()
+        self.assertTrue(stand_in.errors_count > 0)
+        self.assertEqual(retry_fetcher.retries_count, stand_in.errors_count)
+        self.assertEqual(retry_data, fetched_data)
+
+
+    def check_checkpoint(self):
+        """ Check that the completed exports are recorded in the checkpoint journal and skipped when resuming """
+        journal_file = self.export_dir+'checkpoint.jsonl'
+        checkpoint = PGSCheckpoint(journal_file)
+        catalogue = PGSCatalogue(self.data)
+        exports_generator = PGSExportGenerator(self.export_dir,catalogue.data,self.scores_list_file,self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,data_index=catalogue,checkpoint=checkpoint)
+        exports_generator.call_generate_studies_metadata_exports()
+
+        # Resume: all the exports are completed
+        checkpoint = PGSCheckpoint(journal_file, True)
+        for pgs_id in self.score_ids_list:
+            self.assertTrue(checkpoint.is_bundle_done(pgs_id))
+
+        # Modified export file
+        with open(f'{self.export_dir}{self.score_ids_list[0]}/Metadata/{self.score_ids_list[0]}_metadata_scores.csv', 'a') as f:
+            f.write('\n')
+        self.assertFalse(checkpoint.is_bundle_done(self.score_ids_list[0]))
+        os.remove(journal_file)
+
+        # Restore the export file
+        exports_generator.generate_study_metadata_export(self.score_ids_list[0])
+
+
+    def check_ftp_plan(self):
+        """ Check the classification of the entries by the FTP build plan, and the FTP structure built from the plan """
+        ftp_dir = self.current_dir+'/tests/ftp/'
+        new_ftp_dir = self.current_dir+'/tests/new_ftp_content'
+        ref_new_ftp_dir = self.current_dir+'/tests/new_ftp_content_reference'
+        ftp_path = PGSBuildFtp.ftp_path
+        PGSBuildFtp.ftp_path = ftp_dir
+        try:
+            # Local FTP from the previous release: PGS1 unchanged, PGS2 updated (with different CSV files),
+            # PGS3 new, PGS9 removed and PGP1 updated (without CSV files on the FTP)
+            for pgs_id in ['PGS1', 'PGS2']:
+                shutil.copytree(f'{self.export_dir}{pgs_id}/Metadata', f'{ftp_dir}scores/{pgs_id}/Metadata')
+                shutil.copy2(f'{self.export_dir}{pgs_id}_metadata.tar.gz', f'{ftp_dir}scores/{pgs_id}/Metadata/')
+            for filename in ['PGS2_metadata.xlsx', 'PGS2_metadata_scores.csv']:
+                with open(f'{ftp_dir}scores/PGS2/Metadata/{filename}', 'ab') as f:
+                    f.write(b'\n')
+            os.makedirs(f'{ftp_dir}scores/PGS9/Metadata')
+            shutil.copy2(f'{self.export_dir}PGS1/Metadata/PGS1_metadata.xlsx', f'{ftp_dir}scores/PGS9/Metadata/PGS9_metadata.xlsx')
+            os.makedirs(f'{ftp_dir}scores/PGS9/Metadata/archived_versions')
+            shutil.copy2(f'{self.export_dir}PGS1_metadata.tar.gz', f'{ftp_dir}scores/PGS9/Metadata/archived_versions/PGS9_metadata_2020-06-01.tar.gz')
+            os.makedirs(f'{ftp_dir}metadata/publications/PGP1')
+            shutil.copy2(f'{self.export_dir}publications_metadata/PGP1_metadata.tar.gz', f'{ftp_dir}metadata/publications/PGP1/')
+            shutil.copy2(f'{self.export_dir}PGS1/Metadata/PGS1_metadata.xlsx', f'{ftp_dir}metadata/publications/PGP1/PGP1_metadata.xlsx')
+            shutil.copy2(f'{self.export_dir}pgs_all_metadata.tar.gz', f'{ftp_dir}metadata/')
+            shutil.copy2(f'{self.export_dir}all_metadata/pgs_all_metadata.xlsx', f'{ftp_dir}metadata/')
+
+            # PGS1 is exported again (later than the files of the FTP): its files are identical, so it stays unchanged
+            time.sleep(1.1)
+            catalogue = PGSCatalogue(self.data)
+            exports_generator = PGSExportGenerator(self.export_dir,catalogue.data,self.scores_list_file,self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,data_index=catalogue)
+            exports_generator.generate_study_metadata_export('PGS1')
+
+            release_manifest = PGSReleaseManifest(new_ftp_dir)
+            ftp_generator = PGSFtpGenerator(self.export_dir,new_ftp_dir,self.score_ids_list,self.large_publication_ids_list,'2020-12-01',False,self.debug,self.export_dir+'ftp_listing.tsv',release_manifest)
+            plan = ftp_generator.get_plan()
+            plan.report()
+            self.assertEqual(plan.get_ids('score', 'unchanged'), ['PGS1'])
+            self.assertEqual(plan.get_ids('score', 'changed'), ['PGS2'])
+            self.assertEqual(plan.get_ids('score', 'new'), ['PGS3'])
+            self.assertEqual(plan.get_ids('score', 'removed'), ['PGS9'])
+            # Files deleted from the FTP: the archives of the previous releases are kept
+            self.assertEqual(ftp_generator.get_removed_files(), ['scores/PGS9/Metadata/PGS9_metadata.xlsx'])
+            self.assertEqual(plan.get_ids('publication', 'changed'), ['PGP1'])
+            self.assertEqual(plan.get_ids('all', 'unchanged'), ['all'])
+            self.assertTrue(plan.entries['score']['PGS2']['archive'])
+            self.assertIsNone(plan.entries['publication']['PGP1']['archive'])
+            self.assertEqual(plan.get_archive_size('score'), os.path.getsize(f'{ftp_dir}scores/PGS2/Metadata/PGS2_metadata.tar.gz'))
+
+            # The listing saved in the listing file is reused, with the checksums computed for the plan
+            ftp_listing = PGSBuildFtp.get_ftp_listing(self.export_dir+'ftp_listing.tsv')
+            self.assertEqual({ x: e[:2] for x, e in ftp_listing.files.items() }, { x: e[:2] for x, e in PGSBuildFtp.list_ftp_files().files.items() })
+            self.assertEqual(ftp_listing.files['scores/PGS1/Metadata/PGS1_metadata.xlsx'][2], self.get_md5_file_checksum(f'{ftp_dir}scores/PGS1/Metadata/PGS1_metadata.xlsx'))
+            # PGS2: the Excel file and the scores CSV file have a different size, they are not hashed
+            self.assertIsNone(ftp_listing.files['scores/PGS2/Metadata/PGS2_metadata.xlsx'][2])
+            self.assertEqual(ftp_listing.get_dir_files('metadata/publications/PGP1/'), ['PGP1_metadata.tar.gz', 'PGP1_metadata.xlsx'])
+
+            # The listing file is refreshed: the checksums of the files modified since (different size or mtime) and the files removed are dropped
+            listing_lines = []
+            with open(self.export_dir+'ftp_listing.tsv') as f:
+                for line in f.read().splitlines():
+                    md5, size, mtime, filepath = line.split('\t')
+                    if filepath == 'scores/PGS1/Metadata/PGS1_metadata.xlsx':
+                        line = f'{"0"*32}\t{size}\t{int(mtime)-10}\t{filepath}'
+                    listing_lines.append(line)
+            listing_lines.append(f'{"0"*32}\t10\t0\tscores/PGS8/Metadata/PGS8_metadata.xlsx')
+            with open(self.export_dir+'ftp_listing.tsv', 'w') as f:
+                f.write('\n'.join(listing_lines)+'\n')
+            ftp_listing = PGSBuildFtp.get_ftp_listing(self.export_dir+'ftp_listing.tsv')
+            self.assertIsNone(ftp_listing.files['scores/PGS1/Metadata/PGS1_metadata.xlsx'][2])
+            self.assertEqual(ftp_listing.get_md5('scores/PGS1/Metadata/PGS1_metadata.xlsx'), self.get_md5_file_checksum(f'{ftp_dir}scores/PGS1/Metadata/PGS1_metadata.xlsx'))
+            self.assertNotIn('scores/PGS8/Metadata/PGS8_metadata.xlsx', ftp_listing)
+            self.assertEqual(ftp_listing.files['metadata/pgs_all_metadata.xlsx'][2], self.get_md5_file_checksum(f'{ftp_dir}metadata/pgs_all_metadata.xlsx'))
+            with open(self.export_dir+'ftp_listing.tsv') as f:
+                self.assertNotIn('PGS8', f.read())
+            # File modified within the same second (same size): the modification time is compared in nanoseconds
+            all_meta_xlsx = f'{ftp_dir}metadata/pgs_all_metadata.xlsx'
+            mtime_ns = os.stat(all_meta_xlsx).st_mtime_ns
+            new_mtime_ns = mtime_ns - mtime_ns % 1000000000 + (1 if mtime_ns % 1000000000 != 1 else 2)
+            os.utime(all_meta_xlsx, ns=(new_mtime_ns, new_mtime_ns))
+            ftp_listing = PGSBuildFtp.get_ftp_listing(self.export_dir+'ftp_listing.tsv')
+            self.assertEqual(ftp_listing.files['metadata/pgs_all_metadata.xlsx'][1], new_mtime_ns)
+            self.assertIsNone(ftp_listing.files['metadata/pgs_all_metadata.xlsx'][2])
+
+            # FTP structure built from the plan
+            ftp_generator.build_metadata_ftp()
+            ftp_generator.build_bulk_metadata_ftp()
+            ftp_generator.build_large_study_metadata_ftp()
+            self.assertEqual(os.listdir(f'{new_ftp_dir}/scores/PGS1/Metadata'), [])
+            self.assertTrue(os.path.isfile(f'{new_ftp_dir}/scores/PGS2/Metadata/archived_versions/PGS2_metadata_2020-12-01.tar.gz'))
+            self.assertTrue(os.path.isfile(f'{new_ftp_dir}/scores/PGS3/Metadata/PGS3_metadata_scores.csv'))
+            self.assertFalse(os.path.isdir(f'{new_ftp_dir}/scores/PGS9'))
+            self.assertFalse(os.path.isdir(f'{new_ftp_dir}/metadata/publications/PGP1/archived_versions'))
+            self.assertTrue(os.path.isfile(f'{new_ftp_dir}/metadata/previous_releases/2020/pgs_all_metadata_2020-12-01.tar.gz'))
+            archived_files = {
+                'scores/PGS2/Metadata/archived_versions/PGS2_metadata_2020-12-01.tar.gz': 'scores/PGS2/Metadata/PGS2_metadata.tar.gz',
+                'metadata/previous_releases/2020/pgs_all_metadata_2020-12-01.tar.gz': 'metadata/pgs_all_metadata.tar.gz'
+            }
+            for archived_file, ftp_file in archived_files.items():
+                self.assertFalse(os.path.samefile(f'{new_ftp_dir}/{archived_file}', ftp_dir+ftp_file))
+
+            # Release manifest, listing all the files of the new FTP structure
+            manifest_file = release_manifest.write()
+            with open(manifest_file) as f:
+                manifest_lines = f.read().splitlines()
+            self.assertEqual(manifest_lines[0], 'path\tsize\tmd5\tsha256')
+            ftp_files = [ os.path.relpath(os.path.join(root, x), new_ftp_dir) for root, dirs, files in os.walk(new_ftp_dir) for x in files ]
+            self.assertEqual(sorted([ x.split('\t')[0] for x in manifest_lines[1:] ]), sorted([ x for x in ftp_files if x != PGSReleaseManifest.manifest_file_name ]))
+            for line in manifest_lines[1:]:
+                filepath, size, md5, sha256 = line.split('\t')
+                self.assertEqual(md5, self.get_md5_file_checksum(f'{new_ftp_dir}/{filepath}'))
+                self.assertEqual(sha256, hashlib.sha256(open(f'{new_ftp_dir}/{filepath}','rb').read()).hexdigest())
+
+            # Archives of the previous release hardlinked from the FTP, with the same FTP structure
+            ref_ftp_generator = PGSFtpGenerator(self.export_dir,ref_new_ftp_dir,self.score_ids_list,self.large_publication_ids_list,'2020-12-01',False,self.debug,archive_by_reference=True)
+            ref_ftp_generator.build_metadata_ftp()
+            ref_ftp_generator.build_bulk_metadata_ftp()
+            ref_ftp_generator.build_large_study_metadata_ftp()
+            for archived_file, ftp_file in archived_files.items():
+                self.assertTrue(os.path.samefile(f'{ref_new_ftp_dir}/{archived_file}', ftp_dir+ftp_file))
+            trees = {}
+            for name, tree_dir in (('copy', new_ftp_dir), ('reference', ref_new_ftp_dir)):
+                trees[name] = { os.path.relpath(os.path.join(root, x), tree_dir): self.get_md5_file_checksum(os.path.join(root, x)) for root, dirs, files in os.walk(tree_dir) for x in files if x != PGSReleaseManifest.manifest_file_name }
+            self.assertEqual(trees['copy'], trees['reference'])
+
+            # The file is copied if the hardlink can't be created (different file systems)
+            def cross_device_link(source, destination):
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            link = os.link
+            os.link = cross_device_link
+            try:
+                PGSBuildFtp.link_file(ftp_dir+'metadata/pgs_all_metadata.tar.gz', ref_new_ftp_dir+'/pgs_all_metadata_copy.tar.gz')
+            finally:
+                os.link = link
+            self.assertFalse(os.path.samefile(ftp_dir+'metadata/pgs_all_metadata.tar.gz', ref_new_ftp_dir+'/pgs_all_metadata_copy.tar.gz'))
+            self.assertEqual(self.get_md5_file_checksum(ftp_dir+'metadata/pgs_all_metadata.tar.gz'), self.get_md5_file_checksum(ref_new_ftp_dir+'/pgs_all_metadata_copy.tar.gz'))
+        finally:
+            PGSBuildFtp.ftp_path = ftp_path
+            shutil.rmtree(ftp_dir,ignore_errors=True)
+            shutil.rmtree(new_ftp_dir,ignore_errors=True)
+            shutil.rmtree(ref_new_ftp_dir,ignore_errors=True)
+            if os.path.isfile(self.export_dir+'ftp_listing.tsv'):
+                os.remove(self.export_dir+'ftp_listing.tsv')
+
+
+    def check_ftp_pipeline(self):
+        """ Check that the streaming pipeline (FTP structure built as the entries are exported) builds the same FTP structure as the staged build """
+        ftp_dir = self.current_dir+'/tests/ftp/'
+        new_ftp_dirs = { x: f'{self.current_dir}/tests/new_ftp_content_{x}' for x in ('streaming', 'staged') }
+        ftp_path = PGSBuildFtp.ftp_path
+        PGSBuildFtp.ftp_path = ftp_dir
+        try:
+            os.makedirs(ftp_dir+'scores')
+            os.makedirs(ftp_dir+'metadata')
+            # Streaming: the FTP structure of each entry is built as soon as it is exported (2 worker processes)
+            ftp_generator = PGSFtpGenerator(self.export_dir,new_ftp_dirs['streaming'],self.score_ids_list,self.large_publication_ids_list,'2020-12-01',False,self.debug)
+            exports_generator = PGSExportGenerator(self.export_dir,self.data,self.scores_list_file,self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,workers=2)
+            exports_generator.export_queue = ftp_generator.start_pipeline()
+            exports_generator.call_generate_studies_and_large_studies_metadata_exports()
+            streaming_plan = ftp_generator.finish_pipeline()
+            ftp_generator.build_bulk_metadata_ftp()
+
+            # Staged: the FTP structure is built from the exports
+            ftp_generator = PGSFtpGenerator(self.export_dir,new_ftp_dirs['staged'],self.score_ids_list,self.large_publication_ids_list,'2020-12-01',False,self.debug)
+            ftp_generator.build_metadata_ftp()
+            ftp_generator.build_bulk_metadata_ftp()
+            ftp_generator.build_large_study_metadata_ftp()
+            staged_plan = ftp_generator.get_plan()
+
+            for type in ('score', 'publication', 'all'):
+                self.assertEqual(sorted(streaming_plan.get_ids(type, 'new')), sorted(staged_plan.get_ids(type, 'new')))
+            self.assertEqual(sorted(streaming_plan.get_ids('score', 'new')), sorted(self.score_ids_list))
+            trees = {}
+            for name, new_ftp_dir in new_ftp_dirs.items():
+                trees[name] = { os.path.relpath(os.path.join(root, x), new_ftp_dir): self.get_md5_file_checksum(os.path.join(root, x)) for root, dirs, files in os.walk(new_ftp_dir) for x in files }
+            self.assertTrue(len(trees['staged']) > 0)
+            self.assertEqual(trees['streaming'], trees['staged'])
+        finally:
+            PGSBuildFtp.ftp_path = ftp_path
+            shutil.rmtree(ftp_dir,ignore_errors=True)
+            for new_ftp_dir in new_ftp_dirs.values():
+                shutil.rmtree(new_ftp_dir,ignore_errors=True)
+
+
+    def check_release_verifier(self):
+        """ Check that the verification of the new FTP structure passes, and reports the corrupted, inconsistent and missing files """
+        ftp_dir = self.current_dir+'/tests/ftp/'
+        new_ftp_dir = self.current_dir+'/tests/new_ftp_content_verified'
+        ftp_path = PGSBuildFtp.ftp_path
+        PGSBuildFtp.ftp_path = ftp_dir
+        try:
+            os.makedirs(ftp_dir+'scores')
+            os.makedirs(ftp_dir+'metadata')
+            ftp_generator = PGSFtpGenerator(self.export_dir,new_ftp_dir,self.score_ids_list,self.large_publication_ids_list,'2020-12-01',False,self.debug)
+            ftp_generator.build_metadata_ftp()
+            ftp_generator.build_bulk_metadata_ftp()
+            ftp_generator.build_large_study_metadata_ftp()
+
+            catalogue = PGSCatalogue(self.data)
+            verifier = PGSReleaseVerifier(new_ftp_dir, catalogue, workers=2)
+            self.assertTrue(verifier.run())
+            verifier.report()
+            entries_count = len(self.score_ids_list) + len(self.large_publication_ids_list) + 1
+            self.assertEqual(verifier.stats['archives'], entries_count)
+            self.assertEqual(verifier.stats['xlsx_files'], entries_count)
+            self.assertEqual(verifier.stats['csv_files'], entries_count * len(self.csv_files_types))
+            self.assertEqual(verifier.stats['members'], entries_count * (len(self.csv_files_types) + 1))
+
+            # Truncated archive, CSV file with a missing row and missing CSV file
+            with open(f'{new_ftp_dir}/scores/PGS1/Metadata/PGS1_metadata.tar.gz', 'r+b') as f:
+                f.truncate(os.path.getsize(f.name) // 2)
+            csv_file = f'{new_ftp_dir}/metadata/pgs_all_metadata_performance_metrics.csv'
+            with open(csv_file) as f:
+                lines = f.readlines()
+            with open(csv_file, 'w') as f:
+                f.writelines(lines[:-1])
+            os.remove(f'{new_ftp_dir}/scores/PGS2/Metadata/PGS2_metadata_cohorts.csv')
+            verifier = PGSReleaseVerifier(new_ftp_dir, catalogue, workers=2)
+            self.assertFalse(verifier.run())
+            errors = '\n'.join(verifier.errors)
+            self.assertIn('PGS1_metadata.tar.gz: invalid archive', errors)
+            self.assertIn(f'pgs_all_metadata_performance_metrics.csv: {len(lines)-2} rows instead of {len(lines)-1}', errors)
+            self.assertIn('PGS2_metadata_cohorts.csv: missing file', errors)
+            self.assertIn('PGS2_metadata.tar.gz: member PGS2_metadata_cohorts.csv not in the directory', errors)
+            self.assertIn('pgs_all_metadata.tar.gz: member pgs_all_metadata_performance_metrics.csv different from the file of the directory', errors)
+        finally:
+            PGSBuildFtp.ftp_path = ftp_path
+            shutil.rmtree(ftp_dir,ignore_errors=True)
+            shutil.rmtree(new_ftp_dir,ignore_errors=True)
+
+
+    def check_trait_exports(self):
+        """ Check the metadata files of each trait (Scores indexed by trait), their FTP structure (with the archive of the previous release) and their verification """
+        ftp_dir = self.current_dir+'/tests/ftp/'
+        new_ftp_dir = self.current_dir+'/tests/new_ftp_content_traits'
+        traits_dir = self.export_dir+'traits_metadata/'
+        ftp_path = PGSBuildFtp.ftp_path
+        PGSBuildFtp.ftp_path = ftp_dir
+        try:
+            catalogue = PGSCatalogue(self.data)
+            trait_ids_list = catalogue.get_trait_ids()
+            self.assertEqual(trait_ids_list, ['EFO_0000305', 'EFO_1000649', 'EFO_0000712', 'HP_0002140'])
+            self.assertEqual(catalogue.get_trait_score_ids('HP_0002140'), ['PGS3'])
+            self.assertEqual(catalogue.get_trait_score_ids('EFO_9999999'), [])
+
+            # Trait exports (2 worker processes): each trait of the test data is mapped to one Score, so its CSV files are the ones of the Score
+            exports_generator = PGSExportGenerator(self.export_dir,catalogue.data,self.scores_list_file,self.score_ids_list,self.large_publication_ids_list,self.current_release_date,self.ancestry_categories,self.debug,workers=2,data_index=catalogue,trait_ids_list=trait_ids_list)
+            exports_generator.call_generate_traits_metadata_exports()
+            for efo_id in trait_ids_list:
+                pgs_id = catalogue.get_trait_score_ids(efo_id)[0]
+                for type in self.csv_files_types:
+                    with open(f'{traits_dir}{efo_id}/{efo_id}_metadata_{type}.csv','rb') as f:
+                        trait_csv = f.read()
+                    with open(f'{self.export_dir}{pgs_id}/Metadata/{pgs_id}_metadata_{type}.csv','rb') as f:
+                        self.assertEqual(trait_csv, f.read())
+                with tarfile.open(f'{traits_dir}{efo_id}_metadata.tar.gz') as tar:
+                    self.assertEqual(sorted([ os.path.basename(x) for x in tar.getnames() if x ]), sorted(os.listdir(f'{traits_dir}{efo_id}')))
+
+            # Local FTP from the previous release: EFO_0000305 updated (with different CSV files) and EFO_9999999 removed
+            os.makedirs(ftp_dir+'scores')
+            shutil.copytree(f'{traits_dir}EFO_0000305', f'{ftp_dir}metadata/traits/EFO_0000305')
+            shutil.copy2(f'{traits_dir}EFO_0000305_metadata.tar.gz', f'{ftp_dir}metadata/traits/EFO_0000305/')
+            for filename in ['EFO_0000305_metadata.xlsx', 'EFO_0000305_metadata_scores.csv']:
+                with open(f'{ftp_dir}metadata/traits/EFO_0000305/{filename}', 'ab') as f:
+                    f.write(b'\n')
+            os.makedirs(f'{ftp_dir}metadata/traits/EFO_9999999')
+            shutil.copy2(f'{traits_dir}EFO_0000305/EFO_0000305_metadata.xlsx', f'{ftp_dir}metadata/traits/EFO_9999999/EFO_9999999_metadata.xlsx')
+
+            ftp_generator = PGSFtpGenerator(self.export_dir,new_ftp_dir,self.score_ids_list,self.large_publication_ids_list,'2020-12-01',False,self.debug,trait_ids_list=trait_ids_list)
+            plan = ftp_generator.get_plan()
+            self.assertEqual(plan.get_ids('trait', 'changed'), ['EFO_0000305'])
+            self.assertEqual(plan.get_ids('trait', 'new'), trait_ids_list[1:])
+            self.assertEqual(plan.get_ids('trait', 'removed'), ['EFO_9999999'])
+            self.assertTrue(plan.entries['trait']['EFO_0000305']['archive'])
+            ftp_generator.build_metadata_ftp()
+            ftp_generator.build_bulk_metadata_ftp()
+            ftp_generator.build_large_study_metadata_ftp()
+            ftp_generator.build_trait_metadata_ftp()
+            self.assertTrue(os.path.isfile(f'{new_ftp_dir}/metadata/traits/EFO_0000305/archived_versions/EFO_0000305_metadata_2020-12-01.tar.gz'))
+            self.assertTrue(os.path.isfile(f'{new_ftp_dir}/metadata/traits/HP_0002140/HP_0002140_metadata_scores.csv'))
+            self.assertFalse(os.path.isdir(f'{new_ftp_dir}/metadata/traits/EFO_9999999'))
+
+            # The trait directories are verified with the rows expected from the Scores of the trait
+            verifier = PGSReleaseVerifier(new_ftp_dir, catalogue)
+            self.assertIsNotNone(verifier.get_expected_content('metadata/traits/EFO_0000305/'))
+            self.assertTrue(verifier.run())
+            entries_count = len(self.score_ids_list) + len(self.large_publication_ids_list) + len(trait_ids_list) + 1
+            self.assertEqual(verifier.stats['xlsx_files'], entries_count)
+
+            # Trait directory without Score (its expected rows are not the ones of the whole catalogue)
+            self.assertEqual(verifier.get_expected_content('metadata/traits/EFO_9999999/'), { 'error': 'unexpected trait directory (no Score associated with EFO_9999999)' })
+            shutil.copytree(f'{ftp_dir}metadata/traits/EFO_9999999', f'{new_ftp_dir}/metadata/traits/EFO_9999999')
+            verifier = PGSReleaseVerifier(new_ftp_dir, catalogue)
+            self.assertFalse(verifier.run())
+            self.assertEqual(verifier.errors, [f'{new_ftp_dir}/metadata/traits/EFO_9999999/: unexpected trait directory (no Score associated with EFO_9999999)'])
+        finally:
+            PGSBuildFtp.ftp_path = ftp_path
+            shutil.rmtree(ftp_dir,ignore_errors=True)
+            shutil.rmtree(new_ftp_dir,ignore_errors=True)
+            shutil.rmtree(traits_dir,ignore_errors=True)
+
+
+    def check_release_delta(self):
+        """ Check that the delta archive applied on a mirror of the FTP updates it to the new release, keeping the archives of the previous releases """
+        delta_dir = self.current_dir+'/tests/delta/'
+        try:
+            # FTP mirror: PGS1, PGS2 (with the archive of a previous release) and the all metadata of a previous release
+            # New release tree: PGS1 (updated) and PGS3, PGS2 removed
+            for pgs_id in ['PGS1', 'PGS2']:
+                shutil.copytree(f'{self.export_dir}{pgs_id}', f'{delta_dir}previous/scores/{pgs_id}')
+            os.makedirs(f'{delta_dir}previous/scores/PGS2/Metadata/archived_versions')
+            shutil.copy2(f'{self.export_dir}PGS2_metadata.tar.gz', f'{delta_dir}previous/scores/PGS2/Metadata/archived_versions/PGS2_metadata_2020-06-01.tar.gz')
+            os.makedirs(f'{delta_dir}previous/metadata/previous_releases/2020')
+            shutil.copy2(f'{self.export_dir}pgs_all_metadata.tar.gz', f'{delta_dir}previous/metadata/previous_releases/2020/pgs_all_metadata_2020-06-01.tar.gz')
+            for pgs_id in ['PGS1', 'PGS3']:
+                shutil.copytree(f'{self.export_dir}{pgs_id}', f'{delta_dir}new/scores/{pgs_id}')
+            with open(f'{delta_dir}new/scores/PGS1/Metadata/PGS1_metadata_scores.csv', 'a') as f:
+                f.write('\n')
+
+            # Manifest of the previous release tree: PGS1 and PGS2 only
+            previous_manifest = { x: e for x, e in PGSReleaseDelta(delta_dir+'previous').get_manifest().items() if '/PGS3/' not in x and 'archived_versions' not in x and 'previous_releases' not in x }
+            with open(delta_dir+'previous_manifest.tsv', 'w') as f:
+                f.write(PGSReleaseManifest.get_content(previous_manifest))
+            self.assertEqual(PGSReleaseManifest.read(delta_dir+'previous_manifest.tsv'), previous_manifest)
+            removed_files = sorted([ f'scores/PGS2/Metadata/{x}' for x in os.listdir(f'{delta_dir}previous/scores/PGS2/Metadata') if x.endswith(('.csv', '.xlsx')) ])
+            release_delta = PGSReleaseDelta(delta_dir+'new')
+            manifest_file = PGSReleaseManifest(delta_dir+'new').write()
+            manifest = PGSReleaseManifest.read(manifest_file)
+            delta = release_delta.create_delta_archive(delta_dir+'delta.tar.gz', manifest, previous_manifest, removed_files)
+            # The unchanged files of PGS1 are identical to the ones of the previous release
+            self.assertEqual(len(delta['changed']), 1+len(os.listdir(f'{delta_dir}new/scores/PGS3/Metadata')))
+            self.assertEqual(delta['deleted'], removed_files)
+
+            # Second mirror, updated from a relative path
+            shutil.copytree(delta_dir+'previous', delta_dir+'mirror')
+
+            self.assertEqual(PGSReleaseDelta(delta_dir+'previous').apply_delta_archive(delta_dir+'delta.tar.gz'), [])
+            mirror_manifest = PGSReleaseDelta(delta_dir+'previous').get_manifest()
+            for filepath, entry in manifest.items():
+                self.assertEqual(mirror_manifest[filepath], entry)
+            # The mirror gets the manifest published with the release
+            self.assertEqual(PGSReleaseManifest.read(delta_dir+'previous/'+PGSReleaseManifest.manifest_file_name), manifest)
+            self.assertEqual(os.listdir(f'{delta_dir}previous/scores/PGS2/Metadata'), ['archived_versions'])
+            self.assertTrue(os.path.isfile(f'{delta_dir}previous/scores/PGS2/Metadata/archived_versions/PGS2_metadata_2020-06-01.tar.gz'))
+            self.assertTrue(os.path.isfile(f'{delta_dir}previous/metadata/previous_releases/2020/pgs_all_metadata_2020-06-01.tar.gz'))
+
+            relative_tree = './'+os.path.relpath(delta_dir+'mirror')
+            self.assertEqual(PGSReleaseDelta(relative_tree).apply_delta_archive(delta_dir+'delta.tar.gz'), [])
+            self.assertEqual(os.listdir(f'{delta_dir}mirror/scores/PGS2/Metadata'), ['archived_versions'])
+        finally:
+            shutil.rmtree(delta_dir,ignore_errors=True)
+
+
     def create_pgs_directory(self,path):
         """
         Creates directory for a given PGS
@@ -198,4 +985,21 @@ if __name__ == "__main__":
     export_test = TestSum()
     export_test.get_all_data()
     export_test.generates_export_files()
+    export_test.check_checkpoint()
+    export_test.check_hash_service()
+    export_test.check_csv_backends()
+    export_test.check_csv_encoding()
+    export_test.check_ancestry_table()
+    export_test.check_blob_store()
+    export_test.check_export_bundle()
+    export_test.check_incremental_all_metadata()
+    export_test.check_large_publication_selection()
+    export_test.check_sqlite_catalogue()
+    export_test.check_export_scheduler()
+    export_test.check_ftp_plan()
+    export_test.check_ftp_pipeline()
+    export_test.check_release_verifier()
+    export_test.check_trait_exports()
+    export_test.check_release_delta()
+    export_test.check_rest_fetcher()
     export_test.compare_files()
\ No newline at end of file